@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Benchmark of internal CENC decrypter (tools_cenc.cencdecrypt) against mp4decrypt binary.
+# Synthetic init and media segments are generated and encrypted, so no real stream is needed.
+#
+# Usage:
+#   python3 benchmark/bench_cenc.py [--scheme cenc|cbcs] [--samples N] [--sample-size BYTES] [--rounds N] [--binary PATH]
+#
+# Binary path is optional - if not provided (or not runnable on this machine), only internal decrypter is measured.
+
+import os, sys, struct, time, argparse, tempfile, subprocess
+from binascii import a2b_hex
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tools_cenc.cencdecrypt import CencDecrypter, InitSegment, is_available, iter_boxes
+
+try:
+	from Cryptodome.Cipher import AES
+	from Cryptodome.Util import Counter
+except:
+	from Crypto.Cipher import AES
+	from Crypto.Util import Counter
+
+KID = '0123456789abcdef0123456789abcdef'
+KEY = 'fedcba9876543210fedcba9876543210'
+TRACK_ID = 1
+
+# ###########################################################################################################
+
+def box(box_type, *payload):
+	data = b''.join(payload)
+	return struct.pack('>I', len(data) + 8) + box_type + data
+
+def full_box(box_type, version, flags, *payload):
+	return box(box_type, struct.pack('>I', (version << 24) | flags), *payload)
+
+# ###########################################################################################################
+
+def create_init_segment(scheme, iv_size, constant_iv=None):
+	if scheme == b'cbcs':
+		tenc = full_box(b'tenc', 1, 0, b'\x00', struct.pack('>BBB', 0x19, 1, iv_size), a2b_hex(KID))
+		if iv_size == 0:
+			tenc = full_box(b'tenc', 1, 0, b'\x00', struct.pack('>BBB', 0x19, 1, 0), a2b_hex(KID), struct.pack('>B', len(constant_iv)), constant_iv)
+	else:
+		tenc = full_box(b'tenc', 0, 0, b'\x00\x00', struct.pack('>BB', 1, iv_size), a2b_hex(KID))
+
+	sinf = box(b'sinf', box(b'frma', b'avc1'), full_box(b'schm', 0, 0, scheme, struct.pack('>I', 0x10000)), box(b'schi', tenc))
+	encv = box(b'encv', b'\x00' * 78, sinf)
+	stsd = full_box(b'stsd', 0, 0, struct.pack('>I', 1), encv)
+	stbl = box(b'stbl', stsd)
+	minf = box(b'minf', stbl)
+	mdia = box(b'mdia', minf)
+	tkhd = full_box(b'tkhd', 0, 3, b'\x00' * 8, struct.pack('>I', TRACK_ID), b'\x00' * 68)
+	trak = box(b'trak', tkhd, mdia)
+	trex = full_box(b'trex', 0, 0, struct.pack('>5I', TRACK_ID, 1, 0, 0, 0))
+	mvex = box(b'mvex', trex)
+	moov = box(b'moov', trak, mvex)
+	ftyp = box(b'ftyp', b'iso6', struct.pack('>I', 0), b'iso6dash')
+	return ftyp + moov
+
+# ###########################################################################################################
+
+def encrypt_sample(scheme, key, iv, sample, subsamples):
+	out = bytearray(sample)
+	ranges = []
+	pos = 0
+	for clear, enc in subsamples:
+		pos += clear
+		ranges.append((pos, enc))
+		pos += enc
+
+	if scheme == b'cenc':
+		ctr = Counter.new(128, initial_value=int.from_bytes(iv + b'\x00' * (16 - len(iv)), 'big'))
+		cipher = AES.new(key, AES.MODE_CTR, counter=ctr)
+		for p, s in ranges:
+			out[p:p + s] = cipher.encrypt(bytes(out[p:p + s]))
+	else:
+		# cbcs with 1:9 pattern, IV reset for each subsample
+		for p, s in ranges:
+			cipher = AES.new(key, AES.MODE_CBC, iv)
+			end = p + s
+			while p + 16 <= end:
+				out[p:p + 16] = cipher.encrypt(bytes(out[p:p + 16]))
+				p += 160
+
+	return bytes(out)
+
+# ###########################################################################################################
+
+def create_media_segment(scheme, samples_count, sample_size, iv_size, constant_iv=None):
+	key = a2b_hex(KEY)
+	samples = []
+	enc_samples = []
+	senc_entries = []
+
+	for i in range(samples_count):
+		sample = os.urandom(sample_size)
+		# two subsamples - small clear NAL header followed by encrypted payload
+		half = sample_size // 2
+		subsamples = [(5, half - 5), (7, sample_size - half - 7)]
+		if iv_size:
+			iv = os.urandom(iv_size)
+		else:
+			iv = constant_iv
+
+		samples.append(sample)
+		enc_samples.append(encrypt_sample(scheme, key, iv if len(iv) == 16 else iv + b'\x00' * 8, sample, subsamples))
+		senc_entries.append((iv if iv_size else b'') + struct.pack('>H', len(subsamples)) + b''.join(struct.pack('>HI', c, e) for c, e in subsamples))
+
+	senc = full_box(b'senc', 0, 2, struct.pack('>I', samples_count), *senc_entries)
+	saiz = full_box(b'saiz', 0, 0, struct.pack('>BI', 0, samples_count), bytes(bytearray(len(e) for e in senc_entries)))
+
+	def build(data_offset, saio_offset):
+		trun = full_box(b'trun', 0, 0x201, struct.pack('>Ii', samples_count, data_offset), *[struct.pack('>I', sample_size)] * samples_count)
+		saio = full_box(b'saio', 0, 0, struct.pack('>II', 1, saio_offset))
+		tfhd = full_box(b'tfhd', 0, 0x20000, struct.pack('>I', TRACK_ID))
+		tfdt = full_box(b'tfdt', 1, 0, struct.pack('>Q', 0))
+		traf = box(b'traf', tfhd, tfdt, trun, saiz, saio, senc)
+		return box(b'moof', full_box(b'mfhd', 0, 0, struct.pack('>I', 1)), traf)
+
+	# build twice - first time to get right offsets
+	moof = build(0, 0)
+	senc_offset = moof.find(b'senc') + 4 + 4 + 4
+	moof = build(len(moof) + 8, senc_offset)
+	mdat = box(b'mdat', *enc_samples)
+	styp = box(b'styp', b'msdh', struct.pack('>I', 0), b'msdhmsix')
+
+	return styp + moof + mdat, b''.join(samples), len(styp) + len(moof) + 8
+
+# ###########################################################################################################
+
+def binary_decrypt(binary, keys, init_data, enc_data):
+	tmp_dir = tempfile.mkdtemp()
+	init_file = os.path.join(tmp_dir, 'init.mp4')
+	in_file = os.path.join(tmp_dir, 'in.m4s')
+	out_file = os.path.join(tmp_dir, 'out.m4s')
+
+	with open(init_file, 'wb') as f:
+		f.write(init_data)
+
+	with open(in_file, 'wb') as f:
+		f.write(enc_data)
+
+	cmd = [binary]
+	for k in keys:
+		cmd.extend(['--key', k])
+	cmd.extend(['--fragments-info', init_file, in_file, out_file])
+
+	try:
+		subprocess.check_call(cmd)
+		with open(out_file, 'rb') as f:
+			return f.read()
+	finally:
+		for f in (init_file, in_file, out_file):
+			try:
+				os.remove(f)
+			except:
+				pass
+		os.rmdir(tmp_dir)
+
+# ###########################################################################################################
+
+def mdat_payload(data):
+	for t, bstart, pstart, bend in iter_boxes(data, 0, len(data)):
+		if t == b'mdat':
+			return data[pstart:bend]
+
+def measure(name, rounds, fn):
+	start = time.time()
+	for i in range(rounds):
+		result = fn()
+	duration = time.time() - start
+	print('%-28s %8.2f ms / segment' % (name, duration * 1000 / rounds))
+	return result
+
+# ###########################################################################################################
+
+def main():
+	parser = argparse.ArgumentParser(description='CENC decryption benchmark')
+	parser.add_argument('--scheme', choices=('cenc', 'cbcs'), default='cenc')
+	parser.add_argument('--samples', type=int, default=100, help='number of samples in media segment')
+	parser.add_argument('--sample-size', type=int, default=20000, help='size of one sample in bytes')
+	parser.add_argument('--rounds', type=int, default=20)
+	parser.add_argument('--binary', help='path to mp4decrypt binary')
+	args = parser.parse_args()
+
+	if not is_available():
+		print('No AES implementation available - internal decrypter can\'t be used')
+		return 1
+
+	scheme = args.scheme.encode('ascii')
+	if scheme == b'cbcs':
+		iv_size = 0
+		constant_iv = os.urandom(16)
+	else:
+		iv_size = 8
+		constant_iv = None
+
+	init_data = create_init_segment(scheme, iv_size, constant_iv)
+	enc_data, plain_data, mdat_offset = create_media_segment(scheme, args.samples, args.sample_size, iv_size, constant_iv)
+	keys = ['%s:%s' % (KID, KEY)]
+
+	print('Scheme: %s, segment size: %d bytes, samples: %d, rounds: %d' % (args.scheme, len(enc_data), args.samples, args.rounds))
+
+	init = InitSegment(init_data)
+	dec = measure('internal (parsed init)', args.rounds, lambda: CencDecrypter(keys).decrypt(init, enc_data))
+	print('  output valid: %s' % (mdat_payload(dec) == plain_data))
+
+	measure('internal (raw init)', args.rounds, lambda: CencDecrypter(keys).decrypt(init_data, enc_data))
+
+	if args.binary:
+		try:
+			dec = measure('mp4decrypt binary', args.rounds, lambda: binary_decrypt(args.binary, keys, init_data, enc_data))
+			print('  output valid: %s' % (mdat_payload(dec) == plain_data))
+		except Exception as e:
+			print('Failed to run mp4decrypt binary: %s' % str(e))
+
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Benchmark of EPG export to enigma's EPG cache (tools_archivczsk.generator.enigmaepg) against original way of import
+# (one importEvents call per event). Enigma is not needed - stub EPG cache parses service reference and stores events
+# on every call, which is roughly what real eEPGCache does.
+#
+# Usage:
+#   python3 benchmark/bench_enigmaepg.py [--channels N] [--days N] [--event-length MINUTES] [--batch-size N] [--rounds N]
+
+import os, sys, time, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tools_archivczsk.generator.enigmaepg import EnigmaEpgGeneratorTemplate
+
+# ###########################################################################################################
+
+class StubEpgCache(object):
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.calls = 0
+		self.events = 0
+		self.max_call_time = 0
+		self.services = {}
+
+	def importEvents(self, services, events):
+		start = time.time()
+		self.calls += 1
+		for service in services:
+			key = tuple(int(x, 16) for x in service.split(':')[3:7])
+			data = self.services.setdefault(key, {})
+			for event in events:
+				data[event[0]] = event
+				self.events += 1
+
+		self.max_call_time = max(self.max_call_time, time.time() - start)
+
+# ###########################################################################################################
+
+class BenchEpgGenerator(EnigmaEpgGeneratorTemplate):
+	def __init__(self, epgcache, channels, event_length):
+		self.sid_start = 1
+		self.tid = 1
+		self.onid = 1
+		self.namespace = 0x7070000
+		self.prefix = 'bench'
+		self.channels = channels
+		self.event_length = event_length
+		self.epg_import_pause = 0
+		EnigmaEpgGeneratorTemplate.__init__(self, epgcache=epgcache)
+
+	def get_channels(self):
+		return [{ 'id': i, 'name': 'Channel %d' % i } for i in range(self.channels)]
+
+	def get_epg(self, channel, fromts, tots):
+		ts = fromts // 3600 * 3600
+		i = 0
+		while ts < tots:
+			yield {
+				'start': ts,
+				'end': ts + self.event_length,
+				'title': 'Pořad %d' % i,
+				'desc': 'Popis pořadu %d na kanálu %d' % (i, channel['id'])
+			}
+			ts += self.event_length
+			i += 1
+
+	def start_epg_export_legacy(self, days):
+		# original implementation - one call per event
+		fromts = int(time.time())
+		tots = fromts + (int(days) * 86400)
+
+		for channel in self.get_channels():
+			serviceref = '1:0:1:%X:%X:%X:%X:0:0:0:http%%3a//' % (self.sid_start + channel['id'], self.tid, self.onid, self.namespace)
+			for event in self.get_epg(channel, fromts, tots):
+				start = self.to_utc(event['start'])
+				stop = self.to_utc(event['end'])
+				title = str(event['title'])
+				subtitle = str(event.get('subtitle') or '')
+				desc = str(event.get('desc') or '')
+				self.epgcache.importEvents([serviceref], ((int(start), int(stop - start), title, subtitle, desc, 0),))
+
+# ###########################################################################################################
+
+def measure(name, fn, epgcache, rounds):
+	best = None
+	for i in range(rounds):
+		epgcache.reset()
+		start = time.time()
+		fn()
+		duration = time.time() - start
+		best = duration if best is None else min(best, duration)
+
+	print('%-10s %8.3f s  calls: %7d  events: %7d  longest call: %6.2f ms' % (name, best, epgcache.calls, epgcache.events, epgcache.max_call_time * 1000))
+	return best
+
+# ###########################################################################################################
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--channels', type=int, default=200)
+	parser.add_argument('--days', type=int, default=7)
+	parser.add_argument('--event-length', type=int, default=30, help='length of one event in minutes')
+	parser.add_argument('--batch-size', type=int, default=500)
+	parser.add_argument('--rounds', type=int, default=3)
+	args = parser.parse_args()
+
+	epgcache = StubEpgCache()
+	generator = BenchEpgGenerator(epgcache, args.channels, args.event_length * 60)
+	generator.epg_import_batch_size = args.batch_size
+
+	legacy = measure('legacy', lambda: generator.start_epg_export_legacy(args.days), epgcache, args.rounds)
+	batch = measure('batch', lambda: generator.start_epg_export(args.days), epgcache, args.rounds)
+	print('Speedup: %.2fx' % (legacy / batch))
+
+if __name__ == '__main__':
+	main()
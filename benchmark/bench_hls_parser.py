@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Benchmark of HLS playlist parser (tools_archivczsk.parser.hls) against original implementation. Synthetic media
+# playlist with long DVR window (key rotation every few segments) and master playlist with many variants are used.
+#
+# Usage:
+#   python3 benchmark/bench_hls_parser.py [--segments N] [--key-every N] [--variants N] [--rounds N]
+
+import os, sys, re, time, argparse
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tools_archivczsk.parser.hls import HlsPlaylist
+
+# ###########################################################################################################
+# original implementation of parser - only parts needed for comparison
+
+class LegacyAttrValue(object):
+	def __init__(self, value):
+		if value.startswith('"'):
+			self.value = value[1:-1]
+			self.use_qm = True
+		else:
+			self.value = value
+			self.use_qm = False
+
+	def __str__(self):
+		return self.value
+
+	def __eq__(self, value):
+		return self.value == value
+
+	def export(self):
+		return '"%s"' % self.value if self.use_qm else self.value
+
+class LegacySegmentHeader(object):
+	def __init__(self, segment_url, attrs='', key={}):
+		self.segment_url = segment_url
+		self.duration = attrs.split(',', 1)[0]
+		self.key = key
+
+	def __str__(self):
+		if self.key:
+			key='#EXT-X-KEY:{}\n'.format(','.join('%s=%s' % (k, v.export()) for k, v in self.key.items()))
+		else:
+			key = ''
+
+		return '{}#EXTINF:{},\n{}'.format(key, self.duration, self.segment_url)
+
+class LegacyHlsPlaylist(HlsPlaylist):
+	@staticmethod
+	def parse_attributes(line):
+		attr = OrderedDict()
+		for a in re.findall(r'(?:[^\s,"]|"(?:\\.|[^"])*")+', line):
+			s = a.split('=')
+			value = '='.join(s[1:])
+			attr[s[0]] = LegacyAttrValue(value)
+
+		return attr
+
+	def add_segment(self, attrs, segment_url, key={}):
+		self.segments.append(LegacySegmentHeader(segment_url, attrs, key))
+
+	def parse(self, playlist_data):
+		attrs = {}
+		key = {}
+		in_header = True
+		video_playlist = False
+
+		for line in iter(playlist_data.splitlines()):
+			line = line.strip()
+			if not line:
+				continue
+
+			if not line.startswith('#'):
+				if video_playlist:
+					self.add_video_playlist(attrs, line)
+				else:
+					self.add_segment(attrs, line, key)
+					key = {}
+				attrs = {}
+
+			elif line.startswith('#EXT-X-STREAM-INF:'):
+				in_header = False
+				video_playlist = True
+				attrs = self.parse_attributes(line[18:])
+			elif line.startswith('#EXTINF:'):
+				in_header = False
+				video_playlist = False
+				attrs = line[8:]
+			elif line.startswith('#EXT-X-MEDIA:'):
+				in_header = False
+				self.add_media_playlist(self.parse_attributes(line[13:]))
+			elif line.startswith('#EXT-X-KEY:'):
+				key = self.parse_attributes(line[11:])
+			elif line == '#EXT-X-ENDLIST':
+				self.finished = True
+			elif in_header:
+				self.header.append(line)
+
+# ###########################################################################################################
+
+def create_media_playlist(segments, key_every):
+	data = ['#EXTM3U', '#EXT-X-VERSION:6', '#EXT-X-TARGETDURATION:6', '#EXT-X-MEDIA-SEQUENCE:1000', '#EXT-X-MAP:URI="init.mp4"']
+	for i in range(segments):
+		if key_every and i % key_every == 0:
+			data.append('#EXT-X-KEY:METHOD=SAMPLE-AES,URI="data:text/plain;base64,AAAAW3Bzc2gAAAAA7e+LqXnWSs6jyCfc1R0h7QAAADsIARIQ%08d",KEYID=0x%032x,KEYFORMAT="urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed",KEYFORMATVERSIONS="1"' % (i, i))
+		data.append('#EXTINF:6.000000,')
+		data.append('https://cdn.example.com/live/channel/video/%d/segment_%d.m4s?token=abcdef0123456789' % (i // 100, i))
+
+	return '\n'.join(data) + '\n'
+
+def create_master_playlist(variants):
+	data = ['#EXTM3U', '#EXT-X-VERSION:6', '#EXT-X-INDEPENDENT-SEGMENTS']
+	for lang in ('cs', 'sk', 'en', 'de'):
+		data.append('#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",LANGUAGE="%s",NAME="Audio %s",DEFAULT=NO,AUTOSELECT=YES,CHANNELS="2",URI="audio_%s.m3u8"' % (lang, lang, lang))
+		data.append('#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",LANGUAGE="%s",NAME="Subs %s",DEFAULT=NO,AUTOSELECT=YES,FORCED=NO,URI="subs_%s.m3u8"' % (lang, lang, lang))
+	for i in range(variants):
+		data.append('#EXT-X-STREAM-INF:BANDWIDTH=%d,AVERAGE-BANDWIDTH=%d,CODECS="avc1.640028,mp4a.40.2",RESOLUTION=%dx%d,FRAME-RATE=25.000,AUDIO="audio",SUBTITLES="subs"' % (500000 + i * 1000, 400000 + i * 1000, 640 + i, 360 + i))
+		data.append('video_%d.m3u8' % i)
+
+	return '\n'.join(data) + '\n'
+
+# ###########################################################################################################
+
+def measure(name, fn, rounds):
+	best = None
+	for i in range(rounds):
+		start = time.time()
+		ret = fn()
+		duration = time.time() - start
+		best = duration if best is None else min(best, duration)
+
+	print('%-28s %8.2f ms' % (name, best * 1000))
+	return best, ret
+
+def parse(cls, data, lazy=None):
+	p = cls('http://example.com/playlist.m3u8') if lazy is None else cls('http://example.com/playlist.m3u8', lazy=lazy)
+	p.parse(data)
+	return p
+
+# ###########################################################################################################
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--segments', type=int, default=10000)
+	parser.add_argument('--key-every', type=int, default=5, help='add #EXT-X-KEY line before every N-th segment (0 = never)')
+	parser.add_argument('--variants', type=int, default=200)
+	parser.add_argument('--rounds', type=int, default=5)
+	args = parser.parse_args()
+
+	media_data = create_media_playlist(args.segments, args.key_every)
+	master_data = create_master_playlist(args.variants)
+
+	print('Media playlist: %d segments, %d bytes' % (args.segments, len(media_data)))
+	legacy, p_legacy = measure('legacy parse', lambda: parse(LegacyHlsPlaylist, media_data), args.rounds)
+	new, p_new = measure('parse', lambda: parse(HlsPlaylist, media_data, False), args.rounds)
+	lazy, p_lazy = measure('parse (lazy)', lambda: parse(HlsPlaylist, media_data, True), args.rounds)
+	measure('legacy parse + to_string', lambda: parse(LegacyHlsPlaylist, media_data).to_string(), args.rounds)
+	measure('parse + to_string', lambda: parse(HlsPlaylist, media_data, False).to_string(), args.rounds)
+	measure('parse (lazy) + to_string', lambda: parse(HlsPlaylist, media_data, True).to_string(), args.rounds)
+	print('Output identical: %s' % (p_legacy.to_string() == p_new.to_string() == p_lazy.to_string()))
+	print('Speedup: %.2fx, lazy: %.2fx' % (legacy / new, legacy / lazy))
+
+	print('\nMaster playlist: %d variants, %d bytes' % (args.variants, len(master_data)))
+	legacy, p_legacy = measure('legacy parse', lambda: parse(LegacyHlsPlaylist, master_data), args.rounds)
+	new, p_new = measure('parse', lambda: parse(HlsPlaylist, master_data, False), args.rounds)
+	print('Output identical: %s' % (p_legacy.to_string() == p_new.to_string()))
+	print('Speedup: %.2fx' % (legacy / new))
+
+if __name__ == '__main__':
+	main()
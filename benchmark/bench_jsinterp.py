@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Benchmark of YouTube n-param function evaluation - JSInterpreter (interprets source code on every call) against
+# JSCompiler (code is compiled to python closures once). Synthetic player contains n-function in the same style as
+# real players: array of helper functions and values, that are called in long comma separated expression in try block.
+#
+# Usage:
+#   python3 benchmark/bench_jsinterp.py [--inputs N] [--calls N] [--rounds N]
+
+import os, sys, time, random, types, argparse
+
+# __init__ of youtube package needs enigma, so only modules of interpreter are loaded from it
+youtube_package = types.ModuleType('youtube')
+youtube_package.__path__ = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugin_video_yt', 'youtube')]
+sys.modules['youtube'] = youtube_package
+
+from youtube.jsinterp import JSInterpreter
+from youtube.jscompiler import JSCompiler
+
+# ###########################################################################################################
+
+HELPERS = [
+	# swap first item with item at position
+	'function(d,e){e=(e%d.length+d.length)%d.length;var f=d[0];d[0]=d[e];d[e]=f}',
+	# reverse
+	'function(d){d.reverse()}',
+	# rotate
+	'function(d,e){for(e=(e%d.length+d.length)%d.length;e--;)d.unshift(d.pop())}',
+	# remove item
+	'function(d,e){e=(e%d.length+d.length)%d.length;d.splice(e,1)}',
+	# splice swap
+	'function(d,e){e=(e%d.length+d.length)%d.length;d.splice(0,1,d.splice(e,1,d[0])[0])}',
+	# push
+	'function(d,e){d.push(e)}',
+	# cipher with alphabet generated by loop with switch
+	'''function(d,e){for(var f=64,h=[];++f-h.length-32;){switch(f){case 58:f-=14;case 91:case 92:case 93:continue;
+	case 123:f=47;case 94:case 95:case 96:continue;case 46:f=95;default:h.push(String.fromCharCode(f))}}
+	d.forEach(function(l,m,n){this.push(n[m]=h[(h.indexOf(l)-h.indexOf(this[m])+m-32+f--)%h.length])},e.split(""))}''',
+	# the same cipher with fixed alphabet
+	'''function(d,e,f){var h=f.length;d.forEach(function(l,m,n){this.push(n[m]=f[(f.indexOf(l)-f.indexOf(this[m])+m+h--)%f.length])},e.split(""))}''',
+]
+
+ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_'
+
+
+def create_player(calls, seed=1):
+	rnd = random.Random(seed)
+
+	# c[0..7] helpers, c[8] = b, c[9] = alphabet, c[10] = c, c[11..] numbers and strings
+	items = HELPERS + ['b', '"%s"' % ALPHABET, 'null']
+	values = []
+	for i in range(24):
+		if i % 3 == 0:
+			values.append('"%s"' % ''.join(rnd.choice(ALPHABET) for _ in range(8)))
+		else:
+			values.append(str(rnd.randint(-1000, 1000)))
+	items.extend(values)
+	nvalues = len(values)
+
+	strings = [11 + i for i in range(nvalues) if i % 3 == 0]
+	numbers = [11 + i for i in range(nvalues) if i % 3 != 0]
+
+	statements = []
+	for i in range(calls):
+		h = rnd.randint(0, len(HELPERS) - 1)
+		number = rnd.choice(numbers)
+		string = rnd.choice(strings)
+		if h == 1:
+			statements.append('c[%d](c[8])' % h)
+		elif h == 5:
+			statements.append('(0,c[%d])(c[8],c[%d])' % (h, string))
+		elif h == 6:
+			statements.append('c[%d](c[8],c[%d])' % (h, string))
+		elif h == 7:
+			statements.append('c[%d](c[8],c[%d],c[9])' % (h, string))
+		else:
+			statements.append('c[%d](c[8],c[%d])' % (h, number))
+
+		if i % 10 == 9:
+			statements.append('c[%d]>=-%d||c[%d]<%d&&c[1](c[8])' % (number, rnd.randint(0, 1000), number, rnd.randint(-1000, 0)))
+
+	code = (
+		'var Xa=function(a){var b=a.split(""),c=[%s];c[10]=c;'
+		'try{%s}catch(d){return"enhanced_except_"+a}return b.join("")};'
+	) % (','.join(items), ','.join(statements))
+
+	return code
+
+# ###########################################################################################################
+
+
+def measure(name, fn, rounds):
+	best = None
+	for i in range(rounds):
+		start = time.time()
+		ret = fn()
+		duration = time.time() - start
+		best = duration if best is None else min(best, duration)
+
+	print('%-32s %10.2f ms' % (name, best * 1000))
+	return best, ret
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--inputs', type=int, default=10, help='number of n-param values to transform')
+	parser.add_argument('--calls', type=int, default=60, help='number of helper calls in n-function')
+	parser.add_argument('--rounds', type=int, default=1)
+	args = parser.parse_args()
+
+	code = create_player(args.calls)
+	rnd = random.Random(2)
+	inputs = [''.join(rnd.choice(ALPHABET) for _ in range(16)) for i in range(args.inputs)]
+
+	jsi = JSInterpreter(code)
+	argnames, func_code = jsi.extract_function_code('Xa')
+	print('n-function: %d bytes, %d helper calls, %d inputs' % (len(func_code), args.calls, len(inputs)))
+
+	def interpret():
+		f = jsi.extract_function_from_code(argnames, func_code)
+		return [f([n]) for n in inputs]
+
+	def compile_only():
+		return JSCompiler(jsi).compile_function(argnames, func_code)
+
+	def compiled():
+		f = JSCompiler(jsi).compile_function(argnames, func_code)
+		return [f([n]) for n in inputs]
+
+	interpreted_time, interpreted = measure('interpreter', interpret, args.rounds)
+	measure('compile', compile_only, args.rounds)
+	compiled_time, compiled_ret = measure('compile + run', compiled, args.rounds)
+
+	failed = sum(1 for r in interpreted if r.startswith('enhanced_except_'))
+	print('Output identical: %s, failed transformations: %d' % (interpreted == compiled_ret, failed))
+	print('Per input: interpreter %.3f ms, compiled %.3f ms' % (interpreted_time * 1000 / len(inputs), compiled_time * 1000 / len(inputs)))
+	print('Speedup: %.1fx' % (interpreted_time / compiled_time))
+
+
+if __name__ == '__main__':
+	main()
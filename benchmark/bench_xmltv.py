@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Benchmark of XMLTV writer (tools_archivczsk.generator.xmltv) against original way of writing XMLEPG data file
+# (several small writes per programme and datetime.strftime for every timestamp).
+# Synthetic EPG is generated, so no addon or network is needed.
+#
+# Usage:
+#   python3 benchmark/bench_xmltv.py [--channels N] [--days N] [--event-length MINUTES] [--rounds N]
+
+import os, sys, time, argparse, tempfile, shutil
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tools_archivczsk.generator.xmltv import XmlTvWriter
+
+# ###########################################################################################################
+
+def create_epg(channels, days, event_length):
+	start_ts = int(time.time()) // 3600 * 3600
+	end_ts = start_ts + days * 86400
+	epg = []
+	for ch in range(channels):
+		events = []
+		ts = start_ts
+		i = 0
+		while ts < end_ts:
+			events.append((ts, ts + event_length, 'Pořad %d & díl %d' % (ch, i), 'Popis pořadu <%d> na kanálu %d - ' % (i, ch) + 'lorem ipsum dolor sit amet ' * 4))
+			ts += event_length
+			i += 1
+		epg.append(('Channel_%d' % ch, events))
+
+	return epg
+
+# ###########################################################################################################
+
+def write_legacy(file_name, epg):
+	with open(file_name, 'w') as f:
+		f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+		f.write('<tv generator-info-name="bench" generator-info-url="https://bench.cz" generator-info-partner="none">\n')
+		for channel_id, events in epg:
+			for event in events:
+				xml_data = {
+					'start': datetime.utcfromtimestamp(event[0]).strftime('%Y%m%d%H%M%S') + ' 0000',
+					'stop': datetime.utcfromtimestamp(event[1]).strftime('%Y%m%d%H%M%S') + ' 0000',
+					'title': escape(str(event[2])),
+					'desc': escape(event[3]) if event[3] != None else ' '
+				}
+				f.write(' <programme start="%s" stop="%s" channel="%s">\n' % (xml_data['start'], xml_data['stop'], channel_id))
+				f.write('  <title lang="cs">%s</title>\n' % xml_data['title'])
+				f.write('  <desc lang="cs">%s</desc>\n' % xml_data['desc'])
+				f.write(' </programme>\n')
+		f.write('</tv>\n')
+
+def write_xmltv(file_name, epg, compress=False):
+	with XmlTvWriter(file_name, compress) as f:
+		f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+		f.write('<tv generator-info-name="bench" generator-info-url="https://bench.cz" generator-info-partner="none">\n')
+		for channel_id, events in epg:
+			for event in events:
+				f.write_programme(channel_id, event[0], event[1], event[2], event[3])
+		f.write('</tv>\n')
+
+# ###########################################################################################################
+
+def measure(name, fn, file_name, rounds):
+	best = None
+	for i in range(rounds):
+		start = time.time()
+		fn(file_name)
+		duration = time.time() - start
+		best = duration if best is None else min(best, duration)
+
+	print('%-20s %8.3f s %10.1f kB' % (name, best, os.path.getsize(file_name) / 1024.0))
+	return best
+
+# ###########################################################################################################
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--channels', type=int, default=200)
+	parser.add_argument('--days', type=int, default=7)
+	parser.add_argument('--event-length', type=int, default=30, help='length of one event in minutes')
+	parser.add_argument('--rounds', type=int, default=3)
+	args = parser.parse_args()
+
+	epg = create_epg(args.channels, args.days, args.event_length * 60)
+	print('Channels: %d, days: %d, events: %d' % (args.channels, args.days, sum(len(e[1]) for e in epg)))
+
+	tmp_dir = tempfile.mkdtemp()
+	try:
+		legacy_file = os.path.join(tmp_dir, 'legacy.xml')
+		xmltv_file = os.path.join(tmp_dir, 'xmltv.xml')
+
+		legacy = measure('legacy', lambda f: write_legacy(f, epg), legacy_file, args.rounds)
+		xmltv = measure('XmlTvWriter', lambda f: write_xmltv(f, epg), xmltv_file, args.rounds)
+		measure('XmlTvWriter (gzip)', lambda f: write_xmltv(f, epg, True), xmltv_file + '.gz', args.rounds)
+
+		with open(legacy_file, 'rb') as f1, open(xmltv_file, 'rb') as f2:
+			print('Output identical: %s' % (f1.read() == f2.read()))
+
+		print('Speedup: %.2fx' % (legacy / xmltv))
+	finally:
+		shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+	main()
@@ -15,6 +15,7 @@ class O2TVBouquetGenerator(BouquetGenerator):
 class O2TVBouquetXmlEpgGenerator(BouquetXmlEpgGenerator):
 	def __init__(self, content_provider, http_endpoint, user_agent):
 		self.bouquet_settings_names = ('enable_userbouquet', 'enable_adult', 'enable_xmlepg', 'enable_picons', 'player_name', 'export_md_subchannels')
+		self.epg_fetch_workers = 4 # get_epg() only calls O2TV API, so EPG for more channels can be fetched in parallel
 		BouquetXmlEpgGenerator.__init__(self, content_provider, http_endpoint, login_settings_names=('username', 'password'), user_agent=user_agent)
 		self.prefix = NAME_PREFIX # this is needed for compatiblity with old archivo2tv addon
 		self.bouquet_generator = O2TVBouquetGenerator
@@ -3,7 +3,7 @@
 # based on waladir's KODI addon
 #
 
-import os, time, json
+import os, time, json, threading
 import traceback
 
 import base64
@@ -27,6 +27,7 @@ class O2TV(object):
 		self.session_data = {}
 		self.services = []
 		self.active_service = None
+		self.refresh_lock = threading.RLock() # EPG is fetched by more threads at once - only one can refresh ks
 
 		self.req_session = self.cp.get_requests_session()
 
@@ -105,7 +106,8 @@ class O2TV(object):
 				return False
 
 		if recover_ks:
-			self.refresh_configuration()
+			with self.refresh_lock:
+				self.refresh_configuration()
 
 		err_msg = None
 		headers = {
@@ -156,7 +158,8 @@ class O2TV(object):
 
 				# check for 'ks expired' error and recover if possible
 				if recover_ks and '/api_v3/' in url and is_auth_error(json_response):
-					self.refresh_configuration(True)
+					with self.refresh_lock:
+						self.refresh_configuration(True)
 
 					# fill new ks in request data
 					if 'ks' in data:
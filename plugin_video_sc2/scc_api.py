@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import os
 import time
 from datetime import datetime
 from tools_archivczsk.contentprovider.exception import AddonErrorException
 from tools_archivczsk.debug.http import dump_json_request
-from tools_archivczsk.cache import ExpiringLRUCache
+from tools_archivczsk.cache import PersistentExpiringLRUCache, SingleFlight
+from tools_archivczsk.metrics import metrics
 
 try:
 	from urllib import urlencode
@@ -37,7 +39,11 @@ class SCC_API(object):
 		self.device_id = self.cp.get_setting('deviceid')
 
 		self.req_session = self.cp.get_requests_session()
-		self.cache = ExpiringLRUCache(30, 1800)
+		# responses are cached also on disk, so they survive restart of enigma2
+		# expired responses are used for one more hour, while new version is loaded in background
+		self.cache = PersistentExpiringLRUCache(30, 1800, os.path.join(self.cp.data_dir, 'api_cache.bin'), max_disk_size=4 * 1024 * 1024, stale_timeout=3600)
+		self.single_flight = SingleFlight()
+		metrics.register_source('api_cache', self.cache, self.cp.name)
 
 	# ##################################################################################################################
 
@@ -69,23 +75,50 @@ class SCC_API(object):
 		if data:
 			rurl += '#' + urlencode(sorted(data.items(), key=lambda val: val[0]))
 
-		response = self.cache.get(rurl)
+		def refresh_cbk(key):
+			self.cp.log_debug("Request found in cache, but it's expired - refreshing in background")
+			self.cp.bgservice.run_task('sc2 api refresh', None, self._refresh_api_call, rurl, endpoint, headers, params, data)
 
-		if response:
+		result = self.cache.get(rurl, refresh_cbk=refresh_cbk)
+
+		if result != None:
 			self.cp.log_debug("Request found in cache")
-		else:
+			return result
+
+		# when the same request is already running (from UI or from background task), then wait for it's result
+		return self.single_flight.do(rurl, self._call_api, rurl, endpoint, headers, params, data)
+
+	# ##################################################################################################################
+
+	def _refresh_api_call(self, rurl, endpoint, headers, params, data):
+		try:
+			self.single_flight.do(rurl, self._call_api, rurl, endpoint, headers, params, data)
+		except:
+			self.cache.refresh_failed(rurl)
+			self.cp.log_exception()
+
+	# ##################################################################################################################
+
+	def _call_api(self, rurl, endpoint, headers, params, data):
+		result = self.cache.get(rurl)
+		if result != None:
+			return result
+
+		with metrics.timer('api_call', self.cp.name):
 			if data:
 				response = self.req_session.post(url=endpoint, headers=headers, params=params, json=data)
 			else:
 				response = self.req_session.get(url=endpoint, headers=headers, params=params)
 
-#			dump_json_request(response)
-			self.cache.put(rurl, response)
+#		dump_json_request(response)
 
 		if response.status_code != 200:
 			raise AddonErrorException(self.cp._("Unexpected return code from server") + ": %d" % response.status_code)
 
-		return response.json()
+		# only decoded response is cached - it is much smaller then whole response object and can be stored on disk
+		result = response.json()
+		self.cache.put(rurl, result)
+		return result
 
 	# ##################################################################################################################
 
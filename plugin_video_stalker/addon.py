@@ -10,6 +10,7 @@ from Plugins.Extensions.archivCZSK.engine.client import log
 from .stalker_provider import stalkerContentProvider
 from .http_handler import StalkerHTTPRequestHandler
 from .stalker import StalkerCache
+from .catalogue import refresh_catalogues
 
 # #################################################################################################
 
@@ -29,10 +30,19 @@ def init_all_portals(addon):
 
 # #################################################################################################
 
+def refresh_all_catalogues(addon):
+	if not addon.settings.get_setting('enable_catalogue'):
+		return
+
+	refresh_catalogues(StalkerCache.load_portals_cfg(), addon.get_info('data_path'), log.info)
+
+# #################################################################################################
+
 def main(addon):
 	request_handler = StalkerHTTPRequestHandler(addon)
 
 	archivCZSKHttpServer.registerRequestHandler(request_handler)
 	log.info("Stalker http endpoint: %s" % archivCZSKHttpServer.getAddonEndpoint(request_handler))
 	init_all_portals(addon)
+	addon.bgservice.run_in_loop('loop(refresh catalogue)', 6 * 3600, refresh_all_catalogues, addon)
 	return XBMCCompatInterface(stalker_run, addon)
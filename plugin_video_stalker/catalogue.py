@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+import os, re, json, gzip, threading, traceback
+from time import time
+from bisect import bisect_left
+
+from tools_archivczsk.string_utils import strip_accents
+from .stalker import StalkerCache, get_cache_key
+
+# #################################################################################################
+
+# positions of fields in item of catalogue
+I_ID, I_NAME, I_CMD, I_ADDED, I_IMG, I_DESC = range(6)
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+def normalise_words(s):
+	return _WORD_RE.findall(strip_accents(s).lower())
+
+# #################################################################################################
+
+class StalkerCatalogue(object):
+	'''
+	Local copy of VOD and series catalogue of one portal. It is stored in data dir (compressed JSON with items stored as
+	lists, not dicts) and refreshed in background. Refresh is incremental - categories are loaded ordered by date of
+	adding and loading stops at first already known item. Full refresh (that also removes deleted items) is done once
+	per full_refresh_interval seconds.
+
+	Search is accent and case insensitive and every word from keyword is matched as prefix of some word in the name.
+	'''
+	VERSION = 1
+	TYPES = ('vod', 'series')
+
+	_instances = {}
+	_instances_lock = threading.Lock()
+
+	def __init__(self, stalker, data_dir):
+		self.stalker = stalker
+		self.file_name = os.path.join(data_dir, get_cache_key(stalker.portal_cfg) + '.catalogue.gz')
+		self.full_refresh_interval = 7 * 86400
+		self.data = None
+		self.search_index = None # (data, index) - index is valid only for data it was built from
+		self.refresh_lock = threading.Lock()
+
+	# #################################################################################################
+
+	@classmethod
+	def get(cls, stalker, data_dir):
+		'''
+		Returns catalogue instance for portal handled by stalker
+		'''
+		key = get_cache_key(stalker.portal_cfg)
+
+		with cls._instances_lock:
+			catalogue = cls._instances.get(key)
+			if catalogue is None:
+				catalogue = cls(stalker, data_dir)
+				cls._instances[key] = catalogue
+
+			return catalogue
+
+	# #################################################################################################
+
+	def empty_data(self):
+		data = {
+			'version': self.VERSION,
+			'updated': 0,
+			'full_refresh': 0,
+		}
+
+		for t in self.TYPES:
+			data[t] = { 'categories': [], 'items': {} }
+
+		return data
+
+	# #################################################################################################
+
+	def load(self):
+		if self.data is None:
+			try:
+				with gzip.open(self.file_name, 'rb') as f:
+					data = json.loads(f.read().decode('utf-8'))
+
+				if data.get('version') != self.VERSION:
+					raise Exception("Unsupported catalogue version")
+			except:
+				data = self.empty_data()
+
+			self.data = data
+
+		return self.data
+
+	# #################################################################################################
+
+	def save(self, data):
+		tmp_name = self.file_name + '.tmp'
+		with gzip.open(tmp_name, 'wb') as f:
+			f.write(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+		os.rename(tmp_name, self.file_name)
+
+	# #################################################################################################
+
+	def is_available(self):
+		return self.load()['updated'] > 0
+
+	# #################################################################################################
+
+	def item_from_api(self, vod_item):
+		return [
+			str(vod_item['id']),
+			vod_item.get('name') or '',
+			vod_item.get('cmd') or '',
+			vod_item.get('added') or '',
+			vod_item.get('screenshot_uri') or '',
+			vod_item.get('description') or '',
+		]
+
+	# #################################################################################################
+
+	def load_category(self, type, cat_id, known=None):
+		'''
+		Loads all items of category ordered by date of adding. If known is set, then loading stops at first item with
+		id in known.
+		'''
+		items = []
+		page = 1
+		while True:
+			vod_data = self.stalker.get_vod_list(type, cat_id, page=page, sortby='added')
+			if not vod_data:
+				raise Exception("Failed to load page %d of %s category %s" % (page, type, cat_id))
+
+			for vod_item in vod_data.get('data', []):
+				item = self.item_from_api(vod_item)
+				if known is not None and item[I_ID] in known:
+					return items
+
+				items.append(item)
+
+			per_page = int(vod_data.get('max_page_items') or 0)
+			if per_page <= 0 or per_page * page >= int(vod_data.get('total_items') or 0):
+				return items
+
+			page += 1
+
+	# #################################################################################################
+
+	def refresh(self, force_full=False):
+		'''
+		Refreshes catalogue from portal - should be called in background thread
+		'''
+		with self.refresh_lock:
+			old_data = self.load()
+			cur_time = int(time())
+			full = force_full or (old_data['full_refresh'] + self.full_refresh_interval) < cur_time
+
+			data = self.empty_data()
+			data['updated'] = cur_time
+			data['full_refresh'] = cur_time if full else old_data['full_refresh']
+
+			new_count = 0
+			for t in self.TYPES:
+				for cat in (self.stalker.get_categories(t) or []):
+					cat_id = str(cat['id'])
+					if cat_id == '*':
+						# "all" category only duplicates items from the others
+						continue
+
+					data[t]['categories'].append([cat_id, cat['title']])
+					old_items = old_data[t]['items'].get(cat_id)
+
+					if full or old_items is None:
+						items = self.load_category(t, cat_id)
+						new_count += len(items)
+					else:
+						items = self.load_category(t, cat_id, set(i[I_ID] for i in old_items))
+						new_count += len(items)
+						items.extend(old_items)
+
+					data[t]['items'][cat_id] = items
+
+			self.save(data)
+			self.data = data
+			self.stalker.log_function("Catalogue of portal %s refreshed (%s): %d new items loaded" % (self.stalker.name, 'full' if full else 'incremental', new_count))
+
+	# #################################################################################################
+
+	def item_to_dict(self, type, cat_id, item):
+		return {
+			'type': type,
+			'category': cat_id,
+			'id': item[I_ID],
+			'name': item[I_NAME],
+			'cmd': item[I_CMD],
+			'added': item[I_ADDED],
+			'screenshot_uri': item[I_IMG],
+			'description': item[I_DESC],
+		}
+
+	# #################################################################################################
+
+	def get_categories(self, type):
+		return [ { 'id': c[0], 'title': c[1] } for c in self.load()[type]['categories'] ]
+
+	# #################################################################################################
+
+	def get_category_items(self, type, cat_id, sortby='added'):
+		'''
+		Returns list of items in category or None, when category is not in catalogue. Supported sortby values are
+		added and name.
+		'''
+		items = self.load()[type]['items'].get(str(cat_id))
+		if items is None:
+			return None
+
+		if sortby == 'name':
+			items = sorted(items, key=lambda i: strip_accents(i[I_NAME]).lower())
+
+		return [ self.item_to_dict(type, cat_id, i) for i in items ]
+
+	# #################################################################################################
+
+	def build_search_index(self, data):
+		'''
+		Creates sorted list of (word, type, category id, position of item in category)
+		'''
+		index = []
+		for t in self.TYPES:
+			for cat_id, items in data[t]['items'].items():
+				for pos, item in enumerate(items):
+					for word in set(normalise_words(item[I_NAME])):
+						index.append((word, t, cat_id, pos))
+
+		index.sort()
+		return index
+
+	# #################################################################################################
+
+	def search(self, keyword, type=None, limit=100):
+		'''
+		Returns list of items with name matching keyword
+		'''
+		words = normalise_words(keyword)
+		data = self.load()
+		if not words or not data['updated']:
+			return []
+
+		search_index = self.search_index
+		if search_index is not None and search_index[0] is data:
+			index = search_index[1]
+		else:
+			# data could be replaced by refresh in the meantime - index is always built from data used by this search
+			index = self.build_search_index(data)
+			self.search_index = (data, index)
+
+		result = None
+		for word in words:
+			found = {}
+			i = bisect_left(index, (word,))
+			while i < len(index) and index[i][0].startswith(word):
+				w, t, cat_id, pos = index[i]
+				if type is None or t == type:
+					item = data[t]['items'][cat_id][pos]
+					# the same item can be in more categories
+					found[(t, item[I_ID])] = (t, cat_id, item)
+				i += 1
+
+			if result is None:
+				result = found
+			else:
+				result = { k: v for k, v in result.items() if k in found }
+
+			if not result:
+				return []
+
+		ret = sorted(result.values(), key=lambda v: strip_accents(v[2][I_NAME]).lower())
+		return [ self.item_to_dict(t, cat_id, item) for t, cat_id, item in ret[:limit] ]
+
+# #################################################################################################
+
+def refresh_catalogues(portals, data_dir, log_function):
+	'''
+	Refreshes catalogues of all portals - runs in background service
+	'''
+	for name, portal_cfg in portals:
+		try:
+			s = StalkerCache.get(portal_cfg, data_dir, log_function)
+			if s.need_handshake() and not s.do_handshake():
+				log_function("Login to portal %s failed - catalogue will not be refreshed" % name)
+				continue
+
+			StalkerCatalogue.get(s, data_dir).refresh()
+		except:
+			log_function("Failed to refresh catalogue of portal %s:\n%s" % (name, traceback.format_exc()))
+
+# #################################################################################################
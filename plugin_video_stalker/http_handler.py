@@ -9,6 +9,8 @@ from .stalker import StalkerCache
 from .http_provider import stalkerHttpProvider
 from time import time
 import json
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThread
 
 # #################################################################################################
 
@@ -83,33 +85,108 @@ class StalkerHTTPRequestHandler( AddonHttpRequestHandler ):
 
 	# #################################################################################################
 
+	def send_m3u8_playlist(self, request, provider, path):
+		'''
+		Playlist is created in background thread and it is sent to client in chunks as the pages are loaded, so reactor
+		is not blocked and whole playlist doesn't need to be kept in memory
+		'''
+		state = { 'finished': False, 'started': False }
+		separator = '\n#EXTVLCOPT:http-user-agent=%s\n' % self.user_agent
+
+		def request_finished(reason):
+			state['finished'] = True
+
+		def write_data(data, file_name):
+			# runs in reactor
+			if state['finished']:
+				return
+
+			if not state['started']:
+				state['started'] = True
+				request.setResponseCode(200)
+				request.setHeader('content-type', "application/x-mpegURL; charset=UTF-8")
+				request.setHeader('Content-Disposition', 'attachment; filename="%s.m3u8"' % self.file_name_sanitize(file_name))
+				data = ('#EXTM3U\n#EXTVLCOPT:http-user-agent=%s\n' % self.user_agent) + data
+
+			if data:
+				request.write(data.encode('utf-8'))
+
+		def create_playlist():
+			# runs in thread
+			chunks, file_name = provider.handle_m3u8(path)
+			if chunks is None:
+				return False
+
+			first = True
+			for items in chunks:
+				if state['finished']:
+					# client disconnected
+					break
+
+				if not items:
+					continue
+
+				data = separator.join(items)
+				if not first:
+					data = separator + data
+
+				first = False
+				reactor.callFromThread(write_data, data, file_name)
+
+			reactor.callFromThread(write_data, '', file_name)
+			return True
+
+		def playlist_created(result):
+			if state['finished']:
+				return
+
+			if result == False:
+				request.setResponseCode(404)
+
+			request.finish()
+
+		def playlist_failed(failure):
+			log.error("Stalker HTTP request processing ERROR:\n%s" % failure.getTraceback())
+			if state['finished']:
+				return
+
+			if state['started']:
+				# part of playlist was already sent - break connection, so client doesn't take truncated playlist as complete
+				transport = request.transport
+				if hasattr(transport, 'abortConnection'):
+					transport.abortConnection()
+				else:
+					transport.loseConnection()
+				return
+
+			request.setResponseCode(200)
+			request.setHeader('content-type', "text/html; charset=UTF-8")
+			request.write(('<html><h2>Error by processing request!</h2><p>%s</p></html>' % str(failure.value)).encode('utf-8'))
+			request.finish()
+
+		request.notifyFinish().addBoth(request_finished)
+		deferToThread(create_playlist).addCallbacks(playlist_created, playlist_failed)
+		return self.NOT_DONE_YET
+
+	# #################################################################################################
+
 	def default_handler(self, request, path_full ):
 		if path_full == '' or path_full.startswith('list/'):
 			endpoint = self.get_endpoint(request)
 
 			data_dir=self.addon.get_info('data_path')
 
-			try:
-				if path_full.endswith('.m3u8'):
-					content_encoding = "application/x-mpegURL; charset=UTF-8"
-					ret, file_name = stalkerHttpProvider(endpoint, data_dir).handle_m3u8(path_full[:-5])
-
-					data = ('#EXTM3U\n#EXTVLCOPT:http-user-agent=%s\n' % self.user_agent)
+			if path_full.endswith('.m3u8'):
+				return self.send_m3u8_playlist(request, stalkerHttpProvider(endpoint, data_dir), path_full[:-5])
 
-					if isinstance(ret,type([])):
-						data += ('\n#EXTVLCOPT:http-user-agent=%s\n' % self.user_agent).join(ret)
-					else:
-						data += ret
+			try:
+				content_encoding = "text/html; charset=UTF-8"
+				ret = stalkerHttpProvider(endpoint, data_dir).handle_html(path_full)
 
-					request.setHeader('Content-Disposition', 'attachment; filename="%s.m3u8"' % self.file_name_sanitize(file_name))
+				if isinstance(ret,type([])):
+					data = '<html>' + ''.join(ret) + '</html>'
 				else:
-					content_encoding = "text/html; charset=UTF-8"
-					ret = stalkerHttpProvider(endpoint, data_dir).handle_html(path_full)
-
-					if isinstance(ret,type([])):
-						data = '<html>' + ''.join(ret) + '</html>'
-					else:
-						data = ret
+					data = ret
 
 			except Exception as e:
 				log.error("Stalker HTTP request processing ERROR:\n%s" % traceback.format_exc())
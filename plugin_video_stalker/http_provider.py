@@ -35,6 +35,8 @@ class stalkerHttpProvider():
 		self.data_dir = data_dir
 		self.endpoint = endpoint
 		self.max_items_per_page = 200
+		# max. number of pages loaded in parallel by export to m3u8 playlist
+		self.m3u8_page_workers = 4
 		
 	# #################################################################################################
 	
@@ -74,6 +76,10 @@ class stalkerHttpProvider():
 	# #################################################################################################
 
 	def handle_m3u8(self, url ):
+		'''
+		Returns tuple (chunks, file name) - chunks is iterable of lists of playlist items, so it can be sent to
+		client in parts as the data are loaded
+		'''
 		if url.startswith('list/'):
 			return self.list_m3u8( url[5:] )
 		else:
@@ -200,7 +206,7 @@ class stalkerHttpProvider():
 				item = self.playlist_item(channel['title'], _e( [ck, channel['cmd'], channel['use_tmp_link'], 'itv', channel['title'], -1] ), group_name, channel['img'])
 				result.append(item)
 	
-		return result, '%s_%s' % (s.name, file_name)
+		return [ result ], '%s_%s' % (s.name, file_name)
 
 	# #################################################################################################
 	
@@ -225,22 +231,12 @@ class stalkerHttpProvider():
 		ck, cat_id, page, sortby, title = _d(url)
 		
 		s = StalkerCache.get_by_key( ck )
-		
-		result = []
 
-		while True:
-			vod_data = s.get_vod_list('vod', cat_id, page=page, sortby=sortby)
-			
-			for vod_item in vod_data['data']:
-				item = self.playlist_item(vod_item['name'], _e( [ck, vod_item['cmd'], True, 'vod', vod_item['name'], -1] ))
-				result.append(item)
-		
-			if vod_data['max_page_items'] * page >= vod_data['total_items']:
-				break
-			
-			page += 1
-			
-		return result, '%s_VOD_%s' % (s.name, title)
+		def get_items():
+			for vod_data in s.get_vod_list_pages('vod', cat_id, page=page, sortby=sortby, workers=self.m3u8_page_workers):
+				yield [ self.playlist_item(vod_item['name'], _e( [ck, vod_item['cmd'], True, 'vod', vod_item['name'], -1] )) for vod_item in vod_data['data'] ]
+
+		return get_items(), '%s_VOD_%s' % (s.name, title)
 	
 	# #################################################################################################
 	
@@ -307,24 +303,19 @@ class stalkerHttpProvider():
 		ck, cat_id, vod_id, page, sortby, title = _d(url)
 		
 		s = StalkerCache.get_by_key( ck )
-		
-		result = []
 
-		while True:
-			vod_data = s.get_vod_list('series', cat_id, vod_id, page=page, sortby=sortby)
-			
-			for vod_item in vod_data['data']:
-				for e in vod_item['series']:
-					episode_name = vod_item['name'] + ' Episode ' + str(e)
-					item = self.playlist_item(episode_name, _e( [ck, vod_item['cmd'], True, 'vod', episode_name, e] ), vod_item['name'])
-					result.append(item)
+		def get_items():
+			for vod_data in s.get_vod_list_pages('series', cat_id, vod_id, page=page, sortby=sortby, workers=self.m3u8_page_workers):
+				result = []
+				for vod_item in vod_data['data']:
+					for e in vod_item['series']:
+						episode_name = vod_item['name'] + ' Episode ' + str(e)
+						item = self.playlist_item(episode_name, _e( [ck, vod_item['cmd'], True, 'vod', episode_name, e] ), vod_item['name'])
+						result.append(item)
 
-			if vod_data['max_page_items'] * page >= vod_data['total_items']:
-				break
-			
-			page += 1
+				yield result
 
-		return result, '%s_SERIES_%s' % (s.name, title)
+		return get_items(), '%s_SERIES_%s' % (s.name, title)
 	
 	# #################################################################################################
 
@@ -5,6 +5,8 @@ from datetime import datetime
 import threading
 import uuid
 import functools
+import struct
+from bisect import bisect_right
 from hashlib import sha1, md5
 from collections import OrderedDict
 
@@ -39,6 +41,164 @@ def get_cache_key( portal_cfg ):
 
 # #################################################################################################
 
+class StalkerEpg(object):
+	'''
+	Compact EPG storage - events of each channel are stored in columns (start times, end times, titles, descriptions)
+	sorted by start time, so event running at some time is found using binary search.
+
+	Data are saved in simple binary format:
+	header: magic, version, load time, number of channels
+	channel: channel id, number of events, start times, end times, titles and descriptions separated by \\0
+	'''
+	MAGIC = b'STEPG'
+	VERSION = 1
+
+	def __init__(self, load_time=0):
+		self.load_time = load_time
+		# channel id -> (starts, ends, titles, descs)
+		self.channels = {}
+
+	# #################################################################################################
+
+	def __len__(self):
+		return len(self.channels)
+
+	# #################################################################################################
+
+	def add_channel(self, ch_id, events):
+		'''
+		Adds events of channel. events is a list of tuples (start, end, title, desc) in any order.
+		'''
+		events = sorted(events, key=lambda e: e[0])
+		self.channels[str(ch_id)] = (
+			[int(e[0]) for e in events],
+			[int(e[1]) for e in events],
+			[e[2] or '' for e in events],
+			[e[3] or '' for e in events],
+		)
+
+	# #################################################################################################
+
+	def get_event(self, ch_id, i):
+		starts, ends, titles, descs = self.channels[str(ch_id)]
+		return {
+			'from': starts[i],
+			'to': ends[i],
+			'title': titles[i],
+			'desc': descs[i]
+		}
+
+	# #################################################################################################
+
+	def get_current_index(self, ch_id, cur_time):
+		'''
+		Returns index of event running at cur_time or index of next event (as negative number - 1) if there is nothing
+		running at this time. Returns None if channel has no EPG.
+		'''
+		data = self.channels.get(str(ch_id))
+		if not data or not data[0]:
+			return None
+
+		starts, ends = data[0], data[1]
+		i = bisect_right(starts, cur_time) - 1
+		if i >= 0 and cur_time < ends[i]:
+			return i
+
+		return -(i + 1) - 1
+
+	# #################################################################################################
+
+	def get_current(self, ch_id, cur_time):
+		i = self.get_current_index(ch_id, cur_time)
+		if i is None or i < 0:
+			return None
+
+		return self.get_event(ch_id, i)
+
+	# #################################################################################################
+
+	def get_now_next(self, ch_id, cur_time):
+		'''
+		Returns tuple (current event, next event) - any of them can be None
+		'''
+		i = self.get_current_index(ch_id, cur_time)
+		if i is None:
+			return None, None
+
+		if i >= 0:
+			now = self.get_event(ch_id, i)
+			i += 1
+		else:
+			now = None
+			i = -i - 1
+
+		if i < len(self.channels[str(ch_id)][0]):
+			return now, self.get_event(ch_id, i)
+
+		return now, None
+
+	# #################################################################################################
+
+	def save(self, file_name):
+		out = [ self.MAGIC, struct.pack('<BqI', self.VERSION, int(self.load_time), len(self.channels)) ]
+
+		for ch_id, (starts, ends, titles, descs) in self.channels.items():
+			ch_id = ch_id.encode('utf-8')
+			titles = '\0'.join(titles).encode('utf-8')
+			descs = '\0'.join(descs).encode('utf-8')
+			cnt = len(starts)
+			out.append(struct.pack('<HI', len(ch_id), cnt))
+			out.append(ch_id)
+			out.append(struct.pack('<%dq' % cnt, *starts))
+			out.append(struct.pack('<%dq' % cnt, *ends))
+			out.append(struct.pack('<II', len(titles), len(descs)))
+			out.append(titles)
+			out.append(descs)
+
+		tmp_name = file_name + '.tmp'
+		with open(tmp_name, 'wb') as f:
+			f.write(b''.join(out))
+		os.rename(tmp_name, file_name)
+
+	# #################################################################################################
+
+	@classmethod
+	def load(cls, file_name):
+		with open(file_name, 'rb') as f:
+			data = f.read()
+
+		if data[:len(cls.MAGIC)] != cls.MAGIC:
+			raise Exception("Unsupported EPG cache format")
+
+		pos = len(cls.MAGIC)
+		version, load_time, ch_count = struct.unpack_from('<BqI', data, pos)
+		if version != cls.VERSION:
+			raise Exception("Unsupported EPG cache version %d" % version)
+
+		pos += struct.calcsize('<BqI')
+		epg = cls(load_time)
+
+		for _ in range(ch_count):
+			id_len, cnt = struct.unpack_from('<HI', data, pos)
+			pos += 6
+			ch_id = data[pos:pos+id_len].decode('utf-8')
+			pos += id_len
+			starts = list(struct.unpack_from('<%dq' % cnt, data, pos))
+			pos += 8 * cnt
+			ends = list(struct.unpack_from('<%dq' % cnt, data, pos))
+			pos += 8 * cnt
+			titles_len, descs_len = struct.unpack_from('<II', data, pos)
+			pos += 8
+			titles = data[pos:pos+titles_len].decode('utf-8').split('\0') if cnt else []
+			pos += titles_len
+			descs = data[pos:pos+descs_len].decode('utf-8').split('\0') if cnt else []
+			pos += descs_len
+			epg.channels[ch_id] = (starts, ends, titles, descs)
+
+		return epg
+
+# #################################################################################################
+
 class StalkerCache:
 	portal_cache = {}
 
@@ -117,6 +277,7 @@ class Stalker:
 		self.time_zone = "Europe/Berlin"
 		self.user_agent = 'Mozilla/5.0 (QtEmbedded; U; Linux; C) AppleWebKit/533.3 (KHTML, like Gecko) MAG200 stbapp ver: 2 rev: 250 Safari/533.3'
 		self.req_session = requests.Session()
+		self.handshake_lock = threading.RLock()
 		self.req_session.request = functools.partial(self.req_session.request, timeout=10) # set timeout for all session calls
 		self.load_login_data()
 
@@ -177,12 +338,8 @@ class Stalker:
 		if self.data_dir:
 			try:
 				ck = get_cache_key( self.portal_cfg )
-				name = self.data_dir + '/' + ck + '.epg'
-
-				with open(name, "r") as f:
-					self.epg = json.load(f)
-
-				self.epg_load_time = os.path.getmtime(name)
+				self.epg = StalkerEpg.load(self.data_dir + '/' + ck + '.epgbin')
+				self.epg_load_time = self.epg.load_time
 			except:
 				pass
 
@@ -191,15 +348,17 @@ class Stalker:
 	def save_epg_data(self):
 		if self.data_dir:
 			ck = get_cache_key( self.portal_cfg )
-			name = self.data_dir + '/' + ck + '.epg'
 
 			try:
-				os.remove( name )
+				# remove EPG cache in old JSON format
+				os.remove( self.data_dir + '/' + ck + '.epg' )
 			except:
 				pass
 
-			with open(name, "w") as f:
-				json.dump(self.epg, f)
+			try:
+				self.epg.save(self.data_dir + '/' + ck + '.epgbin')
+			except:
+				self.log_function("Failed to save EPG cache:\n" + traceback.format_exc())
 
 	# #################################################################################################
 
@@ -250,62 +409,71 @@ class Stalker:
 	# #################################################################################################
 
 	def need_handshake(self):
-		if self.access_token:
-			if self.access_token_checked:
-				return False
+		if self.access_token and self.access_token_checked:
+			return False
 
-			#check if access token is still valid
-			try:
-				params = {
-					'type': 'account_info',
-					'action': 'get_main_info',
-					'mac': self.mac,
-#					'JsHttpRequest': '1-xml'
-				}
-
-				ret = self.call_stalker_api(params)
-				self.log_function("Account info response: %s" % str(ret) )
-
-				if ret != None:
-					self.access_token_checked = True
+		# API is used by more threads at once - only one of them can check access token or do handshake
+		with self.handshake_lock:
+			if self.access_token:
+				if self.access_token_checked:
 					return False
 
-			except Exception as e:
-				pass
-
-		return True
-
-	# #################################################################################################
-
-	def do_handshake(self):
+				#check if access token is still valid
+				try:
+					params = {
+						'type': 'account_info',
+						'action': 'get_main_info',
+						'mac': self.mac,
+#						'JsHttpRequest': '1-xml'
+					}
 
-		# do handshake
-		params = {
-			'type': 'stb',
-			'action': 'handshake',
-			'token': '',
-#			'JsHttpRequest': '1-xml'
-		}
+					ret = self.call_stalker_api(params)
+					self.log_function("Account info response: %s" % str(ret) )
 
-		ret = self.call_stalker_api( params, False)
+					if ret != None:
+						self.access_token_checked = True
+						return False
 
-		if ret:
-			self.access_token = ret.get('token')
-			if self.access_token:
-				# second login step
-				self.get_profile(True)
+				except Exception as e:
+					pass
 
-				if self.portal_cfg.get('username') and self.portal_cfg.get('password'):
-					ret = self.do_auth()
+			return True
 
-				self.save_login_data()
+	# #################################################################################################
 
-				if self.need_handshake():
-					return False
-				else:
-					return True
+	def do_handshake(self):
+		with self.handshake_lock:
+			if self.access_token and self.access_token_checked:
+				# handshake was already done by other thread
+				return True
+
+			# do handshake
+			params = {
+				'type': 'stb',
+				'action': 'handshake',
+				'token': '',
+#				'JsHttpRequest': '1-xml'
+			}
+
+			ret = self.call_stalker_api( params, False)
+
+			if ret:
+				self.access_token = ret.get('token')
+				if self.access_token:
+					# second login step
+					self.get_profile(True)
+
+					if self.portal_cfg.get('username') and self.portal_cfg.get('password'):
+						ret = self.do_auth()
+
+					self.save_login_data()
+
+					if self.need_handshake():
+						return False
+					else:
+						return True
 
-		return False
+			return False
 
 	# #################################################################################################
 
@@ -521,26 +689,19 @@ class Stalker:
 		if self.epg != None and int(time()) < self.epg_load_time + (epg_cache_hours*3600):
 			return
 
-		self.epg = {}
+		load_time = int(time())
+		epg = StalkerEpg(load_time)
 		utc_offset = 0
 #			utc_offset = self.get_utc_offset()
 
 		epg_info = self.get_epg_info(epg_cache_hours)
-		if len(epg_info) > 0:
+		if epg_info:
 			for epg_id, epg_list in epg_info.items():
-				el = []
-
-				for epg_data in epg_list:
-					el.append({
-						'from': epg_data['start_timestamp'] - utc_offset,
-						'to': epg_data['stop_timestamp'] - utc_offset,
-						'title': epg_data['name'],
-						'desc': epg_data['descr']
-					})
-
-#					self.log_function("Saving %d epg entires for channel %s" % (len(el), epg_id))
-				self.epg[epg_id] = el
-		self.epg_load_time = int(time())
+				epg.add_channel(epg_id, ((int(e['start_timestamp']) - utc_offset, int(e['stop_timestamp']) - utc_offset, e['name'], e['descr']) for e in epg_list))
+
+		# EPG is replaced only when it was successfully loaded - on failure it will be requested again next time
+		self.epg = epg
+		self.epg_load_time = load_time
 		self.save_epg_data()
 
 	# #################################################################################################
@@ -558,17 +719,22 @@ class Stalker:
 		if not self.epg:
 			return None
 
-		epg_data = self.epg.get(ch_id, [])
-		self.log_function("%d epg data found for channel %s" % (len(epg_data), ch_id))
+		return self.epg.get_current(ch_id, int(time()))
 
-		cur_time = int(time())
+	# #################################################################################################
+
+	def get_channels_epg_now_next(self, ch_ids):
+		'''
+		Returns map channel id -> (current event, next event) for all channels in ch_ids
+		'''
+		if self.need_handshake():
+			return {}
 
-		for epg_item in epg_data:
-			self.log_function("%d - %d - %s" % (epg_item['from'], epg_item['to'], epg_item['title']))
-			if cur_time > epg_item['from'] and cur_time < epg_item['to']:
-				return epg_item
+		if not self.epg:
+			return {}
 
-		return None
+		cur_time = int(time())
+		return { ch_id: self.epg.get_now_next(ch_id, cur_time) for ch_id in ch_ids }
 
 	# #################################################################################################
 
@@ -603,3 +769,53 @@ class Stalker:
 		return self.call_stalker_api( params )
 
 	# #################################################################################################
+
+	def get_vod_list_pages(self, type='vod', cat_id=0, movie_id=0, page=1, sortby='added', workers=4):
+		'''
+		Generator, that yields data of all pages starting with page in the right order. First page is loaded to get
+		total number of items and the rest is loaded in parallel - max. workers pages at once.
+		'''
+		vod_data = self.get_vod_list(type, cat_id, movie_id, page=page, sortby=sortby)
+		if not vod_data:
+			raise Exception("Failed to load page %d of %s list" % (page, type))
+
+		yield vod_data
+
+		per_page = int(vod_data.get('max_page_items') or 0)
+		total_items = int(vod_data.get('total_items') or 0)
+		if per_page <= 0:
+			return
+
+		pages = list(range(page + 1, (total_items + per_page - 1) // per_page + 1))
+
+		for i in range(0, len(pages), workers):
+			batch = pages[i:i+workers]
+			results = {}
+			errors = {}
+
+			def load_page(p):
+				try:
+					results[p] = self.get_vod_list(type, cat_id, movie_id, page=p, sortby=sortby)
+				except Exception as e:
+					self.log_function("Failed to load page %d:\n%s" % (p, traceback.format_exc()))
+					errors[p] = e
+
+			threads = []
+			for p in batch:
+				t = threading.Thread(target=load_page, args=(p,))
+				t.daemon = True
+				t.start()
+				threads.append(t)
+
+			for t in threads:
+				t.join()
+
+			for p in batch:
+				vod_data = results.get(p)
+				if not vod_data:
+					# don't silently return incomplete list
+					raise Exception("Failed to load page %d of %s list: %s" % (p, type, str(errors.get(p, 'no data received'))))
+
+				yield vod_data
+
+	# #################################################################################################
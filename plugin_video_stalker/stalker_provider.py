@@ -19,6 +19,7 @@ from datetime import datetime, timedelta
 import time
 import json
 from .stalker import StalkerCache, get_cache_key
+from .catalogue import StalkerCatalogue
 from .bouquet import StalkerBouquetGenerator
 from Plugins.Extensions.archivCZSK.engine.httpserver import archivCZSKHttpServer
 
@@ -44,7 +45,7 @@ class stalkerContentProvider(ContentProvider):
 	# #################################################################################################
 
 	def capabilities(self):
-		return ['login', 'categories', 'resolve', '!download']
+		return ['login', 'search', 'categories', 'resolve', '!download']
 
 	# #################################################################################################
 
@@ -115,6 +116,8 @@ class stalkerContentProvider(ContentProvider):
 				return self.show_portal_series(url[15:])
 			elif url.startswith('#portal_episodes#'):
 				return self.show_portal_episodes(url[17:])
+			elif url.startswith('#catalogue_cat#'):
+				return self.show_catalogue_category(url[15:])
 			elif url.startswith('#create_userbouquet#'):
 				return self.create_userbouquet(url[20:])
 		except Exception as e:
@@ -241,9 +244,12 @@ class stalkerContentProvider(ContentProvider):
 		if self.addon.getSetting('enable_epg') == 'true':
 			s.fill_epg_cache()
 
+		channels = s.get_channels_grouped()[group_name]
+		epg_now_next = s.get_channels_epg_now_next([channel['id'] for channel in channels])
+
 		result = []
-		for channel in s.get_channels_grouped()[group_name]:
-			epg = s.get_channel_current_epg(channel['id'])
+		for channel in channels:
+			epg = epg_now_next.get(channel['id'], (None, None))[0]
 
 			item = self.video_item('#portal_link#' + json.dumps( [ck, channel['cmd'], channel['use_tmp_link']] ) )
 			item['title'] = channel['title']
@@ -272,11 +278,142 @@ class stalkerContentProvider(ContentProvider):
 
 	# #################################################################################################
 
-	def show_portal_vod_category(self, url ):
+	def create_vod_item(self, ck, cat_id, vod_item, sortby):
+		item = self.video_item('#portal_vod_link#' + json.dumps( [ck, vod_item['cmd'], -1] ) )
+		item['title'] = vod_item['name']
+		item['plot'] = vod_item['description']
+		item['img'] = vod_item['screenshot_uri']
+
+		if not item['img'].startswith('http'):
+			item['img'] = ''
+
+		if sortby == 'added':
+			item['menu'] = {
+				'Zoradiť podľa názvu': { 'list': '#portal_vod_cat#' + json.dumps( [ck, cat_id, 1, 'name'] ) },
+				'Zoradiť podľa hodnotenia': { 'list': '#portal_vod_cat#' + json.dumps( [ck, cat_id, 1, 'rating'] ) }
+			}
+		elif sortby == 'name':
+			item['menu'] = {
+				'Zoradiť podľa dátumu pridania' : { 'list': '#portal_vod_cat#' + json.dumps( [ck, cat_id, 1, 'added'] ) },
+				'Zoradiť podľa hodnotenia': { 'list': '#portal_vod_cat#' + json.dumps( [ck, cat_id, 1, 'rating'] ) }
+			}
+		elif sortby == 'rating':
+			item['menu'] = {
+				'Zoradiť podľa dátumu pridania' : { 'list': '#portal_vod_cat#' + json.dumps( [ck, cat_id, 1, 'added'] ) },
+				'Zoradiť podľa názvu': { 'list': '#portal_vod_cat#' + json.dumps( [ck, cat_id, 1, 'name'] ) },
+			}
+
+		return item
+
+	# #################################################################################################
+
+	def create_series_item(self, ck, cat_id, vod_item, sortby):
+		item = self.dir_item(vod_item['name'], '#portal_series#' + json.dumps( [ck, cat_id, vod_item['id'], 1, 'added'] ) )
+		item['plot'] = vod_item['description']
+		item['img'] = vod_item['screenshot_uri']
+
+		if not item['img'].startswith('http'):
+			item['img'] = ''
+
+		if sortby == 'added':
+			item['menu'] = {
+				'Zoradiť podľa názvu': { 'list': '#portal_series_cat#' + json.dumps( [ck, cat_id, 1, 'name'] ) },
+				'Zoradiť podľa hodnotenia': { 'list': '#portal_series_cat#' + json.dumps( [ck, cat_id, 1, 'rating'] ) }
+			}
+		elif sortby == 'name':
+			item['menu'] = {
+				'Zoradiť podľa dátumu pridania' : { 'list': '#portal_series_cat#' + json.dumps( [ck, cat_id, 1, 'added'] ) },
+				'Zoradiť podľa hodnotenia': { 'list': '#portal_series_cat#' + json.dumps( [ck, cat_id, 1, 'rating'] ) }
+			}
+		elif sortby == 'rating':
+			item['menu'] = {
+				'Zoradiť podľa dátumu pridania' : { 'list': '#portal_series_cat#' + json.dumps( [ck, cat_id, 1, 'added'] ) },
+				'Zoradiť podľa názvu': { 'list': '#portal_series_cat#' + json.dumps( [ck, cat_id, 1, 'name'] ) },
+			}
+
+		return item
+
+	# #################################################################################################
+
+	def get_catalogue(self, s):
+		if self.addon.getSetting('enable_catalogue') != 'true':
+			return None
+
+		catalogue = StalkerCatalogue.get(s, self.data_dir)
+		return catalogue if catalogue.is_available() else None
+
+	# #################################################################################################
+
+	def show_catalogue_category(self, url):
+		'''
+		Shows items of VOD or series category directly from local catalogue. Page is page of catalogue, not of portal.
+		'''
+		ck, type, cat_id, page, sortby = json.loads(url)
+
+		s = StalkerCache.get_by_key( ck )
+		catalogue = self.get_catalogue(s)
+		items = catalogue.get_category_items(type, cat_id, sortby) if catalogue else None
+
+		if items is None:
+			# catalogue not available anymore - fallback to portal
+			if type == 'vod':
+				return self.show_portal_vod_category(json.dumps( [ck, cat_id, 1, sortby] ), False)
+			else:
+				return self.show_portal_series_category(json.dumps( [ck, cat_id, 1, sortby] ), False)
+
+		create_item = self.create_vod_item if type == 'vod' else self.create_series_item
+		start = (page - 1) * self.max_items_per_page
+		result = [ create_item(ck, cat_id, vod_item, sortby) for vod_item in items[start:start + self.max_items_per_page] ]
+
+		if len(items) > start + self.max_items_per_page:
+			item = self.dir_item('Ďalšie', '#catalogue_cat#' + json.dumps( [ck, type, cat_id, page + 1, sortby] ) )
+			item['type'] = 'next'
+			result.append(item)
+
+		return result
+
+	# #################################################################################################
+
+	def search(self, keyword):
+		result = []
+		catalogue_found = False
+
+		for name, portal_cfg in StalkerCache.load_portals_cfg():
+			s = StalkerCache.get( portal_cfg, self.data_dir, client.log.info )
+			catalogue = self.get_catalogue(s)
+			if not catalogue:
+				continue
+
+			catalogue_found = True
+			ck = get_cache_key( portal_cfg )
+
+			for vod_item in catalogue.search(keyword):
+				if vod_item['type'] == 'vod':
+					item = self.create_vod_item(ck, vod_item['category'], vod_item, 'added')
+				else:
+					item = self.create_series_item(ck, vod_item['category'], vod_item, 'added')
+
+				del item['menu']
+				item['title'] = '[%s] %s' % (name, item['title'])
+				result.append(item)
+
+		if not catalogue_found:
+			item = self.video_item('#')
+			item['title'] = '[COLOR red]Vyhľadávanie vyžaduje lokálny katalóg - povoľte ho v nastaveniach[/COLOR]'
+			result.append(item)
+
+		return result
+
+	# #################################################################################################
+
+	def show_portal_vod_category(self, url, use_catalogue=True ):
 		ck, cat_id, page, sortby = json.loads(url)
 
 		s = StalkerCache.get_by_key( ck )
 
+		if use_catalogue and page == 1 and sortby in ('added', 'name') and self.get_catalogue(s):
+			return self.show_catalogue_category(json.dumps( [ck, 'vod', cat_id, 1, sortby] ))
+
 		result = []
 
 		i = 0
@@ -284,31 +421,7 @@ class stalkerContentProvider(ContentProvider):
 			vod_data = s.get_vod_list('vod', cat_id, page=page, sortby=sortby)
 
 			for vod_item in vod_data['data']:
-				item = self.video_item('#portal_vod_link#' + json.dumps( [ck, vod_item['cmd'], -1] ) )
-				item['title'] = vod_item['name']
-				item['plot'] = vod_item['description']
-				item['img'] = vod_item['screenshot_uri']
-
-				if not item['img'].startswith('http'):
-					item['img'] = ''
-
-				if sortby == 'added':
-					item['menu'] = {
-						'Zoradiť podľa názvu': { 'list': '#portal_vod_cat#' + json.dumps( [ck, cat_id, 1, 'name'] ) },
-						'Zoradiť podľa hodnotenia': { 'list': '#portal_vod_cat#' + json.dumps( [ck, cat_id, 1, 'rating'] ) }
-					}
-				elif sortby == 'name':
-					item['menu'] = {
-						'Zoradiť podľa dátumu pridania' : { 'list': '#portal_vod_cat#' + json.dumps( [ck, cat_id, 1, 'added'] ) },
-						'Zoradiť podľa hodnotenia': { 'list': '#portal_vod_cat#' + json.dumps( [ck, cat_id, 1, 'rating'] ) }
-					}
-				elif sortby == 'rating':
-					item['menu'] = {
-						'Zoradiť podľa dátumu pridania' : { 'list': '#portal_vod_cat#' + json.dumps( [ck, cat_id, 1, 'added'] ) },
-						'Zoradiť podľa názvu': { 'list': '#portal_vod_cat#' + json.dumps( [ck, cat_id, 1, 'name'] ) },
-					}
-
-				result.append(item)
+				result.append(self.create_vod_item(ck, cat_id, vod_item, sortby))
 				i += 1
 
 			if i > self.max_items_per_page or vod_data['max_page_items'] * page >= vod_data['total_items']:
@@ -325,11 +438,14 @@ class stalkerContentProvider(ContentProvider):
 
 	# #################################################################################################
 
-	def show_portal_series_category(self, url ):
+	def show_portal_series_category(self, url, use_catalogue=True ):
 		ck, cat_id, page, sortby = json.loads(url)
 
 		s = StalkerCache.get_by_key( ck )
 
+		if use_catalogue and page == 1 and sortby in ('added', 'name') and self.get_catalogue(s):
+			return self.show_catalogue_category(json.dumps( [ck, 'series', cat_id, 1, sortby] ))
+
 		result = []
 
 		i = 0
@@ -337,30 +453,7 @@ class stalkerContentProvider(ContentProvider):
 			vod_data = s.get_vod_list('series', cat_id, page=page, sortby=sortby)
 
 			for vod_item in vod_data['data']:
-				item = self.dir_item(vod_item['name'], '#portal_series#' + json.dumps( [ck, cat_id, vod_item['id'], 1, 'added'] ) )
-				item['plot'] = vod_item['description']
-				item['img'] = vod_item['screenshot_uri']
-
-				if not item['img'].startswith('http'):
-					item['img'] = ''
-
-				if sortby == 'added':
-					item['menu'] = {
-						'Zoradiť podľa názvu': { 'list': '#portal_series_cat#' + json.dumps( [ck, cat_id, 1, 'name'] ) },
-						'Zoradiť podľa hodnotenia': { 'list': '#portal_series_cat#' + json.dumps( [ck, cat_id, 1, 'rating'] ) }
-					}
-				elif sortby == 'name':
-					item['menu'] = {
-						'Zoradiť podľa dátumu pridania' : { 'list': '#portal_series_cat#' + json.dumps( [ck, cat_id, 1, 'added'] ) },
-						'Zoradiť podľa hodnotenia': { 'list': '#portal_series_cat#' + json.dumps( [ck, cat_id, 1, 'rating'] ) }
-					}
-				elif sortby == 'rating':
-					item['menu'] = {
-						'Zoradiť podľa dátumu pridania' : { 'list': '#portal_series_cat#' + json.dumps( [ck, cat_id, 1, 'added'] ) },
-						'Zoradiť podľa názvu': { 'list': '#portal_series_cat#' + json.dumps( [ck, cat_id, 1, 'name'] ) },
-					}
-
-				result.append(item)
+				result.append(self.create_series_item(ck, cat_id, vod_item, sortby))
 
 			if i > self.max_items_per_page or vod_data['max_page_items'] * page >= vod_data['total_items']:
 				break
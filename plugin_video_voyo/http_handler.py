@@ -12,5 +12,17 @@ class VoyoHTTPRequestHandler(HlsHTTPRequestHandler, DashHTTPRequestHandler):
 		self.hls_proxy_segments = False
 		self.dash_proxy_segments = True
 		self.dash_internal_decrypt = True
+		self.cp.add_setting_change_notifier(['segment_prefetch'], self.segment_prefetch_changed)
+		self.segment_prefetch_changed('segment_prefetch', self.cp.get_setting('segment_prefetch'))
+
+	# #################################################################################################
+
+	def segment_prefetch_changed(self, name, value):
+		try:
+			segments = int(value or 0)
+		except:
+			segments = 0
+
+		self.enable_segment_prefetch(segments)
 
 	# #################################################################################################
@@ -280,7 +280,7 @@ class YoutubeContentProvider(CommonContentProvider):
 			settings = keyword.get('settings')
 
 			try:
-				url = yt_resolve(video_id, settings)
+				url = yt_resolve(video_id, settings, self.data_dir)
 			except Exception as e:
 				self.log_exception()
 			else:
@@ -305,7 +305,7 @@ class YoutubeContentProvider(CommonContentProvider):
 
 	def resolve_video(self, video_title, video_id):
 		try:
-			url = yt_resolve(video_id, self.settings)
+			url = yt_resolve(video_id, self.settings, self.data_dir)
 		except Exception as e:
 			self.log_exception()
 			raise AddonErrorException(self._("Failed to get playable video stream address") + ':\n%s' % str(e))
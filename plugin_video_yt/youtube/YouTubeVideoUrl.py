@@ -17,6 +17,8 @@ from .compat import compat_urlopen
 from .compat import compat_URLError
 from .compat import SUBURI
 from .jsinterp import JSInterpreter
+from .jscompiler import JSCompiler
+from .player_cache import PlayerCache
 
 import traceback
 #####
@@ -67,11 +69,13 @@ create_priority_formats()
 
 
 class YouTubeVideoUrl():
-	def __init__(self):
+	# compiler and functions built from player code are shared by all instances - they are valid until player changes
+	_compiler_cache = {}
+	_func_cache = {}
+
+	def __init__(self, cache_dir=None):
 		self.use_dash_mp4 = ()
-		self._code_cache = {}
-		self._player_cache = {}
-		self.nsig_cache = (None, None)
+		self.player_cache = PlayerCache.get_instance(cache_dir)
 
 	@staticmethod
 	def try_get(src, get):
@@ -163,18 +167,27 @@ class YouTubeVideoUrl():
 				return real_nfunc.group(1)[1:-1]
 
 	def _extract_player_info(self):
+		player_id = self.player_cache.get_player_id()
+		if player_id:
+			return player_id
+
 		res = self._download_webpage('https://www.youtube.com/iframe_api')
 		if res:
 			player_id = search(r'player\\?/([0-9a-fA-F]{8})\\?/', res)
 			if player_id:
+				self.player_cache.set_player_id(player_id.group(1))
 				return player_id.group(1)
 		print('[YouTubeVideoUrl] Cannot get player info')
 
 	def _load_player(self, player_id):
-		if player_id and player_id not in self._player_cache:
-			self._player_cache[player_id] = self._download_webpage(
+		if player_id and self.player_cache.get_player_code(player_id) is None:
+			self.player_cache.set_player_code(player_id, self._download_webpage(
 				'https://www.youtube.com/s/player/%s/player_ias.vflset/en_US/base.js' % player_id
-			)
+			))
+
+	def _get_player_code(self, player_id):
+		self._load_player(player_id)
+		return self.player_cache.get_player_code(player_id)
 
 	@staticmethod
 	def _fixup_n_function_code(argnames, code):
@@ -183,37 +196,58 @@ class YouTubeVideoUrl():
 			';', code)
 
 	def _extract_function(self, player_id, s_id):
-		if player_id not in self._player_cache:
-			self._load_player(player_id)
-		jsi = JSInterpreter(self._player_cache[player_id])
-		if s_id not in self._code_cache:
+		func = self._func_cache.get(s_id)
+		if func is not None:
+			return func
+
+		compiler = self._compiler_cache.get(player_id)
+		if compiler is None:
+			# player changed - functions built from old one are not needed anymore
+			self._compiler_cache.clear()
+			self._func_cache.clear()
+			compiler = JSCompiler(JSInterpreter(self._get_player_code(player_id)))
+			self._compiler_cache[player_id] = compiler
+		jsi = compiler.jsi
+
+		code = self.player_cache.get_function_code(player_id, s_id)
+		if code is None:
 			if s_id.startswith('nsig_'):
-				funcname = self._extract_n_function_name(self._player_cache[player_id])
+				funcname = self._extract_n_function_name(jsi.code)
 			else:
-				funcname = self._parse_sig_js(self._player_cache[player_id])
-			self._code_cache[s_id] = self._fixup_n_function_code(*jsi.extract_function_code(funcname))
-		return lambda s: jsi.extract_function_from_code(*self._code_cache[s_id])([s])
+				funcname = self._parse_sig_js(jsi.code)
+			code = self._fixup_n_function_code(*jsi.extract_function_code(funcname))
+			self.player_cache.set_function_code(player_id, s_id, *code)
+
+		f = compiler.build_function(*code)
+		func = lambda s: f([s])
+		self._func_cache[s_id] = func
+		return func
+
+	def _invalidate_function(self, player_id, s_id):
+		self._func_cache.pop(s_id, None)
+		self.player_cache.invalidate_function_code(player_id, s_id)
 
 	def _unthrottle_url(self, url, player_id):
 		n_param = search(r'&n=(.+?)&', url).group(1)
 		n_id = 'nsig_%s_%s' % (player_id, '.'.join(str(len(p)) for p in n_param.split('.')))
 		print('[YouTubeVideoUrl] Decrypt nsig', n_id)
-		if self.nsig_cache[0] != n_param:
-			self.nsig_cache = (None, None)
+		ret = self.player_cache.get_result(n_id, n_param)
+		if ret is None:
 			try:
 				ret = self._extract_function(player_id, n_id)(n_param)
 			except Exception as ex:
 				print('[YouTubeVideoUrl] Unable to decode nsig', ex)
+				ret = None
 			else:
 				if ret.startswith('enhanced_except_') or ret.endswith(n_param):
 					print('[YouTubeVideoUrl] Unhandled exception in decode', ret)
+					ret = None
 				else:
-					self.nsig_cache = (n_param, ret)
-		if self.nsig_cache[1]:
-			print('[YouTubeVideoUrl] Decrypted nsig %s => %s' % self.nsig_cache)
-			return url.replace(self.nsig_cache[0], self.nsig_cache[1])
-		if n_id in self._code_cache:
-			del self._code_cache[n_id]
+					self.player_cache.set_result(n_id, n_param, ret)
+		if ret:
+			print('[YouTubeVideoUrl] Decrypted nsig %s => %s' % (n_param, ret))
+			return url.replace(n_param, ret)
+		self._invalidate_function(player_id, n_id)
 		return url
 
 	def _decrypt_signature_url(self, sc, player_id):
@@ -221,14 +255,16 @@ class YouTubeVideoUrl():
 		s = sc.get('s', [''])[0]
 		s_id = 'sig_%s_%s' % (player_id, '.'.join(str(len(p)) for p in s.split('.')))
 		print('[YouTubeVideoUrl] Decrypt signature', s_id)
-		try:
-			sig = self._extract_function(player_id, s_id)(s)
-		except Exception as ex:
-			print('[YouTubeVideoUrl] Signature extraction failed', ex)
-			if s_id in self._code_cache:
-				del self._code_cache[s_id]
-		else:
-			return '%s&%s=%s' % (sc['url'][0], sc['sp'][0] if 'sp' in sc else 'signature', sig)
+		sig = self.player_cache.get_result(s_id, s)
+		if sig is None:
+			try:
+				sig = self._extract_function(player_id, s_id)(s)
+			except Exception as ex:
+				print('[YouTubeVideoUrl] Signature extraction failed', ex)
+				self._invalidate_function(player_id, s_id)
+				return None
+			self.player_cache.set_result(s_id, s, sig)
+		return '%s&%s=%s' % (sc['url'][0], sc['sp'][0] if 'sp' in sc else 'signature', sig)
 
 	def _parse_sig_js(self, jscode):
 
@@ -370,12 +406,13 @@ class YouTubeVideoUrl():
 		sts = None
 		player_id = self._extract_player_info()
 		if player_id:
-			if player_id not in self._player_cache:
-				self._load_player(player_id)
-			sts = search(
-				r'(?:signatureTimestamp|sts)\s*:\s*(?P<sts>\d{5})',
-				self._player_cache[player_id]
-			).group('sts')
+			sts = self.player_cache.get_sts(player_id)
+			if sts is None:
+				sts = search(
+					r'(?:signatureTimestamp|sts)\s*:\s*(?P<sts>\d{5})',
+					self._get_player_code(player_id)
+				).group('sts')
+				self.player_cache.set_sts(player_id, sts)
 		return sts, player_id
 
 	def _extract_player_response(self, video_id, yt_auth, client):
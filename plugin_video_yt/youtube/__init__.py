@@ -4,12 +4,12 @@ from .YouTubeVideoUrl import YouTubeVideoUrl
 from .fake_config import config
 import re
 
-def resolve(url, settings=None):
+def resolve(url, settings=None, cache_dir=None):
 	id_object = re.search('((?<=(v|V)/)|(?<=be/)|(?<=(\?|\&)v=)|(?<=embed/))([\w-]+)', url, re.DOTALL)
 
 	if id_object is not None:
 		url = id_object.group(0)
 
 	config.set_addon_settings(settings)
-	youtube = YouTubeVideoUrl()
+	youtube = YouTubeVideoUrl(cache_dir)
 	return youtube.extract(url)
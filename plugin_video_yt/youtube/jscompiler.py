@@ -0,0 +1,1159 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+
+from .compat import compat_chr
+from .compat import compat_str
+from .jsinterp import JSUndefined
+from .jsinterp import JSThrow
+from .jsinterp import _NaN
+from .jsinterp import _Infinity
+from .jsinterp import _OPERATORS
+from .jsinterp import _COMP_OPERATORS
+from .jsinterp import _LOG_OPERATORS
+from .jsinterp import _js_bit_op
+from .jsinterp import _js_arith_op
+from .jsinterp import _js_ternary
+
+# #################################################################################################
+#
+# Compiler of JS functions to tree of python closures.
+#
+# JSInterpreter works directly on source code - every statement is split, matched by regular expressions and
+# re-parsed every time it is executed. This is very slow for n-param function, that executes hundreds of statements
+# for each transformed value. Here the code is parsed only once and every node of syntax tree is turned to python
+# closure, that is then executed. Only subset of JS used by player functions is supported - when unsupported construct
+# is found, JSCompileError is raised and caller can fall back to JSInterpreter.
+#
+# Semantics of values and operators is the same as in JSInterpreter (it uses the same helpers), so both produce the
+# same results.
+#
+# #################################################################################################
+
+
+class JSCompileError(Exception):
+	pass
+
+
+# completion signals of statements - normal completion is None and return is signaled by tuple (value,)
+_BREAK = object()
+_CONTINUE = object()
+
+_CONSTANTS = {
+	'true': True,
+	'false': False,
+	'null': None,
+	'undefined': JSUndefined,
+	'NaN': _NaN,
+	'Infinity': _Infinity,
+}
+
+_UNSUPPORTED_KEYWORDS = frozenset((
+	'new', 'delete', 'in', 'instanceof', 'class', 'async', 'await', 'yield', 'import', 'export', 'super', 'with',
+	'debugger', 'var', 'let', 'const', 'if', 'else', 'for', 'while', 'do', 'return', 'throw', 'try', 'catch',
+	'finally', 'switch', 'case', 'default', 'break', 'continue',
+))
+
+_GLOBAL_TYPES = {
+	'String': compat_str,
+	'Math': float,
+	'Array': list,
+}
+
+_BINARY_PRECEDENCE = {
+	'??': 1, '||': 2, '&&': 3, '|': 4, '^': 5, '&': 6,
+	'==': 7, '!=': 7, '===': 7, '!==': 7,
+	'<': 8, '>': 8, '<=': 8, '>=': 8,
+	'<<': 9, '>>': 9, '>>>': 9,
+	'+': 10, '-': 10,
+	'*': 11, '/': 11, '%': 11,
+	'**': 12,
+}
+
+_ASSIGN_OPS = frozenset(('=', '+=', '-=', '*=', '/=', '%=', '**=', '<<=', '>>=', '>>>=', '&=', '|=', '^='))
+
+_BINARY_OPS = dict(_OPERATORS + _COMP_OPERATORS + _LOG_OPERATORS)
+_BINARY_OPS['>>>'] = _js_bit_op(lambda a, b: (a & 0xffffffff) >> (b & 31))
+
+_js_sub = _js_arith_op(lambda a, b: a - b)
+
+_PUNCTUATORS = sorted(set(list(_BINARY_PRECEDENCE) + list(_ASSIGN_OPS) + [
+	'++', '--', '=>', '?.', '...', '!', '~', '?', ':', '.', ',', ';', '(', ')', '{', '}', '[', ']',
+]), key=len, reverse=True)
+
+_TOKEN_RE = re.compile(r'''(?sx)
+	(?P<space>\s+|/\*.*?\*/|//[^\n]*)|
+	(?P<num>0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)|
+	(?P<name>[a-zA-Z_$][\w$]*)|
+	(?P<str>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')|
+	(?P<op>%s)
+	''' % '|'.join(re.escape(p) for p in _PUNCTUATORS))
+
+_ESCAPE_RE = re.compile(r'\\(?:x([0-9a-fA-F]{2})|u([0-9a-fA-F]{4})|u\{([0-9a-fA-F]+)\}|(\r\n|[\s\S]))')
+
+_ESCAPES = {
+	'n': '\n',
+	't': '\t',
+	'r': '\r',
+	'b': '\b',
+	'f': '\f',
+	'v': '\v',
+	'0': '\0',
+	'\n': '',
+	'\r\n': '',
+}
+
+# #################################################################################################
+
+
+def _unescape(m):
+	code = m.group(1) or m.group(2) or m.group(3)
+	if code:
+		return compat_chr(int(code, 16))
+	return _ESCAPES.get(m.group(4), m.group(4))
+
+
+def _tokenize(code):
+	tokens = []
+	pos, end = 0, len(code)
+	while pos < end:
+		m = _TOKEN_RE.match(code, pos)
+		if m is None:
+			raise JSCompileError('Unsupported character %r at position %d' % (code[pos], pos))
+		pos = m.end()
+
+		kind = m.lastgroup
+		value = m.group(kind)
+		if kind == 'space':
+			continue
+		elif kind == 'num':
+			if value[:2] in ('0x', '0X'):
+				value = int(value, 16)
+			elif '.' in value or 'e' in value or 'E' in value:
+				value = float(value)
+			else:
+				value = int(value)
+		elif kind == 'str':
+			value = _ESCAPE_RE.sub(_unescape, value[1:-1])
+
+		tokens.append((kind, value))
+
+	tokens.append(('eof', None))
+	return tokens
+
+
+def _js_typeof(value):
+	if value is JSUndefined:
+		return 'undefined'
+	elif value is True or value is False:
+		return 'boolean'
+	elif isinstance(value, (int, float)):
+		return 'number'
+	elif isinstance(value, compat_str):
+		return 'string'
+	elif callable(value):
+		return 'function'
+	return 'object'
+
+
+def _setitem(obj, idx, value):
+	if isinstance(obj, list):
+		if not isinstance(idx, (int, float)):
+			raise RuntimeError('List index %s must be integer' % idx)
+		obj[int(idx)] = value
+	else:
+		obj[idx] = value
+
+# #################################################################################################
+
+
+class _Function(object):
+	'''
+	Parsed function - names of params, declared variables and syntax tree of body
+	'''
+	def __init__(self, params):
+		self.params = params
+		self.declared = []
+		self.assigned = set()
+		self.functions = []
+		self.body = None
+
+	def declare(self, name):
+		if name not in self.declared and name not in self.params:
+			self.declared.append(name)
+
+# #################################################################################################
+
+
+class _Parser(object):
+	'''
+	Recursive descent parser, that creates syntax tree from tuples
+	'''
+	def __init__(self, code):
+		self.tokens = _tokenize(code)
+		self.pos = 0
+		self.func = None
+
+	def error(self, msg):
+		raise JSCompileError('%s (token %d: %r)' % (msg, self.pos, self.tokens[self.pos][1]))
+
+	def peek(self):
+		return self.tokens[self.pos]
+
+	def next(self):
+		token = self.tokens[self.pos]
+		self.pos += 1
+		return token
+
+	def at(self, value, kind='op'):
+		token = self.tokens[self.pos]
+		return token[0] == kind and token[1] == value
+
+	def at_name(self, value):
+		return self.at(value, 'name')
+
+	def accept(self, value, kind='op'):
+		if self.at(value, kind):
+			self.pos += 1
+			return True
+		return False
+
+	def expect(self, value, kind='op'):
+		if not self.accept(value, kind):
+			self.error('Expected %s' % value)
+
+	def expect_name(self):
+		kind, value = self.next()
+		if kind != 'name' or value in _CONSTANTS or value in _UNSUPPORTED_KEYWORDS:
+			self.pos -= 1
+			self.error('Expected name')
+		return value
+
+	def end_statement(self):
+		# minimised code doesn't rely on automatic semicolon insertion
+		if not self.accept(';') and not self.at('}') and self.peek()[0] != 'eof':
+			self.error('Expected ;')
+
+	# #################################################################################################
+
+	def parse_function_body(self, params):
+		func = _Function(list(params))
+		self.func = func
+		func.body = self.parse_statements()
+		if self.peek()[0] != 'eof':
+			self.error('Unexpected token')
+		return func
+
+	def parse_function(self):
+		name = None
+		if self.peek()[0] == 'name':
+			name = self.expect_name()
+
+		self.expect('(')
+		params = []
+		while not self.accept(')'):
+			params.append(self.expect_name())
+			if not self.at(')'):
+				self.expect(',')
+
+		if len(set(params)) != len(params):
+			self.error('Duplicate parameter name')
+
+		parent = self.func
+		func = _Function(params)
+		self.func = func
+		try:
+			self.expect('{')
+			func.body = self.parse_statements()
+			self.expect('}')
+		finally:
+			self.func = parent
+
+		return name, func
+
+	def parse_statements(self):
+		statements = []
+		while not self.at('}') and self.peek()[0] != 'eof':
+			statements.append(self.parse_statement())
+		return statements
+
+	def parse_block(self):
+		self.expect('{')
+		statements = self.parse_statements()
+		self.expect('}')
+		return ('block', statements)
+
+	# #################################################################################################
+
+	def parse_statement(self):
+		kind, value = self.peek()
+
+		if kind == 'op':
+			if value == '{':
+				return self.parse_block()
+			elif value == ';':
+				self.pos += 1
+				return ('empty',)
+
+		elif kind == 'name':
+			if value in ('var', 'let', 'const'):
+				self.pos += 1
+				stmt = self.parse_var()
+				self.end_statement()
+				return stmt
+
+			elif value == 'function':
+				self.pos += 1
+				name, func = self.parse_function()
+				if name is None:
+					self.error('Function declaration without name')
+				self.func.declare(name)
+				self.func.functions.append((name, func))
+				return ('empty',)
+
+			elif value == 'if':
+				self.pos += 1
+				self.expect('(')
+				cndn = self.parse_expression()
+				self.expect(')')
+				if_stmt = self.parse_statement()
+				else_stmt = self.parse_statement() if self.accept('else', 'name') else None
+				return ('if', cndn, if_stmt, else_stmt)
+
+			elif value == 'for':
+				self.pos += 1
+				return self.parse_for()
+
+			elif value == 'while':
+				self.pos += 1
+				self.expect('(')
+				cndn = self.parse_expression()
+				self.expect(')')
+				return ('for', None, cndn, None, self.parse_statement())
+
+			elif value == 'do':
+				self.pos += 1
+				body = self.parse_statement()
+				self.expect('while', 'name')
+				self.expect('(')
+				cndn = self.parse_expression()
+				self.expect(')')
+				self.accept(';')
+				return ('do', body, cndn)
+
+			elif value == 'return':
+				self.pos += 1
+				expr = None
+				if not self.at(';') and not self.at('}') and self.peek()[0] != 'eof':
+					expr = self.parse_expression()
+				self.end_statement()
+				return ('return', expr)
+
+			elif value == 'throw':
+				self.pos += 1
+				expr = self.parse_expression()
+				self.end_statement()
+				return ('throw', expr)
+
+			elif value in ('break', 'continue'):
+				self.pos += 1
+				self.end_statement()
+				return (value,)
+
+			elif value == 'switch':
+				self.pos += 1
+				return self.parse_switch()
+
+			elif value == 'try':
+				self.pos += 1
+				return self.parse_try()
+
+		expr = self.parse_expression()
+		self.end_statement()
+		return ('expr', expr)
+
+	def parse_var(self):
+		declarations = []
+		while True:
+			name = self.expect_name()
+			self.func.declare(name)
+			init = self.parse_assign() if self.accept('=') else None
+			declarations.append((name, init))
+			if not self.accept(','):
+				return ('var', declarations)
+
+	def parse_for(self):
+		self.expect('(')
+		init = None
+		if self.peek()[0] == 'name' and self.peek()[1] in ('var', 'let', 'const'):
+			self.pos += 1
+			init = self.parse_var()
+		elif not self.at(';'):
+			init = ('expr', self.parse_expression())
+
+		if self.at_name('in') or self.at_name('of'):
+			self.error('for-in and for-of loops are not supported')
+
+		self.expect(';')
+		cndn = None if self.at(';') else self.parse_expression()
+		self.expect(';')
+		increment = None if self.at(')') else self.parse_expression()
+		self.expect(')')
+		return ('for', init, cndn, increment, self.parse_statement())
+
+	def parse_switch(self):
+		self.expect('(')
+		discriminant = self.parse_expression()
+		self.expect(')')
+		self.expect('{')
+		cases = []
+		while not self.accept('}'):
+			if self.accept('case', 'name'):
+				test = self.parse_expression()
+			elif self.accept('default', 'name'):
+				test = None
+			else:
+				self.error('Expected case')
+			self.expect(':')
+
+			statements = []
+			while not self.at('}') and not self.at_name('case') and not self.at_name('default'):
+				statements.append(self.parse_statement())
+			cases.append((test, ('block', statements)))
+
+		return ('switch', discriminant, cases)
+
+	def parse_try(self):
+		block = self.parse_block()
+		catch_name = catch_block = finally_block = None
+		if self.accept('catch', 'name'):
+			if self.accept('('):
+				catch_name = self.expect_name()
+				self.func.declare(catch_name)
+				self.expect(')')
+			catch_block = self.parse_block()
+		if self.accept('finally', 'name'):
+			finally_block = self.parse_block()
+		if catch_block is None and finally_block is None:
+			self.error('Expected catch or finally')
+		return ('try', block, catch_name, catch_block, finally_block)
+
+	# #################################################################################################
+
+	def parse_expression(self):
+		expr = self.parse_assign()
+		if not self.at(','):
+			return expr
+
+		exprs = [expr]
+		while self.accept(','):
+			exprs.append(self.parse_assign())
+		return ('seq', exprs)
+
+	def parse_assign(self):
+		left = self.parse_conditional()
+		kind, op = self.peek()
+		if kind != 'op' or op not in _ASSIGN_OPS:
+			return left
+
+		self.pos += 1
+		self.check_target(left)
+		return ('assign', op, left, self.parse_assign())
+
+	def check_target(self, target):
+		if target[0] == 'name':
+			self.func.assigned.add(target[1])
+		elif target[0] != 'member':
+			self.error('Invalid assignment target')
+
+	def parse_conditional(self):
+		cndn = self.parse_binary(1)
+		if not self.accept('?'):
+			return cndn
+
+		if_true = self.parse_assign()
+		self.expect(':')
+		return ('cond', cndn, if_true, self.parse_assign())
+
+	def parse_binary(self, min_precedence):
+		left = self.parse_unary()
+		while True:
+			kind, op = self.peek()
+			precedence = _BINARY_PRECEDENCE.get(op) if kind == 'op' else None
+			if precedence is None or precedence < min_precedence:
+				return left
+
+			self.pos += 1
+			# exponentiation is right associative
+			right = self.parse_binary(precedence if op == '**' else precedence + 1)
+			left = ('logic' if op in ('||', '&&', '??') else 'bin', op, left, right)
+
+	def parse_unary(self):
+		kind, op = self.peek()
+		if kind == 'op':
+			if op in ('!', '-', '+', '~'):
+				self.pos += 1
+				operand = self.parse_unary()
+				if op == '-' and operand[0] == 'const' and isinstance(operand[1], (int, float)) and not isinstance(operand[1], bool):
+					return ('const', -operand[1])
+				return ('unary', op, operand)
+			elif op in ('++', '--'):
+				self.pos += 1
+				target = self.parse_unary()
+				self.check_target(target)
+				return ('update', op, True, target)
+
+		elif kind == 'name' and op in ('typeof', 'void'):
+			self.pos += 1
+			return ('unary', op, self.parse_unary())
+
+		expr = self.parse_lhs()
+		kind, op = self.peek()
+		if kind == 'op' and op in ('++', '--'):
+			self.pos += 1
+			self.check_target(expr)
+			return ('update', op, False, expr)
+
+		return expr
+
+	def parse_lhs(self):
+		expr = self.parse_primary()
+		while True:
+			kind, value = self.peek()
+			if kind != 'op':
+				return expr
+
+			if value == '.':
+				self.pos += 1
+				kind, name = self.next()
+				if kind != 'name':
+					self.pos -= 1
+					self.error('Expected property name')
+				expr = ('member', expr, ('const', name))
+			elif value == '[':
+				self.pos += 1
+				prop = self.parse_expression()
+				self.expect(']')
+				expr = ('member', expr, prop)
+			elif value == '(':
+				self.pos += 1
+				args = []
+				while not self.accept(')'):
+					args.append(self.parse_assign())
+					if not self.at(')'):
+						self.expect(',')
+				expr = ('call', expr, args)
+			else:
+				return expr
+
+	def parse_primary(self):
+		kind, value = self.next()
+
+		if kind in ('num', 'str'):
+			return ('const', value)
+
+		elif kind == 'name':
+			if value in _CONSTANTS:
+				return ('const', _CONSTANTS[value])
+			elif value == 'function':
+				return ('func', self.parse_function()[1])
+			elif value == 'this':
+				# this is passed to functions as keyword argument, the same way as in JSInterpreter
+				self.func.declare(value)
+			elif value in _UNSUPPORTED_KEYWORDS:
+				self.pos -= 1
+				self.error('Unsupported keyword')
+			return ('name', value)
+
+		elif kind == 'op':
+			if value == '(':
+				expr = self.parse_expression()
+				self.expect(')')
+				if self.at('=>'):
+					self.error('Arrow functions are not supported')
+				return expr
+
+			elif value == '[':
+				items = []
+				while not self.accept(']'):
+					items.append(self.parse_assign())
+					if not self.at(']'):
+						self.expect(',')
+				return ('array', items)
+
+			elif value == '{':
+				items = []
+				while not self.accept('}'):
+					kind, key = self.next()
+					if kind not in ('name', 'str', 'num'):
+						self.pos -= 1
+						self.error('Unsupported object key')
+					self.expect(':')
+					items.append((compat_str(key), self.parse_assign()))
+					if not self.at('}'):
+						self.expect(',')
+				return ('object', items)
+
+		self.pos -= 1
+		self.error('Unexpected token')
+
+# #################################################################################################
+
+
+class JSCompiler(object):
+	'''
+	Compiles JS functions from player code to python closures. Compiled functions have the same calling convention
+	as functions created by JSInterpreter.build_function(), so they can be mixed. Objects and functions referenced
+	from global scope of player are extracted and compiled on first use - one compiler instance should be used for
+	all functions of one player.
+	'''
+	def __init__(self, jsi):
+		self.jsi = jsi
+		self.globals = {}
+		self.scopes = []
+
+	# #################################################################################################
+
+	def compile_function(self, argnames, code):
+		'''
+		Compiles function from output of JSInterpreter.extract_function_code(). Raises JSCompileError when code
+		contains unsupported constructions.
+		'''
+		func = _Parser(code).parse_function_body(argnames)
+
+		# functions from global scope can be compiled at run time of other function
+		scopes, self.scopes = self.scopes, []
+		try:
+			return self._function(func)(())
+		finally:
+			self.scopes = scopes
+
+	def _build_helper(self, argnames, code):
+		# helpers can modify their arguments, so they can't be safely run again by interpreter when they fail
+		try:
+			return self.compile_function(argnames, code)
+		except JSCompileError as e:
+			print('[JSCompiler] Failed to compile function - using interpreter: %s' % e)
+			return self.jsi.extract_function_from_code(argnames, code)
+
+	def build_function(self, argnames, code):
+		'''
+		Compiles function and when it's not possible, then builds it using interpreter. When compiled function fails
+		at run time (raises exception or returns enhanced_except_ result of player's catch block), then call is repeated
+		by interpreter and interpreted function is used for all next calls.
+		'''
+		try:
+			compiled = self.compile_function(argnames, code)
+		except JSCompileError as e:
+			print('[JSCompiler] Failed to compile function - using interpreter: %s' % e)
+			return self.jsi.extract_function_from_code(argnames, code)
+
+		state = { 'func': compiled }
+
+		def use_interpreter(reason, args, *rest, **kwargs):
+			print('[JSCompiler] Compiled function failed - using interpreter: %s' % reason)
+			state['func'] = self.jsi.extract_function_from_code(argnames, code)
+			return state['func'](args, *rest, **kwargs)
+
+		def func(args, *rest, **kwargs):
+			if state['func'] is not compiled:
+				return state['func'](args, *rest, **kwargs)
+
+			try:
+				ret = compiled(args, *rest, **kwargs)
+			except Exception as e:
+				return use_interpreter(e, args, *rest, **kwargs)
+
+			if isinstance(ret, compat_str) and ret.startswith('enhanced_except_'):
+				return use_interpreter(ret, args, *rest, **kwargs)
+
+			return ret
+
+		return func
+
+	# #################################################################################################
+
+	def _get_global(self, name, kind):
+		key = (kind, name)
+		try:
+			return self.globals[key]
+		except KeyError:
+			pass
+
+		if kind == 'function':
+			value = self._build_helper(*self.jsi.extract_function_code(name))
+		elif kind == 'object':
+			value = _GLOBAL_TYPES.get(name)
+			if value is None:
+				value = self.jsi._objects.get(name)
+			if value is None:
+				value = self.jsi.extract_object(name, self._build_helper)
+		else:
+			value = _GLOBAL_TYPES.get(name, JSUndefined)
+
+		self.globals[key] = value
+		return value
+
+	def _resolve(self, name):
+		for depth in range(len(self.scopes) - 1, -1, -1):
+			slot = self.scopes[depth].get(name)
+			if slot is not None:
+				return depth, slot
+		return None
+
+	# #################################################################################################
+
+	def _function(self, func):
+		'''
+		Returns factory, that creates function in given environment. Environment is tuple of frames (lists of local
+		variables) of all enclosing functions and variables are accessed directly by depth and slot number.
+		'''
+		slots = {}
+		for name in func.params + func.declared:
+			slots[name] = len(slots)
+
+		# assignment to undeclared variable creates local variable - the same as in JSInterpreter
+		for name in sorted(func.assigned):
+			if name not in slots and self._resolve(name) is None:
+				slots[name] = len(slots)
+
+		self.scopes.append(slots)
+		try:
+			body = self._block(func.body)
+			functions = tuple((slots[name], self._function(f)) for name, f in func.functions)
+		finally:
+			self.scopes.pop()
+
+		nparams = len(func.params)
+		padding = [None] * nparams
+		locals_init = [JSUndefined] * (len(slots) - nparams)
+
+		def factory(env):
+			def resf(args, kwargs={}, allow_recursion=100):
+				frame = list(args[:nparams])
+				if len(frame) < nparams:
+					frame.extend(padding[len(frame):])
+				frame.extend(locals_init)
+
+				for name, value in kwargs.items():
+					slot = slots.get(name)
+					if slot is not None:
+						frame[slot] = value
+
+				fenv = env + (frame,)
+				for slot, f in functions:
+					frame[slot] = f(fenv)
+
+				ret = body(fenv)
+				if ret.__class__ is tuple:
+					return ret[0]
+			return resf
+		return factory
+
+	# #################################################################################################
+
+	def _block(self, statements):
+		compiled = tuple(s for s in map(self._statement, statements) if s is not None)
+		if not compiled:
+			return lambda env: None
+		elif len(compiled) == 1:
+			return compiled[0]
+
+		def block(env):
+			for stmt in compiled:
+				ret = stmt(env)
+				if ret is not None:
+					return ret
+		return block
+
+	def _statement(self, node):
+		return getattr(self, '_stmt_' + node[0])(node)
+
+	def _stmt_empty(self, node):
+		return None
+
+	def _stmt_block(self, node):
+		return self._block(node[1])
+
+	def _stmt_expr(self, node):
+		expr = self._expression(node[1])
+
+		def stmt(env):
+			expr(env)
+		return stmt
+
+	def _stmt_var(self, node):
+		assignments = tuple(self._assign('=', ('name', name), init) for name, init in node[1] if init is not None)
+		if not assignments:
+			return None
+		elif len(assignments) == 1:
+			expr = assignments[0]
+
+			def stmt(env):
+				expr(env)
+			return stmt
+
+		def stmt(env):
+			for expr in assignments:
+				expr(env)
+		return stmt
+
+	def _stmt_if(self, node):
+		cndn = self._expression(node[1])
+		if_stmt = self._statement(node[2]) or (lambda env: None)
+		else_stmt = (node[3] and self._statement(node[3])) or (lambda env: None)
+
+		def stmt(env):
+			if _js_ternary(cndn(env)):
+				return if_stmt(env)
+			return else_stmt(env)
+		return stmt
+
+	def _stmt_for(self, node):
+		init = node[1] and self._statement(node[1])
+		cndn = node[2] and self._expression(node[2])
+		increment = node[3] and self._expression(node[3])
+		body = self._statement(node[4]) or (lambda env: None)
+
+		def stmt(env):
+			if init:
+				init(env)
+			while cndn is None or _js_ternary(cndn(env)):
+				ret = body(env)
+				if ret is not None and ret is not _CONTINUE:
+					if ret is _BREAK:
+						break
+					return ret
+				if increment:
+					increment(env)
+		return stmt
+
+	def _stmt_do(self, node):
+		body = self._statement(node[1]) or (lambda env: None)
+		cndn = self._expression(node[2])
+
+		def stmt(env):
+			while True:
+				ret = body(env)
+				if ret is not None and ret is not _CONTINUE:
+					if ret is _BREAK:
+						break
+					return ret
+				if not _js_ternary(cndn(env)):
+					break
+		return stmt
+
+	def _stmt_return(self, node):
+		if node[1] is None:
+			return lambda env: (None,)
+
+		expr = self._expression(node[1])
+		return lambda env: (expr(env),)
+
+	def _stmt_throw(self, node):
+		expr = self._expression(node[1])
+
+		def stmt(env):
+			raise JSThrow(expr(env))
+		return stmt
+
+	def _stmt_break(self, node):
+		return lambda env: _BREAK
+
+	def _stmt_continue(self, node):
+		return lambda env: _CONTINUE
+
+	def _stmt_switch(self, node):
+		discriminant = self._expression(node[1])
+		cases = tuple((test and self._expression(test), self._statement(body)) for test, body in node[2])
+		default = next((i for i, case in enumerate(cases) if case[0] is None), None)
+
+		def stmt(env):
+			value = discriminant(env)
+			start = default
+			for i, case in enumerate(cases):
+				if case[0] is not None and value == case[0](env):
+					start = i
+					break
+
+			if start is None:
+				return None
+
+			for i in range(start, len(cases)):
+				ret = cases[i][1](env)
+				if ret is not None:
+					return None if ret is _BREAK else ret
+		return stmt
+
+	def _stmt_try(self, node):
+		block = self._statement(node[1])
+		finally_block = node[4] and self._statement(node[4])
+		catch_block = node[3] and self._statement(node[3])
+		catch_var = node[2] and self._resolve(node[2])
+
+		def run_finally(env):
+			return finally_block(env) if finally_block else None
+
+		def stmt(env):
+			try:
+				ret = block(env)
+			except Exception as e:
+				if not catch_block:
+					run_finally(env)
+					raise
+
+				if catch_var:
+					depth, slot = catch_var
+					env[depth][slot] = e.args[0] if isinstance(e, JSThrow) and e.args else e
+
+				try:
+					ret = catch_block(env)
+				except Exception:
+					run_finally(env)
+					raise
+
+			# return from finally block overrides result of try/catch
+			return run_finally(env) or ret
+		return stmt
+
+	# #################################################################################################
+
+	def _expression(self, node):
+		return getattr(self, '_expr_' + node[0])(node)
+
+	def _object_expression(self, node):
+		if node[0] == 'name':
+			return self._name(node[1], 'object')
+		return self._expression(node)
+
+	def _name(self, name, kind='value'):
+		resolved = self._resolve(name)
+		if resolved:
+			depth, slot = resolved
+			return lambda env: env[depth][slot]
+
+		get_global = self._get_global
+		return lambda env: get_global(name, kind)
+
+	def _expr_const(self, node):
+		value = node[1]
+		return lambda env: value
+
+	def _expr_name(self, node):
+		return self._name(node[1])
+
+	def _expr_func(self, node):
+		return self._function(node[1])
+
+	def _expr_array(self, node):
+		items = tuple(self._expression(item) for item in node[1])
+		return lambda env: [item(env) for item in items]
+
+	def _expr_object(self, node):
+		items = tuple((key, self._expression(value)) for key, value in node[1])
+		return lambda env: dict((key, value(env)) for key, value in items)
+
+	def _expr_seq(self, node):
+		exprs = tuple(self._expression(e) for e in node[1][:-1])
+		last = self._expression(node[1][-1])
+
+		def expr(env):
+			for e in exprs:
+				e(env)
+			return last(env)
+		return expr
+
+	def _expr_cond(self, node):
+		cndn = self._expression(node[1])
+		if_true = self._expression(node[2])
+		if_false = self._expression(node[3])
+		return lambda env: if_true(env) if _js_ternary(cndn(env)) else if_false(env)
+
+	def _expr_logic(self, node):
+		op = node[1]
+		left = self._expression(node[2])
+		right = self._expression(node[3])
+
+		if op == '||':
+			def expr(env):
+				value = left(env)
+				return value if _js_ternary(value) else right(env)
+		elif op == '&&':
+			def expr(env):
+				value = left(env)
+				return right(env) if _js_ternary(value) else value
+		else:
+			def expr(env):
+				value = left(env)
+				return right(env) if value in (None, JSUndefined) else value
+		return expr
+
+	def _expr_bin(self, node):
+		op = _BINARY_OPS.get(node[1])
+		if op is None:
+			raise JSCompileError('Unsupported operator %s' % node[1])
+
+		left = self._expression(node[2])
+		right = self._expression(node[3])
+		return lambda env: op(left(env), right(env))
+
+	def _expr_unary(self, node):
+		op = node[1]
+		operand = self._expression(node[2])
+
+		if op == '!':
+			return lambda env: not _js_ternary(operand(env))
+		elif op == '-':
+			return lambda env: _js_sub(0, operand(env))
+		elif op == '+':
+			return lambda env: _js_sub(operand(env), 0)
+		elif op == '~':
+			bit_not = _BINARY_OPS['^']
+			return lambda env: bit_not(operand(env), 0xffffffff)
+		elif op == 'void':
+			def expr(env):
+				operand(env)
+			return expr
+
+		if node[2][0] == 'name':
+			# typeof of undeclared variable is not an error
+			name = node[2][1]
+			operand = self._name(name) if self._resolve(name) else (lambda env: _GLOBAL_TYPES.get(name, JSUndefined))
+		return lambda env: _js_typeof(operand(env))
+
+	def _expr_member(self, node):
+		obj = self._object_expression(node[1])
+		prop = node[2]
+		index = self.jsi._index
+
+		if prop[0] == 'const':
+			key = prop[1]
+			if key == 'length':
+				return lambda env: len(obj(env))
+			return lambda env: index(obj(env), key)
+
+		prop = self._expression(prop)
+
+		def expr(env):
+			o = obj(env)
+			key = prop(env)
+			if o.__class__ is list and key.__class__ is int:
+				return o[key]
+			return index(o, key)
+		return expr
+
+	def _expr_call(self, node):
+		callee = node[1]
+		args = tuple(self._expression(arg) for arg in node[2])
+
+		if callee[0] == 'member':
+			obj_node, prop = callee[1], callee[2]
+
+			if obj_node == ('name', 'console') and prop == ('const', 'debug'):
+				return lambda env: None
+
+			# String.prototype.split.call(...) - the same handling of prototype calls as in JSInterpreter
+			if prop[0] == 'const' and prop[1] in ('call', 'apply') and obj_node[0] == 'member' and \
+					obj_node[2][0] == 'const' and obj_node[1][0] == 'member' and obj_node[1][2] == ('const', 'prototype') and \
+					obj_node[1][1][0] == 'name':
+				prop = ('const', 'prototype.%s.%s' % (obj_node[2][1], prop[1]))
+				obj_node = obj_node[1][1]
+
+			obj = self._object_expression(obj_node)
+			prop = self._expression(prop)
+			call_method = self.jsi._call_method
+
+			def expr(env):
+				o = obj(env)
+				key = prop(env)
+				argvals = [arg(env) for arg in args]
+				if o.__class__ is list and key.__class__ is int:
+					return o[key](argvals)
+				return call_method(o, key, argvals, 100)
+			return expr
+
+		if callee[0] == 'name':
+			func = self._name(callee[1], 'function')
+		else:
+			func = self._expression(callee)
+
+		return lambda env: func(env)([arg(env) for arg in args])
+
+	def _assign(self, op, target, value_node):
+		value = self._expression(value_node)
+		op = op[:-1]
+		if op:
+			op = _BINARY_OPS.get(op)
+			if op is None:
+				raise JSCompileError('Unsupported assignment operator %s=' % op)
+
+		if target[0] == 'name':
+			resolved = self._resolve(target[1])
+			if resolved is None:
+				raise JSCompileError('Assignment to unknown variable %s' % target[1])
+			depth, slot = resolved
+
+			if not op:
+				def expr(env):
+					v = env[depth][slot] = value(env)
+					return v
+			else:
+				def expr(env):
+					frame = env[depth]
+					v = frame[slot] = op(frame[slot], value(env))
+					return v
+			return expr
+
+		obj = self._object_expression(target[1])
+		prop = self._expression(target[2])
+		index = self.jsi._index
+
+		if not op:
+			def expr(env):
+				o = obj(env)
+				key = prop(env)
+				v = value(env)
+				_setitem(o, key, v)
+				return v
+		else:
+			def expr(env):
+				o = obj(env)
+				key = prop(env)
+				v = op(index(o, key), value(env))
+				_setitem(o, key, v)
+				return v
+		return expr
+
+	def _expr_assign(self, node):
+		return self._assign(node[1], node[2], node[3])
+
+	def _expr_update(self, node):
+		delta = 1 if node[1] == '++' else -1
+		prefix = node[2]
+		target = node[3]
+
+		if target[0] == 'name':
+			depth, slot = self._resolve(target[1])
+
+			def expr(env):
+				frame = env[depth]
+				old = frame[slot]
+				new = frame[slot] = old + delta
+				return new if prefix else old
+			return expr
+
+		obj = self._object_expression(target[1])
+		prop = self._expression(target[2])
+		index = self.jsi._index
+
+		def expr(env):
+			o = obj(env)
+			key = prop(env)
+			old = index(o, key)
+			new = old + delta
+			_setitem(o, key, new)
+			return new if prefix else old
+		return expr
+
+# #################################################################################################
@@ -777,22 +777,10 @@ class JSInterpreter(object):
 			else:
 				arg_str, remaining = None, arg_str
 
-			def assertion(cndn, msg):
-				""" assert, but without risk of getting optimized out """
-				if not cndn:
-					raise RuntimeError('{0} {1}'.format(member, msg))
-
 			def eval_method(variable, member):
 				if (variable, member) == ('console', 'debug'):
 					return
 
-				ARG_MSG = 'takes one or more arguments'
-				ARG_ONE_MSG = 'takes exactly one argument'
-				ARG_TWO_MSG = 'takes two arguments'
-				ARG_NOT_MSG = 'does not take any arguments'
-				ARG_2_MSG = 'takes at-most 2 arguments'
-				LIST_MSG = 'must be applied on a list'
-
 				types = {
 					'String': compat_str,
 					'Math': float,
@@ -823,103 +811,7 @@ class JSInterpreter(object):
 					self.interpret_expression(v, local_vars, allow_recursion)
 					for v in self._separate(arg_str)]
 
-				# Fixup prototype call
-				if isinstance(obj, type):
-					new_member, rest = member.partition('.')[0::2]
-					if new_member == 'prototype':
-						new_member, func_prototype = rest.partition('.')[0::2]
-						assertion(argvals, ARG_MSG)
-						assertion(isinstance(argvals[0], obj), 'must bind to type {0}'.format(obj))
-						if func_prototype == 'call':
-							obj = argvals.pop(0)
-						elif func_prototype == 'apply':
-							assertion(len(argvals) == 2, ARG_TWO_MSG)
-							obj, argvals = argvals
-							assertion(isinstance(argvals, list), 'second argument must be a list')
-						else:
-							raise RuntimeError('Unsupported function method ' + func_prototype)
-						member = new_member
-
-				if obj is compat_str:
-					if member == 'fromCharCode':
-						assertion(argvals, ARG_MSG)
-						return ''.join(map(compat_chr, argvals))
-					raise RuntimeError('Unsupported string method', member)
-				elif obj is float:
-					if member == 'pow':
-						assertion(len(argvals) == 2, ARG_TWO_MSG)
-						return argvals[0] ** argvals[1]
-					raise RuntimeError('Unsupported Math method', member)
-
-				if member == 'split':
-					assertion(len(argvals) == 1, 'with limit argument is not implemented')
-					return obj.split(argvals[0]) if argvals[0] else list(obj)
-				elif member == 'join':
-					assertion(isinstance(obj, list), LIST_MSG)
-					assertion(len(argvals) == 1, ARG_ONE_MSG)
-					return argvals[0].join(obj)
-				elif member == 'reverse':
-					assertion(not argvals, ARG_NOT_MSG)
-					obj.reverse()
-					return obj
-				elif member == 'slice':
-					assertion(isinstance(obj, (list, compat_str)), 'must be applied on a list or string')
-					assertion(len(argvals) <= 2, 'takes between 0 and 2 arguments')
-					if len(argvals) < 2:
-						argvals += (None,)
-					return obj[slice(*argvals)]
-				elif member == 'splice':
-					assertion(isinstance(obj, list), LIST_MSG)
-					assertion(argvals, ARG_MSG)
-					index, how_many = map(int, (argvals + [len(obj)])[:2])
-					if index < 0:
-						index += len(obj)
-					add_items = argvals[2:]
-					res = []
-					for _ in range(index, min(index + how_many, len(obj))):
-						res.append(obj.pop(index))
-					for i, item in enumerate(add_items):
-						obj.insert(index + i, item)
-					return res
-				elif member == 'unshift':
-					assertion(isinstance(obj, list), LIST_MSG)
-					assertion(argvals, ARG_MSG)
-					for item in reversed(argvals):
-						obj.insert(0, item)
-					return obj
-				elif member == 'pop':
-					assertion(isinstance(obj, list), LIST_MSG)
-					assertion(not argvals, ARG_NOT_MSG)
-					if not obj:
-						return
-					return obj.pop()
-				elif member == 'push':
-					assertion(argvals, ARG_MSG)
-					obj.extend(argvals)
-					return obj
-				elif member == 'forEach':
-					assertion(argvals, ARG_MSG)
-					assertion(len(argvals) <= 2, ARG_2_MSG)
-					f, this = (argvals + [''])[:2]
-					return [f((item, idx, obj), {'this': this}, allow_recursion) for idx, item in enumerate(obj)]
-				elif member == 'indexOf':
-					assertion(argvals, ARG_MSG)
-					assertion(len(argvals) <= 2, ARG_2_MSG)
-					idx, start = (argvals + [0])[:2]
-					try:
-						return obj.index(idx, start)
-					except ValueError:
-						return -1
-				elif member == 'charCodeAt':
-					assertion(isinstance(obj, compat_str), 'must be applied on a string')
-					assertion(len(argvals) == 1, ARG_ONE_MSG)
-					idx = argvals[0] if isinstance(argvals[0], int) else 0
-					if idx >= len(obj):
-						return None
-					return ord(obj[idx])
-
-				idx = int(member) if isinstance(obj, list) else member
-				return obj[idx](argvals, allow_recursion=allow_recursion)
+				return self._call_method(obj, member, argvals, allow_recursion)
 
 			if remaining:
 				ret, should_abort = self.interpret_statement(
@@ -940,13 +832,125 @@ class JSInterpreter(object):
 
 		raise RuntimeError('Unsupported JS expression', expr[:40])
 
+	def _call_method(self, obj, member, argvals, allow_recursion):
+		""" Calls method member of obj - builtin methods of String, Math and lists are emulated """
+		def assertion(cndn, msg):
+			""" assert, but without risk of getting optimized out """
+			if not cndn:
+				raise RuntimeError('{0} {1}'.format(member, msg))
+
+		ARG_MSG = 'takes one or more arguments'
+		ARG_ONE_MSG = 'takes exactly one argument'
+		ARG_TWO_MSG = 'takes two arguments'
+		ARG_NOT_MSG = 'does not take any arguments'
+		ARG_2_MSG = 'takes at-most 2 arguments'
+		LIST_MSG = 'must be applied on a list'
+
+		# Fixup prototype call
+		if isinstance(obj, type):
+			new_member, rest = member.partition('.')[0::2]
+			if new_member == 'prototype':
+				new_member, func_prototype = rest.partition('.')[0::2]
+				assertion(argvals, ARG_MSG)
+				assertion(isinstance(argvals[0], obj), 'must bind to type {0}'.format(obj))
+				if func_prototype == 'call':
+					obj = argvals.pop(0)
+				elif func_prototype == 'apply':
+					assertion(len(argvals) == 2, ARG_TWO_MSG)
+					obj, argvals = argvals
+					assertion(isinstance(argvals, list), 'second argument must be a list')
+				else:
+					raise RuntimeError('Unsupported function method ' + func_prototype)
+				member = new_member
+
+		if obj is compat_str:
+			if member == 'fromCharCode':
+				assertion(argvals, ARG_MSG)
+				return ''.join(map(compat_chr, argvals))
+			raise RuntimeError('Unsupported string method', member)
+		elif obj is float:
+			if member == 'pow':
+				assertion(len(argvals) == 2, ARG_TWO_MSG)
+				return argvals[0] ** argvals[1]
+			raise RuntimeError('Unsupported Math method', member)
+
+		if member == 'split':
+			assertion(len(argvals) == 1, 'with limit argument is not implemented')
+			return obj.split(argvals[0]) if argvals[0] else list(obj)
+		elif member == 'join':
+			assertion(isinstance(obj, list), LIST_MSG)
+			assertion(len(argvals) == 1, ARG_ONE_MSG)
+			return argvals[0].join(obj)
+		elif member == 'reverse':
+			assertion(not argvals, ARG_NOT_MSG)
+			obj.reverse()
+			return obj
+		elif member == 'slice':
+			assertion(isinstance(obj, (list, compat_str)), 'must be applied on a list or string')
+			assertion(len(argvals) <= 2, 'takes between 0 and 2 arguments')
+			if len(argvals) < 2:
+				argvals += (None,)
+			return obj[slice(*argvals)]
+		elif member == 'splice':
+			assertion(isinstance(obj, list), LIST_MSG)
+			assertion(argvals, ARG_MSG)
+			index, how_many = map(int, (argvals + [len(obj)])[:2])
+			if index < 0:
+				index += len(obj)
+			add_items = argvals[2:]
+			res = []
+			for _ in range(index, min(index + how_many, len(obj))):
+				res.append(obj.pop(index))
+			for i, item in enumerate(add_items):
+				obj.insert(index + i, item)
+			return res
+		elif member == 'unshift':
+			assertion(isinstance(obj, list), LIST_MSG)
+			assertion(argvals, ARG_MSG)
+			for item in reversed(argvals):
+				obj.insert(0, item)
+			return obj
+		elif member == 'pop':
+			assertion(isinstance(obj, list), LIST_MSG)
+			assertion(not argvals, ARG_NOT_MSG)
+			if not obj:
+				return
+			return obj.pop()
+		elif member == 'push':
+			assertion(argvals, ARG_MSG)
+			obj.extend(argvals)
+			return obj
+		elif member == 'forEach':
+			assertion(argvals, ARG_MSG)
+			assertion(len(argvals) <= 2, ARG_2_MSG)
+			f, this = (argvals + [''])[:2]
+			return [f((item, idx, obj), {'this': this}, allow_recursion) for idx, item in enumerate(obj)]
+		elif member == 'indexOf':
+			assertion(argvals, ARG_MSG)
+			assertion(len(argvals) <= 2, ARG_2_MSG)
+			idx, start = (argvals + [0])[:2]
+			try:
+				return obj.index(idx, start)
+			except ValueError:
+				return -1
+		elif member == 'charCodeAt':
+			assertion(isinstance(obj, compat_str), 'must be applied on a string')
+			assertion(len(argvals) == 1, ARG_ONE_MSG)
+			idx = argvals[0] if isinstance(argvals[0], int) else 0
+			if idx >= len(obj):
+				return None
+			return ord(obj[idx])
+
+		idx = int(member) if isinstance(obj, list) else member
+		return obj[idx](argvals, allow_recursion=allow_recursion)
+
 	def interpret_expression(self, expr, local_vars, allow_recursion):
 		ret, should_return = self.interpret_statement(expr, local_vars, allow_recursion)
 		if should_return:
 			raise RuntimeError('Cannot return from an expression')
 		return ret
 
-	def extract_object(self, objname):
+	def extract_object(self, objname, build_function=None):
 		_FUNC_NAME_RE = r'''(?:[a-zA-Z$0-9]+|"[a-zA-Z$0-9]+"|'[a-zA-Z$0-9]+')'''
 		obj = {}
 		fields = None
@@ -969,7 +973,7 @@ class JSInterpreter(object):
 			''' % (_FUNC_NAME_RE, _NAME_RE),
 			fields):
 			argnames = self.build_arglist(f.group('args'))
-			obj[remove_quotes(f.group('key'))] = self.build_function(argnames, f.group('code'))
+			obj[remove_quotes(f.group('key'))] = (build_function or self.build_function)(argnames, f.group('code'))
 
 		return obj
 
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from json import dumps, loads
+from time import time
+
+from tools_archivczsk.cache import LRUCache
+
+# #################################################################################################
+
+class PlayerCache(object):
+	'''
+	Persistent cache of YouTube player data. Player JS code is stored in separate file per player_id and in index file
+	are stored signature timestamp and extracted code of signature and n-param functions, so after addon restart
+	nothing needs to be downloaded or extracted again. Only last max_players are kept.
+
+	Results of signature/n-param transformations are kept only in memory (LRU).
+	'''
+	INDEX_FILE = 'yt_player_cache.json'
+
+	_instances = {}
+	_instances_lock = threading.Lock()
+
+	def __init__(self, cache_dir=None, max_players=3, player_id_ttl=3600, results_cache_size=256):
+		self.cache_dir = cache_dir
+		self.max_players = max_players
+		self.player_id_ttl = player_id_ttl
+		self.lock = threading.Lock()
+		self.player_code = {}
+		self.results = LRUCache(results_cache_size)
+		self.index = self.load_index()
+
+	# #################################################################################################
+
+	@classmethod
+	def get_instance(cls, cache_dir=None):
+		'''
+		Returns cache shared by all users of the same cache directory
+		'''
+		with cls._instances_lock:
+			cache = cls._instances.get(cache_dir)
+			if cache is None:
+				cache = cls(cache_dir)
+				cls._instances[cache_dir] = cache
+
+			return cache
+
+	# #################################################################################################
+
+	def _file_name(self, name):
+		return os.path.join(self.cache_dir, name)
+
+	def _player_file_name(self, player_id):
+		return self._file_name('yt_player_%s.js' % player_id)
+
+	# #################################################################################################
+
+	def load_index(self):
+		if self.cache_dir:
+			try:
+				with open(self._file_name(self.INDEX_FILE), 'r') as f:
+					return loads(f.read())
+			except:
+				pass
+
+		return { 'player_id': None, 'checked': 0, 'players': {} }
+
+	# #################################################################################################
+
+	def save_index(self):
+		if not self.cache_dir:
+			return
+
+		try:
+			tmp_name = self._file_name(self.INDEX_FILE + '.tmp')
+			with open(tmp_name, 'w') as f:
+				f.write(dumps(self.index))
+			os.rename(tmp_name, self._file_name(self.INDEX_FILE))
+		except:
+			pass
+
+	# #################################################################################################
+
+	def _player_entry(self, player_id):
+		entry = self.index['players'].get(player_id)
+		if entry is None:
+			entry = { 'used': 0, 'sts': None, 'functions': {} }
+
+			# remove the oldest players - new one is not in index yet, so it can't be removed
+			players = sorted(self.index['players'].items(), key=lambda p: p[1]['used'], reverse=True)
+			for old_id, _ in players[max(self.max_players - 1, 0):]:
+				del self.index['players'][old_id]
+				self.player_code.pop(old_id, None)
+				if self.cache_dir:
+					try:
+						os.remove(self._player_file_name(old_id))
+					except:
+						pass
+
+			self.index['players'][player_id] = entry
+
+		entry['used'] = int(time())
+		return entry
+
+	# #################################################################################################
+
+	def get_player_id(self):
+		'''
+		Returns last known player id if it was checked less then player_id_ttl seconds ago
+		'''
+		if self.index['checked'] + self.player_id_ttl > time():
+			return self.index['player_id']
+
+		return None
+
+	def set_player_id(self, player_id):
+		with self.lock:
+			self.index['player_id'] = player_id
+			self.index['checked'] = int(time())
+			self.save_index()
+
+	# #################################################################################################
+
+	def get_player_code(self, player_id):
+		code = self.player_code.get(player_id)
+		if code is None and self.cache_dir and player_id in self.index['players']:
+			try:
+				with open(self._player_file_name(player_id), 'rb') as f:
+					code = f.read().decode('utf-8')
+				self.player_code[player_id] = code
+			except:
+				pass
+
+		return code
+
+	def set_player_code(self, player_id, code):
+		with self.lock:
+			self._player_entry(player_id)
+			self.player_code[player_id] = code
+			if self.cache_dir:
+				try:
+					tmp_name = self._player_file_name(player_id) + '.tmp'
+					with open(tmp_name, 'wb') as f:
+						f.write(code.encode('utf-8'))
+					os.rename(tmp_name, self._player_file_name(player_id))
+				except:
+					pass
+
+			self.save_index()
+
+	# #################################################################################################
+
+	def get_sts(self, player_id):
+		return self.index['players'].get(player_id, {}).get('sts')
+
+	def set_sts(self, player_id, sts):
+		with self.lock:
+			self._player_entry(player_id)['sts'] = sts
+			self.save_index()
+
+	# #################################################################################################
+
+	def get_function_code(self, player_id, s_id):
+		'''
+		Returns tuple (argnames, code) of extracted function or None
+		'''
+		code = self.index['players'].get(player_id, {}).get('functions', {}).get(s_id)
+		return (code[0], code[1]) if code else None
+
+	def set_function_code(self, player_id, s_id, argnames, code):
+		with self.lock:
+			self._player_entry(player_id)['functions'][s_id] = [argnames, code]
+			self.save_index()
+
+	def invalidate_function_code(self, player_id, s_id):
+		with self.lock:
+			if self.index['players'].get(player_id, {}).get('functions', {}).pop(s_id, None) is not None:
+				self.save_index()
+
+	# #################################################################################################
+
+	def get_result(self, s_id, value):
+		return self.results.get((s_id, value))
+
+	def set_result(self, s_id, value, result):
+		self.results.put((s_id, value), result)
+
+# #################################################################################################
@@ -10,8 +10,19 @@ except:
 	# fallback for older versions
 	from time import time as monotonic
 
+import os
+import struct
 import threading
 import uuid
+from time import time
+from collections import OrderedDict
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+
+try:
+	import cPickle as pickle
+except:
+	import pickle
 
 _MARKER = object()
 # By default, expire items after 2**60 seconds. This fits into 64 bit
@@ -186,9 +197,15 @@ class ExpiringLRUCache(Cache):
 
 	The Clock algorithm is not kept strictly to improve performance, e.g. to
 	allow get() and invalidate() to work without acquiring the lock.
+
+	If stale_timeout is set, then expired entries are kept for another
+	stale_timeout seconds (hard expiry) and get() called with refresh_cbk
+	returns them instead of default and asks refresh_cbk to load fresh value.
 	"""
-	def __init__(self, size, default_timeout=_DEFAULT_TIMEOUT):
+	def __init__(self, size, default_timeout=_DEFAULT_TIMEOUT, stale_timeout=0):
 		self.default_timeout = default_timeout
+		self.stale_timeout = stale_timeout
+		self.refreshing = set()
 		size = int(size)
 		if size < 1:
 			raise ValueError('size must be >0')
@@ -203,6 +220,7 @@ class ExpiringLRUCache(Cache):
 		self.hits = 0
 		self.misses = 0
 		self.lookups = 0
+		self.stale_hits = 0
 		self.clear()
 
 	def clear(self):
@@ -224,20 +242,36 @@ class ExpiringLRUCache(Cache):
 			self.hits = 0
 			self.misses = 0
 			self.lookups = 0
+			self.stale_hits = 0
+			self.refreshing = set()
 
-	def get(self, key, default=None):
-		"""Return value for key. If not in cache or expired, return default"""
+	def get(self, key, default=None, refresh_cbk=None):
+		"""Return value for key. If not in cache or expired, return default
+
+		If refresh_cbk is set and entry expired less then stale_timeout seconds
+		ago, then stale value is returned and refresh_cbk(key) is called to
+		load new value. It's called only once until new value is put to cache.
+		"""
 		self.lookups += 1
 		try:
 			pos, val, expires = self.data[key]
 		except KeyError:
 			self.misses += 1
 			return default
-		if expires > monotonic():
+		cur_time = monotonic()
+		if expires > cur_time:
 			# cache entry still valid
 			self.hits += 1
 			self.clock_refs[pos] = True
 			return val
+		elif refresh_cbk is not None and expires + self.stale_timeout > cur_time:
+			# cache entry has expired, but it can still be used until refresh is done
+			self.stale_hits += 1
+			self.clock_refs[pos] = True
+			if key not in self.refreshing:
+				self.refreshing.add(key)
+				refresh_cbk(key)
+			return val
 		else:
 			# cache entry has expired. Make sure the space in the cache can
 			# be recycled soon.
@@ -245,6 +279,10 @@ class ExpiringLRUCache(Cache):
 			self.clock_refs[pos] = False
 			return default
 
+	def refresh_failed(self, key):
+		"""Refresh of key failed - allow next get() to start new refresh"""
+		self.refreshing.discard(key)
+
 	def put(self, key, val, timeout=None):
 		"""Add key to the cache with value val
 
@@ -260,6 +298,8 @@ class ExpiringLRUCache(Cache):
 		if timeout is None:
 			timeout = self.default_timeout
 
+		self.refreshing.discard(key)
+
 		with self.lock:
 			entry = data.get(key)
 			if entry is not None:
@@ -315,31 +355,391 @@ class ExpiringLRUCache(Cache):
 		# else: key was not in cache. Nothing to do.
 
 
+class DiskCacheStore(object):
+	""" Simple persistent key/value store with expiration times
+
+	All data are stored in one append-only file. Every record contains key, value
+	and absolute (wall clock) expiration time. Index of records is built when store
+	is opened, so only value needs to be read from disk on lookup. When file grows
+	over max_size, then it is compacted - expired and old entries are dropped.
+	Keys and values must be picklable.
+	"""
+	_HEADER = struct.Struct('>BIId') # flags, key length, value length, expiration time
+	_FLAG_VALUE = 1
+	_FLAG_DELETED = 0
+
+	def __init__(self, file_name, max_size=1024 * 1024):
+		self.file_name = file_name
+		self.max_size = max_size
+		self.lock = threading.Lock()
+		# key -> (value offset, value length, expires) ordered by write time
+		self.index = OrderedDict()
+		self.file_size = 0
+		self.load()
+
+	def load(self):
+		self.index = OrderedDict()
+		self.file_size = 0
+		hdr_size = self._HEADER.size
+
+		try:
+			with open(self.file_name, 'rb') as f:
+				pos = 0
+				while True:
+					hdr = f.read(hdr_size)
+					if len(hdr) < hdr_size:
+						break
+
+					flags, key_len, value_len, expires = self._HEADER.unpack(hdr)
+					key_data = f.read(key_len)
+					if len(key_data) < key_len:
+						break
+
+					key = pickle.loads(key_data)
+					value_offset = pos + hdr_size + key_len
+					f.seek(value_len, os.SEEK_CUR)
+					if f.tell() != value_offset + value_len:
+						break
+
+					self.index.pop(key, None)
+					if flags == self._FLAG_VALUE:
+						self.index[key] = (value_offset, value_len, expires)
+
+					pos = value_offset + value_len
+		except (IOError, OSError):
+			pos = 0
+		except Exception:
+			# broken file - start from scratch
+			self.index = OrderedDict()
+			pos = 0
+
+		try:
+			if pos == 0:
+				if os.path.exists(self.file_name):
+					os.remove(self.file_name)
+			elif os.path.getsize(self.file_name) != pos:
+				# remove incomplete record at the end of file
+				with open(self.file_name, 'r+b') as f:
+					f.truncate(pos)
+		except (IOError, OSError):
+			pass
+
+		self.file_size = pos
+
+	def _append(self, f, flags, key_data, value_data, expires):
+		offset = self.file_size
+		f.write(self._HEADER.pack(flags, len(key_data), len(value_data), expires))
+		f.write(key_data)
+		f.write(value_data)
+		value_offset = offset + self._HEADER.size + len(key_data)
+		self.file_size = value_offset + len(value_data)
+		return value_offset
+
+	def get(self, key, default=None):
+		"""Return value for key and its expiration time as tuple. If not found or expired, return (default, 0)"""
+		entry = self.index.get(key)
+		if entry is None:
+			return default, 0
+
+		value_offset, value_len, expires = entry
+		if expires <= time():
+			return default, 0
+
+		try:
+			with self.lock:
+				with open(self.file_name, 'rb') as f:
+					f.seek(value_offset)
+					value_data = f.read(value_len)
+
+			return pickle.loads(value_data), expires
+		except Exception:
+			self.index.pop(key, None)
+			return default, 0
+
+	def put(self, key, val, timeout):
+		"""Store value for key - it will expire in $timeout seconds"""
+		try:
+			key_data = pickle.dumps(key, 2)
+			value_data = pickle.dumps(val, 2)
+		except Exception:
+			# not picklable - only memory cache can be used for this entry
+			return False
+
+		expires = time() + min(timeout, _DEFAULT_TIMEOUT)
+
+		with self.lock:
+			try:
+				with open(self.file_name, 'ab') as f:
+					value_offset = self._append(f, self._FLAG_VALUE, key_data, value_data, expires)
+			except (IOError, OSError):
+				return False
+
+			self.index.pop(key, None)
+			self.index[key] = (value_offset, len(value_data), expires)
+
+			if self.file_size > self.max_size:
+				self._compact()
+
+		return True
+
+	def invalidate(self, key):
+		"""Remove key from the store"""
+		with self.lock:
+			if self.index.pop(key, None) is None:
+				return
+
+			try:
+				with open(self.file_name, 'ab') as f:
+					self._append(f, self._FLAG_DELETED, pickle.dumps(key, 2), b'', 0)
+			except (IOError, OSError):
+				pass
+
+	def clear(self):
+		"""Remove all entries from the store"""
+		with self.lock:
+			self.index = OrderedDict()
+			self.file_size = 0
+			try:
+				os.remove(self.file_name)
+			except (IOError, OSError):
+				pass
+
+	def _compact(self):
+		# keep only valid entries and drop the oldest ones, until file has at most 3/4 of max size
+		cur_time = time()
+		entries = [(k, v) for k, v in self.index.items() if v[2] > cur_time]
+		size = sum(v[1] for k, v in entries)
+		while entries and size > (self.max_size * 3) // 4:
+			size -= entries.pop(0)[1][1]
+
+		tmp_name = self.file_name + '.tmp'
+		new_index = OrderedDict()
+		self.file_size = 0
+
+		try:
+			with open(self.file_name, 'rb') as fr:
+				with open(tmp_name, 'wb') as fw:
+					for key, (value_offset, value_len, expires) in entries:
+						fr.seek(value_offset)
+						new_index[key] = (self._append(fw, self._FLAG_VALUE, pickle.dumps(key, 2), fr.read(value_len), expires), value_len, expires)
+
+			os.rename(tmp_name, self.file_name)
+			self.index = new_index
+		except Exception:
+			self.index = OrderedDict()
+			self.file_size = 0
+			for name in (tmp_name, self.file_name):
+				try:
+					os.remove(name)
+				except (IOError, OSError):
+					pass
+
+
+class PersistentExpiringLRUCache(ExpiringLRUCache):
+	""" ExpiringLRUCache with persistent second tier stored on disk
+
+	Hot entries are kept in memory (CLOCK structure), every stored entry is also
+	written to disk store, so it survives restart of enigma2 or reload of addon.
+	On memory miss, entry is loaded from disk (if it's not expired) and promoted
+	back to memory.
+	"""
+	def __init__(self, size, default_timeout=_DEFAULT_TIMEOUT, file_name=None, max_disk_size=1024 * 1024, stale_timeout=0):
+		super(PersistentExpiringLRUCache, self).__init__(size, default_timeout, stale_timeout)
+		self.disk = DiskCacheStore(file_name, max_disk_size) if file_name else None
+		self.disk_hits = 0
+
+	def get(self, key, default=None, refresh_cbk=None):
+		"""Return value for key. If not in cache or expired, return default"""
+		val = super(PersistentExpiringLRUCache, self).get(key, _MARKER, refresh_cbk)
+		if val is not _MARKER:
+			return val
+
+		if self.disk is None:
+			return default
+
+		val, expires = self.disk.get(key, _MARKER)
+		if val is _MARKER:
+			return default
+
+		self.disk_hits += 1
+		super(PersistentExpiringLRUCache, self).put(key, val, expires - time())
+		return val
+
+	def put(self, key, val, timeout=None):
+		"""Add key to the cache with value val
+
+		key will expire in $timeout seconds. Entry is stored in memory and on disk.
+		"""
+		if timeout is None:
+			timeout = self.default_timeout
+
+		super(PersistentExpiringLRUCache, self).put(key, val, timeout)
+		if self.disk is not None:
+			self.disk.put(key, val, timeout)
+
+	def invalidate(self, key):
+		"""Remove key from the cache"""
+		super(PersistentExpiringLRUCache, self).invalidate(key)
+		if self.disk is not None:
+			self.disk.invalidate(key)
+
+	def clear(self, disk=True):
+		"""Remove all entries from the cache. If disk is False, then only memory entries are removed"""
+		super(PersistentExpiringLRUCache, self).clear()
+		if disk and getattr(self, 'disk', None) is not None:
+			self.disk.clear()
+
+
+class SingleFlight(object):
+	""" Per-key request coalescing
+
+	When more callers ask for the same key at the same time, only the first
+	one really calls the function and the others wait for its result. Works
+	for callers running in threads (do()) and for Twisted callers, that work
+	with Deferreds (do_deferred()).
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.calls = {}
+		self.deferred_calls = {}
+		self.shared = 0
+
+	def do(self, key, fn, *args, **kwargs):
+		"""Call fn(*args, **kwargs) or wait for result of already running call with the same key"""
+		with self.lock:
+			call = self.calls.get(key)
+			if call is None:
+				call = { 'event': threading.Event(), 'thread': threading.current_thread(), 'result': None, 'error': None }
+				self.calls[key] = call
+				leader = True
+			else:
+				leader = False
+				self.shared += 1
+
+		if not leader:
+			if call['thread'] is threading.current_thread():
+				# recursive call with the same key from the same thread - waiting would block forever
+				return fn(*args, **kwargs)
+
+			call['event'].wait()
+			if call['error'] is not None:
+				raise call['error']
+			return call['result']
+
+		try:
+			call['result'] = fn(*args, **kwargs)
+		except Exception as e:
+			call['error'] = e
+			raise
+		finally:
+			with self.lock:
+				del self.calls[key]
+			call['event'].set()
+
+		return call['result']
+
+	def do_deferred(self, key, fn, *args, **kwargs):
+		"""Deferred version of do(). fn can return value or Deferred - returned Deferred fires with it's result"""
+		waiting = self.deferred_calls.get(key)
+		if waiting is not None:
+			self.shared += 1
+			d = Deferred()
+			waiting.append(d)
+			return d
+
+		waiting = []
+		self.deferred_calls[key] = waiting
+
+		def call_finished(result):
+			del self.deferred_calls[key]
+			for d in waiting:
+				if isinstance(result, Failure):
+					d.errback(result)
+				else:
+					d.callback(result)
+			return result
+
+		return maybeDeferred(fn, *args, **kwargs).addBoth(call_finished)
+
+	def __len__(self):
+		return len(self.calls) + len(self.deferred_calls)
+
+
 class lru_cache(object):
 	""" Decorator for LRU-cached function
 
 	timeout parameter specifies after how many seconds a cached entry should
 	be considered invalid.
+
+	disk_cache parameter specifies file, where cached entries will be persisted,
+	so they survive restart. It can be used only together with timeout and
+	arguments and return values of function must be picklable.
+
+	Concurrent calls with the same arguments are coalesced - function is called
+	only once and other callers wait for its result.
+
+	stale_timeout parameter enables stale-while-revalidate mode: for another
+	stale_timeout seconds after expiration the old value is returned immediately
+	and function is called in background to refresh it. Background refresh runs
+	using bgservice.run_task() - bgservice is taken from parameter or from
+	bgservice attribute of first argument (self of content provider's method).
+	If no bgservice is available, then refresh runs in new thread.
 	"""
 	def __init__(self,
 				 maxsize,
 				 cache=None, # cache is an arg to serve tests
 				 timeout=None,
-				 ignore_unhashable_args=False):
+				 ignore_unhashable_args=False,
+				 disk_cache=None,
+				 max_disk_size=1024 * 1024,
+				 stale_timeout=0,
+				 bgservice=None):
 		if cache is None:
 			if maxsize is None:
 				cache = UnboundedCache()
 			elif timeout is None:
 				cache = LRUCache(maxsize)
+			elif disk_cache:
+				cache = PersistentExpiringLRUCache(maxsize, default_timeout=timeout, file_name=disk_cache, max_disk_size=max_disk_size, stale_timeout=stale_timeout)
 			else:
-				cache = ExpiringLRUCache(maxsize, default_timeout=timeout)
+				cache = ExpiringLRUCache(maxsize, default_timeout=timeout, stale_timeout=stale_timeout)
 		self.cache = cache
+		self.single_flight = SingleFlight()
 		self._ignore_unhashable_args = ignore_unhashable_args
+		self._stale = bool(stale_timeout) and isinstance(cache, ExpiringLRUCache)
+		self.bgservice = bgservice
 
 	def __call__(self, func):
 		cache = self.cache
+		single_flight = self.single_flight
 		marker = _MARKER
 
+		def load_value(key, args, kwargs):
+			# cache needs to be checked once more - value could be stored by another caller in the meantime
+			val = cache.get(key, marker)
+			if val is marker:
+				val = func(*args, **kwargs)
+				cache.put(key, val)
+			return val
+
+		def refresh_value(key, args, kwargs):
+			try:
+				single_flight.do(key, load_value, key, args, kwargs)
+			except:
+				cache.refresh_failed(key)
+
+		def start_refresh(key, args, kwargs):
+			bgservice = self.bgservice
+			if bgservice is None and args:
+				bgservice = getattr(args[0], 'bgservice', None)
+
+			if bgservice is not None:
+				bgservice.run_task('cache refresh: %s' % getattr(func, '__name__', 'function'), None, refresh_value, key, args, kwargs)
+			else:
+				t = threading.Thread(target=refresh_value, args=(key, args, kwargs))
+				t.daemon = True
+				t.start()
+
 		def cached_wrapper(*args, **kwargs):
 			try:
 				key = (args, frozenset(kwargs.items())) if kwargs else args
@@ -349,10 +749,13 @@ class lru_cache(object):
 				else:
 					raise e
 			else:
-				val = cache.get(key, marker)
+				if self._stale:
+					val = cache.get(key, marker, lambda key: start_refresh(key, args, kwargs))
+				else:
+					val = cache.get(key, marker)
+
 				if val is marker:
-					val = func(*args, **kwargs)
-					cache.put(key, val)
+					val = single_flight.do(key, load_value, key, args, kwargs)
 				return val
 
 		def _maybe_copy(source, target, attr):
@@ -447,17 +850,56 @@ class CacheMaker(object):
 			self._cache[name].clear()
 
 class SimpleAutokeyExpiringCache(object):
-	def __init__(self, expire_time=60):
+	""" Simple cache with automatically generated keys
+
+	Entry expires, when it was not used for expire_time seconds. Entries are kept
+	in order of their last usage, so expired entries are always at the beginning
+	and cleanup on put doesn't need to walk through whole cache. Optionaly the
+	number of entries can be limited by max_entries - least recently used entries
+	are removed first.
+	"""
+	def __init__(self, expire_time=60, max_entries=None):
 		self.expire_time = expire_time
+		self.max_entries = max_entries
 		self.scache_key = 1
-		self.scache = {}
+		self.lock = threading.Lock()
+		# key -> (last_used, data) ordered from least recently used
+		self.data = OrderedDict()
+		self.evictions = 0
+		self.expirations = 0
+		self.hits = 0
+		self.misses = 0
+		self.lookups = 0
+
+	@property
+	def scache(self):
+		return self.data
+
+	@scache.setter
+	def scache(self, value):
+		# compatibility with code, that clears cache by setting scache = {}
+		self.clear()
+		for k, v in value.items():
+			self.put_with_key(v, k)
+
+	def clear(self):
+		"""Remove all entries from the cache"""
+		with self.lock:
+			self.data = OrderedDict()
 
 	def get(self, key, default=None):
-		data = self.scache.get(key)
-		if data:
-			data['last_used'] = int(monotonic())
-			return data['data']
-		return default
+		self.lookups += 1
+		with self.lock:
+			entry = self.data.pop(key, _MARKER)
+			if entry is _MARKER:
+				self.misses += 1
+				return default
+
+			# move entry to the end - it is the most recently used one
+			self.data[key] = (monotonic(), entry[1])
+
+		self.hits += 1
+		return entry[1]
 
 	def put(self, data):
 		key = str(self.scache_key)
@@ -465,19 +907,30 @@ class SimpleAutokeyExpiringCache(object):
 		return self.put_with_key(data, key)
 
 	def put_with_key(self, data, key):
-		cur_time = int(monotonic())
+		cur_time = monotonic()
 
-		krem = []
-		for k,v in self.scache.items():
-			if (cur_time - v['last_used']) > self.expire_time:
-				krem.append(k)
+		with self.lock:
+			cache_data = self.data
+			cache_data.pop(key, None)
+
+			# expired entries are at the beginning - remove them until first valid one is found
+			while cache_data:
+				k = next(iter(cache_data))
+				if (cur_time - cache_data[k][0]) <= self.expire_time:
+					break
+				del cache_data[k]
+				self.expirations += 1
 
-		for k in krem:
-			del self.scache[k]
+			if self.max_entries:
+				while len(cache_data) >= self.max_entries:
+					cache_data.popitem(last=False)
+					self.evictions += 1
 
-		self.scache[key] = {
-			'last_used': cur_time,
-			'data': data
-		}
+			cache_data[key] = (cur_time, data)
 
 		return key
+
+	def invalidate(self, key):
+		"""Remove key from the cache"""
+		with self.lock:
+			self.data.pop(key, None)
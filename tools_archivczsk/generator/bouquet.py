@@ -4,6 +4,7 @@ import os, base64
 import threading, requests, traceback
 from Plugins.Extensions.archivCZSK.engine import client
 from .lamedb import lameDB
+from .picons import PiconSync
 
 try:
 	from Components.ParentalControl import parentalControl
@@ -22,6 +23,54 @@ except:
 
 # #################################################################################################
 
+SKYLINK_FREQ = [ 11739, 11778, 11856, 11876, 11934, 11954, 11973, 12012, 12032, 12070, 12090, 12110, 12129, 12168, 12344, 12363 ]
+ANTIK_FREQ = [ 11055, 11094, 11231, 11283, 11324, 11471, 11554, 11595, 11637, 12605 ]
+
+def _freq_set(f_list):
+	# all frequencies in MHz, that are considered equal to frequencies from f_list
+	return frozenset(f2 + d for f2 in f_list for d in range(-4, 5))
+
+def build_best_service_index(lamedb):
+	'''
+	Creates map normalised channel name -> best service from lamedb. Preference order: 23.5E on Skylink frequency,
+	16E on Antik frequency, 23.5E, 16E, 0.8W, 19.2E and then the first one.
+	'''
+	skylink_freq = _freq_set(SKYLINK_FREQ)
+	antik_freq = _freq_set(ANTIK_FREQ)
+	position_rank = { 235: 2, 160: 3, -8: 4, 192: 5 }
+
+	def service_rank(s):
+		data = s.Transponder.Data
+		if data is None:
+			return 6
+
+		position = data.OrbitalPosition
+		if position == 235 and int(data.Frequency / 1000) in skylink_freq:
+			return 0
+		if position == 160 and int(data.Frequency / 1000) in antik_freq:
+			return 1
+
+		return position_rank.get(position, 6)
+
+	index = {}
+	for name, services in lamedb.Services.items():
+		best = None
+		best_rank = 7
+		for s in services:
+			rank = service_rank(s)
+			if rank < best_rank:
+				best = s
+				best_rank = rank
+				if rank == 0:
+					break
+
+		if best is not None:
+			index[name] = best
+
+	return index
+
+# #################################################################################################
+
 class BouquetGeneratorTemplate(object):
 
 	def __init__(self, endpoint, enable_adult=True, enable_xmlepg=False, enable_picons=False, player_name='0', user_agent=None):
@@ -34,6 +83,9 @@ class BouquetGeneratorTemplate(object):
 		self.enable_xmlepg = enable_xmlepg
 		self.enable_picons = enable_picons
 		self.player_name = player_name
+		self.lamedb_cache_file = '/tmp/archivczsk_lamedb.cache' # parsed lamedb is cached here
+		if not hasattr(self, 'picon_size'):
+			self.picon_size = None # (width, height) - if set, then downloaded picons are resized to fit in this size
 
 		# Child class must define these values
 #		self.prefix = "o2tv"
@@ -46,37 +98,11 @@ class BouquetGeneratorTemplate(object):
 	# #################################################################################################
 
 	@staticmethod
-	def download_picons(picons):
-		s = requests.Session()
-
-		def download_picon(fileout, url):
-			if not os.path.exists(fileout):
-				try:
-					r = s.get( url, timeout=5 )
-
-					if r.status_code == 200:
-						if r.headers.get('content-type','').lower() != 'image/png':
-							client.log.error("Unsupported content type %s of picon URL %s downloaded to %s" % (r.headers.get('content-type'), url, fileout))
-						else:
-							client.log.debug("Writing picon from URL %s to %s" % (url, fileout))
-							with open(fileout, 'wb') as f:
-								f.write( r.content )
-				except:
-					client.log.error(traceback.format_exc())
-					pass
-
-
-		if not os.path.exists( '/usr/share/enigma2/picon' ):
-			os.mkdir('/usr/share/enigma2/picon')
-
-		for ref, urls in picons.items():
-			fileout = '/usr/share/enigma2/picon/' + ref + '.png'
-
-			if isinstance(urls, (type(()), type([]))):
-				for url in urls:
-					download_picon( fileout, url)
-			elif urls:
-				download_picon( fileout, urls)
+	def download_picons(picons, **kwargs):
+		'''
+		Downloads new and refreshes changed picons - kwargs are passed to PiconSync
+		'''
+		return PiconSync(**kwargs).sync(picons)
 
 	# #################################################################################################
 
@@ -147,56 +173,11 @@ class BouquetGeneratorTemplate(object):
 	# #################################################################################################
 
 	def service_ref_get( self, lamedb, channel_name, player_id, channel_id ):
-
-		skylink_freq = [ 11739, 11778, 11856, 11876, 11934, 11954, 11973, 12012, 12032, 12070, 12090, 12110, 12129, 12168, 12344, 12363 ]
-		antik_freq = [ 11055, 11094, 11231, 11283, 11324, 11471, 11554, 11595, 11637, 12605 ]
-
-		def cmp_freq( f, f_list ):
-			f = int(f/1000)
-
-			for f2 in f_list:
-				if abs( f - f2) < 5:
-					return True
-
-			return False
-
 		if lamedb != None:
 			try:
-				services = lamedb.Services[ lamedb.name_normalise( channel_name ) ]
-
-				# try position 23.5E first
-				for s in services:
-					if s.Transponder.Data.OrbitalPosition == 235 and cmp_freq( s.Transponder.Data.Frequency, skylink_freq ):
-						return self.build_service_ref(s, player_id)
-
-				# then 16E
-				for s in services:
-					if s.Transponder.Data.OrbitalPosition == 160 and cmp_freq( s.Transponder.Data.Frequency, antik_freq ):
-						return self.build_service_ref(s, player_id)
-
-				for s in services:
-					if s.Transponder.Data.OrbitalPosition == 235:
-						return self.build_service_ref(s, player_id)
-
-				# then 16E
-				for s in services:
-					if s.Transponder.Data.OrbitalPosition == 160:
-						return self.build_service_ref(s, player_id)
-
-				# then 0,8W
-				for s in services:
-					if s.Transponder.Data.OrbitalPosition == -8:
-						return self.build_service_ref(s, player_id)
-
-				# then 192
-				for s in services:
-					if s.Transponder.Data.OrbitalPosition == 192:
-						return self.build_service_ref(s, player_id)
-
-				# take the first one
-				for s in services:
+				s = lamedb.get_index('best_service', build_best_service_index).get(lamedb.name_normalise(channel_name))
+				if s != None:
 					return self.build_service_ref(s, player_id)
-
 			except:
 				pass
 
@@ -263,7 +244,7 @@ class BouquetGeneratorTemplate(object):
 		if self.enable_xmlepg:
 			lamedb = None
 		else:
-			lamedb = lameDB("/etc/enigma2/lamedb")
+			lamedb = lameDB("/etc/enigma2/lamedb", self.lamedb_cache_file)
 
 		if self.player_name == "1": # gstplayer
 			player_id = "5001"
@@ -332,6 +313,6 @@ class BouquetGeneratorTemplate(object):
 		self.reload_bouquets()
 
 		if self.enable_picons:
-			threading.Thread(target=BouquetGeneratorTemplate.download_picons,args=(picons,)).start()
+			threading.Thread(target=BouquetGeneratorTemplate.download_picons,args=(picons,),kwargs={'user_agent': self.user_agent, 'picon_size': self.picon_size}).start()
 
 	# #################################################################################################
@@ -33,6 +33,7 @@ class BouquetGenerator(BouquetGeneratorTemplate):
 		self.onid = bxeg.onid
 		self.namespace = bxeg.namespace
 		self.channel_type = channel_type
+		self.picon_size = bxeg.picon_size
 		BouquetGeneratorTemplate.__init__(self, bxeg.http_endpoint, bxeg.get_setting('enable_adult'), bxeg.get_setting('enable_xmlepg'), bxeg.get_setting('enable_picons'), bxeg.get_setting('player_name'), bxeg.user_agent)
 
 	# #################################################################################################
@@ -57,6 +58,9 @@ class XmlEpgGenerator(XmlEpgGeneratorTemplate):
 		self.tid = bxeg.tid
 		self.onid = bxeg.onid
 		self.namespace = bxeg.namespace
+		self.metrics_name = bxeg.cp.name
+		self.epg_fetch_workers = bxeg.epg_fetch_workers
+		self.epg_fetch_rate = bxeg.epg_fetch_rate
 		XmlEpgGeneratorTemplate.__init__(self, log_info=bxeg.cp.log_info, log_error=bxeg.cp.log_error)
 
 	# #################################################################################################
@@ -89,6 +93,9 @@ class EnigmaEpgGenerator(EnigmaEpgGeneratorTemplate):
 		self.tid = bxeg.tid
 		self.onid = bxeg.onid
 		self.namespace = bxeg.namespace
+		self.prefix = bxeg.prefix
+		self.epg_fetch_workers = bxeg.epg_fetch_workers
+		self.epg_fetch_rate = bxeg.epg_fetch_rate
 		EnigmaEpgGeneratorTemplate.__init__(self, log_info=bxeg.cp.log_info, log_error=bxeg.cp.log_error)
 
 	# #################################################################################################
@@ -103,9 +110,15 @@ class EnigmaEpgGenerator(EnigmaEpgGeneratorTemplate):
 
 	# #################################################################################################
 
+	def save_export_progress(self, cks):
+		self.bxeg.cp.save_cached_data('enigmaepg', cks)
+
+	# #################################################################################################
+
 	def run(self, force):
 		cks = self.bxeg.cp.load_cached_data('enigmaepg')
-		if EnigmaEpgGeneratorTemplate.run(self, cks, force, self.bxeg.get_setting('xmlepg_days')):
+		if EnigmaEpgGeneratorTemplate.run(self, cks, force, self.bxeg.get_setting('xmlepg_days')) or 'export_progress' in cks:
+			# save also progress of unfinished export, so it can be resumed next time
 			self.bxeg.cp.save_cached_data('enigmaepg', cks)
 
 # #################################################################################################
@@ -144,6 +157,18 @@ class BouquetXmlEpgGenerator(object):
 			# set settings names that are chcecked if rebuild of xmlepg is needed
 			self.xmlepg_settings_names = ('xmlepg_dir', 'xmlepg_days')
 
+		if not hasattr(self, 'epg_fetch_workers'):
+			# how many channels can be fetched in parallel by EPG generators - providers with thread safe get_epg() can set more
+			self.epg_fetch_workers = 1
+
+		if not hasattr(self, 'epg_fetch_rate'):
+			# max. number of channels fetched per second by EPG generators (0 = unlimited)
+			self.epg_fetch_rate = 0
+
+		if not hasattr(self, 'picon_size'):
+			# (width, height) - if set, then downloaded picons are resized to fit in this size (needs PIL)
+			self.picon_size = None
+
 		# if any of login settings names changes, then it will force bouquet and xmlepg rebuild
 		self.login_settings_names = login_settings_names
 		self.channel_types = channel_types       # list of enabled channel types
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import sys, traceback
-from time import time
+from time import time, sleep
+from .epgfetch import EpgFetcher, RateLimiter
 
 PY2 = sys.version_info[0] == 2
 
+if PY2:
+	def _text(s):
+		return str(s).encode('utf-8')
+else:
+	_text = str
+
 try:
 	from enigma import eEPGCache
 except:
@@ -18,23 +25,44 @@ def _log_dummy(message):
 
 class EnigmaEpgGeneratorTemplate(object):
 
-	def __init__(self, log_info=None, log_error=None):
+	def __init__(self, log_info=None, log_error=None, epgcache=None):
 		# configuration to make this class little bit reusable also in other addons
 		self.data_valid_time = ((20 * 3600) - 60) # refresh data every 20 hours by default
 		self.log_info = log_info if log_info else _log_dummy
 		self.log_error = log_error if log_error else _log_dummy
 
-		if eEPGCache is not None:
-			self.epgcache = eEPGCache.getInstance()
-
-			if hasattr(self.epgcache, 'importEvent'):
-				self.import_event = self.__import_event1
-			elif hasattr(self.epgcache, 'importEvents'):
-				self.import_event = self.__import_event2
-			else:
-				raise Exception("No enigma2 interface for importing EPG events found")
+		# parameters of parallel EPG fetching - child class can set them before calling this constructor
+		if not hasattr(self, 'epg_fetch_workers'):
+			self.epg_fetch_workers = 1    # max. number of channels fetched in parallel (get_epg() needs to be thread safe for more)
+		if not hasattr(self, 'epg_fetch_rate'):
+			self.epg_fetch_rate = 0       # max. number of channels fetched per second (0 = unlimited)
+		if not hasattr(self, 'epg_channel_timeout'):
+			self.epg_channel_timeout = 120 # skip channel if fetching of it's EPG takes more seconds
+
+		# parameters of import to enigma's EPG cache
+		if not hasattr(self, 'epg_import_batch_size'):
+			self.epg_import_batch_size = 500     # max. number of events imported by one call
+		if not hasattr(self, 'epg_import_time_slice'):
+			self.epg_import_time_slice = 0.1     # import continuously max. this number of seconds ...
+		if not hasattr(self, 'epg_import_pause'):
+			self.epg_import_pause = 0.02         # ... and then make a pause, so other threads (reactor) can run
+		if not hasattr(self, 'epg_export_save_interval'):
+			self.epg_export_save_interval = 10   # save progress of export after each this number of exported channels
+
+		if epgcache is None:
+			if eEPGCache is None:
+				raise Exception("No enigma2 eEPGCache interface found")
+
+			epgcache = eEPGCache.getInstance()
+
+		self.epgcache = epgcache
+
+		if hasattr(self.epgcache, 'importEvent'):
+			self.import_events = self.__import_events1
+		elif hasattr(self.epgcache, 'importEvents'):
+			self.import_events = self.__import_events2
 		else:
-			raise Exception("No enigma2 eEPGCache interface found")
+			raise Exception("No enigma2 interface for importing EPG events found")
 
 		# Child class must define these values
 #		self.sid_start = 0xE000
@@ -45,38 +73,61 @@ class EnigmaEpgGeneratorTemplate(object):
 
 	# #################################################################################################
 
-	def __import_event1(self, service, events):
-		self.epgcache.importEvent(service, (events,))
+	def __import_events1(self, service, events):
+		self.epgcache.importEvent(service, events)
 
 	# #################################################################################################
 
-	def __import_event2(self, service, events):
-		self.epgcache.importEvents([service], (events,))
+	def __import_events2(self, service, events):
+		self.epgcache.importEvents([service], events)
 
 	# #################################################################################################
 
 	def run(self, cks, force=False, xmlepg_days=5):
+		'''
+		Exports EPG to enigma's EPG cache. Progress of export is stored in cks, so when export fails, then next run continues
+		with channels not exported yet. Returns True when export was finished - cks needs to be saved also when
+		cks contains 'export_progress' (unfinished export). During export cks is periodically passed to
+		save_export_progress(), so progress is not lost when enigma2 is restarted.
+		'''
 		last_export = cks.get('last_export', 0)
 
 		if not force and (last_export + self.data_valid_time) >= time():
 			# we have exported data less then 20 hours
 			return False
 
+		progress = cks.get('export_progress')
+		if force or not progress or (progress['started'] + self.data_valid_time) < time():
+			progress = { 'started': int(time()), 'done': [] }
+		else:
+			self.log_info("Resuming EPG export - %d channels already exported" % len(progress['done']))
+
+		cks['export_progress'] = progress
+
 		# time to generate new XML EPG file
 		try:
 			gen_time_start = time()
-			self.start_epg_export(xmlepg_days)
+			self.start_epg_export(xmlepg_days, progress['done'], lambda: self.save_export_progress(cks))
 			self.log_info("EPG exported in %d seconds" % int(time() - gen_time_start))
 		except Exception as e:
 			self.log_error("Something's failed by exporting epg")
 			self.log_error(traceback.format_exc())
 			return False
 
+		del cks['export_progress']
 		cks['last_export'] = int(time())
 		return True
 
 	# #################################################################################################
 
+	def save_export_progress(self, cks):
+		'''
+		Implement this to persist cks with progress of unfinished export
+		'''
+		pass
+
+	# #################################################################################################
+
 	def get_channels(self):
 		'''
 		Tou need to implement this to get list of channels included in XML-EPG file
@@ -111,36 +162,96 @@ class EnigmaEpgGeneratorTemplate(object):
 
 	# #################################################################################################
 
-	def start_epg_export(self, days):
+	def convert_event(self, event):
+		start = self.to_utc(event['start'])
+		stop = self.to_utc(event['end'])
+
+		return (
+			int(start),                           # UTC start timestamp
+			int(stop - start),                    # duration in seconds
+			_text(event['title']),                # title
+			_text(event.get('subtitle') or ''),   # subtitle
+			_text(event.get('desc') or ''),       # long description
+			0,                                    # category number
+		)
+
+	# #################################################################################################
+
+	def convert_events(self, events):
+		'''
+		Converts list of event maps to list of tuples used by enigma's EPG cache
+		'''
+		convert_event = self.convert_event
+		try:
+			# whole list is converted at once - in most cases all events are OK
+			return [convert_event(e) for e in events]
+		except:
+			pass
+
+		# some event is broken - convert them one by one and skip the bad ones
+		ret = []
+		for event in events:
+			try:
+				ret.append(self.convert_event(event))
+			except:
+				self.log_error(traceback.format_exc())
+
+		return ret
+
+	# #################################################################################################
+
+	def import_channel_events(self, serviceref, epg_events, slice_state):
+		'''
+		Imports events in batches of epg_import_batch_size. After each epg_import_time_slice seconds of continuous import
+		makes a pause, so enigma's EPG cache (which holds GIL) doesn't block other threads for too long.
+		'''
+		batch_size = self.epg_import_batch_size
+		for i in range(0, len(epg_events), batch_size):
+			self.import_events(serviceref, epg_events[i:i + batch_size])
+
+			if (time() - slice_state['start']) >= self.epg_import_time_slice:
+				sleep(self.epg_import_pause)
+				slice_state['start'] = time()
+
+	# #################################################################################################
+
+	def start_epg_export(self, days, done=None, progress_cbk=None):
+		'''
+		Exports EPG of all channels. IDs of exported channels are appended to done list and channels already
+		present in this list are skipped. progress_cbk is called after each epg_export_save_interval exported channels.
+		'''
 		fromts = int(time())
 		tots = fromts + (int(days) * 86400)
 
-		for channel in self.get_channels():
-			self.log_info("Exporting EPG for channel: %s" % channel['name'])
+		if done is None:
+			done = []
+
+		fetcher = EpgFetcher(self.get_epg, self.epg_fetch_workers, RateLimiter.get_instance(getattr(self, 'prefix', self.__class__.__name__), self.epg_fetch_rate), self.epg_channel_timeout, self.log_error)
+
+		done_set = set(done)
+		channels = [ch for ch in self.get_channels() if str(ch['id']) not in done_set]
+		slice_state = { 'start': time() }
+
+		for channel, events, error, duration in fetcher.fetch(channels, fromts, tots):
+			if error is not None:
+				self.log_error("Failed to get EPG for channel %s: %s" % (channel['name'], str(error)))
+				continue
+
+			self.log_info("EPG for channel %s fetched in %.2fs (%d events)" % (channel['name'], duration, len(events)))
 
 			serviceref = '1:0:1:%X:%X:%X:%X:0:0:0:http%%3a//' % (self.sid_start + channel['id'], self.tid, self.onid, self.namespace)
 
-			for event in self.get_epg(channel, fromts, tots):
-				try:
-					start = self.to_utc(event['start'])
-					stop = self.to_utc(event['end'])
-					title = str(event['title'])
-					subtitle = str(event.get('subtitle') or '')
-					desc = str(event.get('desc') or '')
-
-					epg_data = (
-						int(start),                                     # UTC start timestamp
-						int(stop - start),                              # duration in seconds
-						title.encode('utf-8') if PY2 else title,        # title
-						subtitle.encode('utf-8') if PY2 else subtitle,  # subtitle
-						desc.encode('utf-8') if PY2 else desc,          # long description
-						0,                                              # category number
-					)
-
-					self.import_event(serviceref, epg_data)
+			try:
+				self.import_channel_events(serviceref, self.convert_events(events), slice_state)
+			except:
+				self.log_error(traceback.format_exc())
+				continue
 
+			done.append(str(channel['id']))
+			if progress_cbk and len(done) % self.epg_export_save_interval == 0:
+				try:
+					progress_cbk()
 				except:
 					self.log_error(traceback.format_exc())
-					pass
 
 	# #################################################################################################
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+import threading, traceback
+from time import time, sleep
+
+try:
+	from Queue import Queue
+except:
+	from queue import Queue
+
+# #################################################################################################
+
+class RateLimiter(object):
+	'''
+	Simple rate limiter shared by all workers - allows max. rate calls per second
+	'''
+	_instances = {}
+	_instances_lock = threading.Lock()
+
+	def __init__(self, rate):
+		self.interval = 1.0 / rate if rate else 0
+		self.next_time = 0
+		self.lock = threading.Lock()
+
+	@classmethod
+	def get_instance(cls, name, rate):
+		'''
+		Returns rate limiter shared by all users with the same name (usualy name of provider)
+		'''
+		with cls._instances_lock:
+			limiter = cls._instances.get(name)
+			if limiter is None or limiter.interval != (1.0 / rate if rate else 0):
+				limiter = cls(rate)
+				cls._instances[name] = limiter
+
+			return limiter
+
+	def acquire(self):
+		if not self.interval:
+			return
+
+		with self.lock:
+			cur_time = time()
+			wait_time = self.next_time - cur_time
+			self.next_time = max(cur_time, self.next_time) + self.interval
+
+		if wait_time > 0:
+			sleep(wait_time)
+
+# #################################################################################################
+
+class EpgFetcher(object):
+	'''
+	Fetches EPG for list of channels using pool of worker threads. Results are returned in the same order as channels
+	were provided. Failing channel returns no events and slow channel is skipped after channel_timeout seconds, so they
+	don't stop processing of the others.
+
+	get_epg_cbk(channel, fromts, tots) - function that returns list (or generator) of events for channel
+	workers - max. number of channels processed in parallel
+	rate_limiter - RateLimiter object used to limit number of get_epg_cbk calls per second
+	'''
+	def __init__(self, get_epg_cbk, workers=1, rate_limiter=None, channel_timeout=120, log_error=None):
+		self.get_epg_cbk = get_epg_cbk
+		self.workers = max(1, int(workers))
+		self.rate_limiter = rate_limiter
+		self.channel_timeout = channel_timeout
+		self.log_error = log_error
+
+	# #################################################################################################
+
+	def _load_channel(self, channel, fromts, tots):
+		if self.rate_limiter:
+			self.rate_limiter.acquire()
+
+		start = time()
+		try:
+			# get_epg() is usualy generator, so data are really loaded here
+			events = list(self.get_epg_cbk(channel, fromts, tots))
+			error = None
+		except Exception as e:
+			events = None
+			error = e
+			if self.log_error:
+				self.log_error(traceback.format_exc())
+
+		return events, error, time() - start
+
+	# #################################################################################################
+
+	def fetch(self, channels, fromts, tots):
+		'''
+		Generator, that yields tuples (channel, events, error, duration) in the same order as channels.
+		On error events is None and error contains exception.
+		'''
+		channels = list(channels)
+
+		if self.workers == 1 and not self.channel_timeout:
+			# no need to create any threads
+			for channel in channels:
+				events, error, duration = self._load_channel(channel, fromts, tots)
+				yield channel, events, error, duration
+			return
+
+		results = {}
+		cond = threading.Condition()
+		tasks = Queue()
+		# workers are not allowed to go too much ahead of consumer - it limits memory usage
+		window = threading.Semaphore(self.workers * 2)
+		state = { 'stop': False, 'skipped': set() }
+		threads = []
+
+		def worker():
+			while True:
+				# place in window must be taken before the task - tasks are then taken in the same order as
+				# consumer waits for them, so the one it waits for always has a place in window
+				window.acquire()
+				item = tasks.get()
+				if item is None:
+					window.release()
+					break
+
+				i, channel = item
+				if state['stop']:
+					result = (None, Exception("Fetching stopped"), 0)
+				elif i in state['skipped']:
+					# consumer gave up waiting before this channel was even started
+					result = None
+				else:
+					result = self._load_channel(channel, fromts, tots)
+
+				with cond:
+					if i in state['skipped']:
+						# timed out channel was already yielded - drop late result and exit, because consumer
+						# started new worker in place of this one
+						break
+
+					results[i] = result
+					cond.notify_all()
+
+		def start_worker():
+			t = threading.Thread(target=worker)
+			t.daemon = True
+			t.start()
+			threads.append(t)
+
+		for i in range(min(self.workers, len(channels))):
+			start_worker()
+
+		for i, channel in enumerate(channels):
+			tasks.put((i, channel))
+
+		for t in threads:
+			tasks.put(None)
+
+		try:
+			for i, channel in enumerate(channels):
+				deadline = time() + self.channel_timeout if self.channel_timeout else None
+				with cond:
+					while i not in results:
+						if deadline is None:
+							cond.wait()
+						else:
+							remaining = deadline - time()
+							if remaining <= 0:
+								break
+							cond.wait(remaining)
+
+					result = results.pop(i, None)
+					if result is None:
+						state['skipped'].add(i)
+
+				window.release()
+
+				if result is None:
+					# worker processing skipped channel will drop its result and exit - replace it by new one,
+					# so slow channel doesn't block the rest
+					start_worker()
+					result = (None, Exception("Timeout"), self.channel_timeout)
+					if self.log_error:
+						self.log_error("Timeout by fetching EPG for channel %s - skipping" % channel.get('name'))
+
+				yield (channel,) + result
+		finally:
+			state['stop'] = True
+			# unblock workers waiting for free place in window
+			for t in list(threads):
+				window.release()
+
+# #################################################################################################
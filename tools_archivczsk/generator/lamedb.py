@@ -1,21 +1,40 @@
 # -*- coding: utf-8 -*-
-import re, io, os, json
+import re, io, os, json, threading
+try:
+	import cPickle as pickle
+except:
+	import pickle
+
 from ..string_utils import strip_accents
 
-def channel_name_normalise(name):
+# version of format of parsed lamedb cache file
+LAMEDB_CACHE_VERSION = 1
+
+def get_channel_mapping_file():
+	try:
+		from Components.config import config
+		return os.path.join(config.plugins.archivCZSK.dataPath.value, 'channel_mapping.json')
+	except:
+		return None
+
+def load_channel_name_mapping():
 	name_mapping = {
 		'natgeo': 'nationalgeographic',
 		'id': 'investigationdiscovery',
 	}
 
 	try:
-		from Components.config import config
-
-		with open(os.path.join(config.plugins.archivCZSK.dataPath.value, 'channel_mapping.json'), 'r') as f:
+		with open(get_channel_mapping_file(), 'r') as f:
 			name_mapping.update(json.load(f))
 	except:
 		pass
 
+	return name_mapping
+
+def channel_name_normalise(name, name_mapping=None):
+	if name_mapping is None:
+		name_mapping = load_channel_name_mapping()
+
 	name = strip_accents(name).lower()
 
 	name = name.replace("television", "tv")
@@ -40,7 +59,8 @@ def channel_name_normalise(name):
 	name = name.replace("&", " and ").replace("'", "").replace(".", "").replace(" ", "")
 	return name_mapping.get(name, name)
 
-class TransponderS():
+class TransponderS(object):
+	__slots__ = ('Frequency', 'SymbolRateBPS', 'Polarization', 'FEC', 'OrbitalPosition', 'Inversion', 'Flags', 'System', 'Modulation', 'Rolloff', 'Pilot')
 
 	def __init__(self):
 		self.Frequency = 0x0  # In Hertz
@@ -83,7 +103,8 @@ class TransponderS():
 			raise
 
 
-class Transponder():
+class Transponder(object):
+	__slots__ = ('DVBNameSpace', 'TransportStreamID', 'OriginalNetworkID', 'Type', 'Data')
 
 	def __init__(self):
 		self.DVBNameSpace = 0x0
@@ -111,7 +132,8 @@ class Transponder():
 				self.Data.ReadData(DataLine.group(2))
 
 
-class Service():
+class Service(object):
+	__slots__ = ('ServiceID', 'ServiceType', 'ServiceNumber', 'Transponder', 'ChannelName', 'Provider')
 
 	def __init__(self):
 		self.ServiceID = 0x0
@@ -140,14 +162,24 @@ class Service():
 		self.Provider = Line
 
 
-class lameDB():
+class lameDB(object):
+	'''
+	Parser of enigma's lamedb file. Services are indexed by normalised channel name. Parsed data are shared by all
+	instances in process and if cache_file is set, then also stored to disk - both are reused until lamedb (or channel
+	name mapping) file changes.
+	'''
+	_loaded = {} # path -> (cache key, (Transponders, TranspondersIndex, Services), Indexes)
+	_loaded_lock = threading.Lock()
 
-	def __init__(self, Path):
+	def __init__(self, Path, cache_file=None):
+		self.name_mapping = load_channel_name_mapping()
 		if Path == None:
 			return
 		self.Transponders = []
+		self.TranspondersIndex = {} # (namespace, tsid, onid) -> Transponder
 		self.Services = {}
-		self.Open(Path)
+		self.Indexes = {} # indexes built from services using get_index()
+		self.Open(Path, cache_file)
 
 	def getOrbitals(self):
 		data = set()
@@ -156,13 +188,87 @@ class lameDB():
 
 		return list(data)
 
-	def Open(self, Path):
+	def _get_cache_key(self, Path):
+		try:
+			st = os.stat(Path)
+		except:
+			return None
+
+		try:
+			mst = os.stat(get_channel_mapping_file())
+			mapping_key = (mst.st_mtime, mst.st_size)
+		except:
+			mapping_key = None
+
+		return (LAMEDB_CACHE_VERSION, st.st_mtime, st.st_size, mapping_key)
+
+	def _load_cache(self, Path, cache_key, cache_file):
+		with lameDB._loaded_lock:
+			loaded = lameDB._loaded.get(Path)
+
+		if loaded and loaded[0] == cache_key:
+			self.Indexes = loaded[2]
+			return loaded[1]
+
+		if not cache_file:
+			return None
+
+		try:
+			with open(cache_file, 'rb') as f:
+				data = pickle.load(f)
+
+			if data[0] == cache_key:
+				return data[1]
+		except:
+			pass
+
+		return None
+
+	def _save_cache(self, cache_key, cache_file):
 		try:
-			self._file = open(Path, encoding='utf-8', mode="r", errors='ignore')
+			tmp_file = cache_file + '.tmp'
+			with open(tmp_file, 'wb') as f:
+				pickle.dump((cache_key, (self.Transponders, self.TranspondersIndex, self.Services)), f, pickle.HIGHEST_PROTOCOL)
+			os.rename(tmp_file, cache_file)
 		except:
-			self._file = io.open(Path, encoding='utf-8', mode="r", errors='ignore')
+			pass
+
+	def Open(self, Path, cache_file=None):
+		cache_key = self._get_cache_key(Path)
+
+		if cache_key:
+			data = self._load_cache(Path, cache_key, cache_file)
+			if data:
+				self.Transponders, self.TranspondersIndex, self.Services = data
+				if not self.Indexes:
+					# loaded from disk cache - share it in process
+					with lameDB._loaded_lock:
+						lameDB._loaded[Path] = (cache_key, data, self.Indexes)
+				return
+
+		with io.open(Path, encoding='utf-8', mode="r", errors='ignore') as self._file:
+			self._read()
+
+		self._file = None
 
-		self._read()
+		if cache_key:
+			with lameDB._loaded_lock:
+				lameDB._loaded[Path] = (cache_key, (self.Transponders, self.TranspondersIndex, self.Services), self.Indexes)
+
+			if cache_file:
+				self._save_cache(cache_key, cache_file)
+
+	def get_index(self, name, build_fn):
+		'''
+		Returns index created from loaded data by build_fn(lamedb). Index is built only once and then shared by all
+		instances using the same loaded data.
+		'''
+		index = self.Indexes.get(name)
+		if index is None:
+			index = build_fn(self)
+			self.Indexes[name] = index
+
+		return index
 
 	def _read(self):
 		self._checkheader()
@@ -192,18 +298,22 @@ class lameDB():
 			transponder.ReadData(self._file.readline().strip())
 
 			self.Transponders.append(transponder)
+			# keep first transponder for duplicate keys - same as original linear lookup did
+			self.TranspondersIndex.setdefault((transponder.DVBNameSpace, transponder.TransportStreamID, transponder.OriginalNetworkID), transponder)
 
 			if self._file.readline().strip() != '/':
 				raise
 
 	def name_normalise(self, name):
-		return channel_name_normalise(name)
+		return channel_name_normalise(name, self.name_mapping)
 
 	def _readServiceSection(self):
 		transpondersLine = self._file.readline().strip()
 		if transpondersLine != 'services':
 			raise
 
+		transponders_index = self.TranspondersIndex
+
 		while True:
 			Line = self._file.readline().strip()
 			if Line == 'end':
@@ -216,10 +326,7 @@ class lameDB():
 			service.ReadChannelName(self._file.readline().strip())
 			service.ReadProvider(self._file.readline().strip())
 
-			for transponder in self.Transponders:
-				if transponder.DVBNameSpace == DVBNameSpace and transponder.TransportStreamID == TransportStreamID and transponder.OriginalNetworkID == OriginalNetworkID:
-					service.Transponder = transponder
-					break
+			service.Transponder = transponders_index.get((DVBNameSpace, TransportStreamID, OriginalNetworkID))
 
 			if service.Transponder == None:
 				continue
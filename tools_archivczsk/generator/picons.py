@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+import os, io, json, threading, traceback, requests
+from time import time
+from Plugins.Extensions.archivCZSK.engine import client
+
+try:
+	from Queue import Queue
+except:
+	from queue import Queue
+
+try:
+	from PIL import Image
+except:
+	Image = None
+
+# #################################################################################################
+
+PICON_DIR = '/usr/share/enigma2/picon'
+MANIFEST_FILE = '.archivczsk_picons.json'
+
+# manifest is shared by all addons - lock it when it's updated
+_manifest_lock = threading.Lock()
+
+# #################################################################################################
+
+class PiconSync(object):
+	'''
+	Downloads picons in parallel. Already downloaded picons are revalidated using conditional GET requests (ETag and
+	Last-Modified values are stored in manifest file in picon directory), so changed picons are refreshed and
+	unchanged ones are not downloaded again. Files are written to temporary file and then atomicaly renamed.
+
+	picon_dir - destination directory
+	workers - max. number of parallel downloads
+	revalidate_interval - picons checked less then this number of seconds ago are skipped
+	picon_size - if set to (width, height) and PIL is available, then picons are resized to fit in this size
+	'''
+	def __init__(self, picon_dir=PICON_DIR, workers=4, timeout=5, revalidate_interval=24 * 3600, picon_size=None, user_agent=None):
+		self.picon_dir = picon_dir
+		self.workers = max(1, int(workers))
+		self.timeout = timeout
+		self.revalidate_interval = revalidate_interval
+		self.picon_size = picon_size
+		self.user_agent = user_agent
+		self.manifest_file = os.path.join(picon_dir, MANIFEST_FILE)
+		self.manifest = {}
+		self.lock = threading.Lock()
+		self.stats = {}
+
+	# #################################################################################################
+
+	def load_manifest(self):
+		try:
+			with open(self.manifest_file, 'r') as f:
+				return json.load(f)
+		except:
+			return {}
+
+	def save_manifest(self, updates):
+		with _manifest_lock:
+			# other addon could update manifest in the meantime
+			manifest = self.load_manifest()
+			manifest.update(updates)
+
+			try:
+				tmp_file = self.manifest_file + '.tmp'
+				with open(tmp_file, 'w') as f:
+					json.dump(manifest, f)
+				os.rename(tmp_file, self.manifest_file)
+			except:
+				client.log.error("Failed to save picons manifest: %s" % traceback.format_exc())
+
+	# #################################################################################################
+
+	def inc_stat(self, name, value=1):
+		with self.lock:
+			self.stats[name] = self.stats.get(name, 0) + value
+
+	# #################################################################################################
+
+	def process_image(self, data):
+		if not self.picon_size or Image is None:
+			return data
+
+		try:
+			img = Image.open(io.BytesIO(data))
+			if img.size[0] <= self.picon_size[0] and img.size[1] <= self.picon_size[1]:
+				return data
+
+			img.thumbnail(self.picon_size, Image.LANCZOS if hasattr(Image, 'LANCZOS') else Image.ANTIALIAS)
+			out = io.BytesIO()
+			img.save(out, 'PNG', optimize=True)
+			return out.getvalue()
+		except:
+			client.log.error("Failed to resize picon: %s" % traceback.format_exc())
+			return data
+
+	# #################################################################################################
+
+	def write_file(self, file_name, data):
+		tmp_file = file_name + '.tmp'
+		with open(tmp_file, 'wb') as f:
+			f.write(data)
+		os.rename(tmp_file, file_name)
+
+	# #################################################################################################
+
+	def download_picon(self, session, file_name, url, updates):
+		'''
+		Downloads or revalidates one picon. Returns True if picon is up to date.
+		Existing picons without manifest entry are adopted only when they have the same content as downloaded ones,
+		otherwise they are kept untouched (they were created by user or by other tool).
+		'''
+		fileout = os.path.join(self.picon_dir, file_name)
+		entry = self.manifest.get(file_name)
+		file_exists = os.path.exists(fileout)
+
+		if file_exists and entry and entry.get('foreign'):
+			self.inc_stat('skipped')
+			return True
+
+		headers = {}
+		if file_exists and entry and entry.get('url') == url:
+			if entry.get('etag'):
+				headers['If-None-Match'] = entry['etag']
+			if entry.get('last_modified'):
+				headers['If-Modified-Since'] = entry['last_modified']
+
+		r = session.get(url, headers=headers, timeout=self.timeout)
+
+		if r.status_code == 304:
+			self.inc_stat('not_modified')
+		elif r.status_code == 200:
+			if r.headers.get('content-type','').lower() != 'image/png':
+				client.log.error("Unsupported content type %s of picon URL %s downloaded to %s" % (r.headers.get('content-type'), url, fileout))
+				return False
+
+			data = self.process_image(r.content)
+			if file_exists and not entry:
+				with open(fileout, 'rb') as f:
+					old_data = f.read()
+
+				if old_data != data and old_data != r.content:
+					client.log.debug("Picon %s has no manifest entry and differs from URL %s - keeping it" % (fileout, url))
+					updates[file_name] = { 'url': url, 'foreign': True, 'checked': int(time()) }
+					self.inc_stat('skipped')
+					return True
+
+				self.inc_stat('not_modified')
+			else:
+				client.log.debug("Writing picon from URL %s to %s" % (url, fileout))
+				self.write_file(fileout, data)
+				self.inc_stat('downloaded')
+				self.inc_stat('downloaded_bytes', len(r.content))
+		else:
+			return False
+
+		updates[file_name] = {
+			'url': url,
+			'etag': r.headers.get('etag') or (entry or {}).get('etag'),
+			'last_modified': r.headers.get('last-modified') or (entry or {}).get('last_modified'),
+			'checked': int(time()),
+		}
+		return True
+
+	# #################################################################################################
+
+	def worker(self, tasks, updates):
+		session = requests.Session()
+		if self.user_agent:
+			session.headers.update({ 'User-Agent': self.user_agent })
+
+		while True:
+			item = tasks.get()
+			if item is None:
+				break
+
+			file_name, urls = item
+			for url in urls:
+				try:
+					if self.download_picon(session, file_name, url, updates):
+						break
+				except:
+					client.log.error(traceback.format_exc())
+			else:
+				self.inc_stat('failed')
+
+	# #################################################################################################
+
+	def sync(self, picons):
+		'''
+		Synchronises picons. picons is a map service reference (with _ instead of :) -> url or list of urls, that are
+		tried in this order. Returns statistics.
+		'''
+		self.stats = { 'downloaded': 0, 'downloaded_bytes': 0, 'not_modified': 0, 'skipped': 0, 'failed': 0 }
+
+		if not os.path.exists(self.picon_dir):
+			os.mkdir(self.picon_dir)
+
+		self.manifest = self.load_manifest()
+		updates = {}
+		tasks = Queue()
+		cur_time = time()
+
+		for ref, urls in picons.items():
+			if isinstance(urls, (type(()), type([]))):
+				urls = [u for u in urls if u]
+			elif urls:
+				urls = [urls]
+			else:
+				continue
+
+			file_name = ref + '.png'
+			entry = self.manifest.get(file_name)
+			if entry and entry.get('url') in urls and (entry.get('checked', 0) + self.revalidate_interval) > cur_time and os.path.exists(os.path.join(self.picon_dir, file_name)):
+				# checked recently
+				self.stats['skipped'] += 1
+				continue
+
+			tasks.put((file_name, urls))
+
+		threads = []
+		for i in range(min(self.workers, tasks.qsize())):
+			t = threading.Thread(target=self.worker, args=(tasks, updates,))
+			t.daemon = True
+			t.start()
+			threads.append(t)
+			tasks.put(None)
+
+		for t in threads:
+			t.join()
+
+		if updates:
+			self.save_manifest(updates)
+
+		client.log.info("Picons synchronised: %d downloaded (%d bytes), %d not modified, %d skipped, %d failed" % (self.stats['downloaded'], self.stats['downloaded_bytes'], self.stats['not_modified'], self.stats['skipped'], self.stats['failed']))
+		return self.stats
+
+# #################################################################################################
@@ -7,10 +7,11 @@ except:
 	import pickle
 
 from time import time
-from datetime import datetime
-from xml.sax.saxutils import escape
 from hashlib import md5
 from ..string_utils import strip_accents
+from ..metrics import metrics
+from .epgfetch import EpgFetcher, RateLimiter
+from .xmltv import XmlTvWriter
 
 # #################################################################################################
 
@@ -41,6 +42,9 @@ EPGLOAD_SOURCES_CONTENT = '''<?xml version="1.0" encoding="utf-8"?>
 </sources>
 '''
 
+# version of format of file with stored EPG events
+EPG_STORE_VERSION = 1
+
 # #################################################################################################
 
 def _log_dummy(message):
@@ -55,9 +59,27 @@ class XmlEpgGeneratorTemplate(object):
 		self.data_mtime = 0
 		self.log_info = log_info if log_info else _log_dummy
 		self.log_error = log_error if log_error else _log_dummy
+		if not getattr(self, 'metrics_name', None):
+			self.metrics_name = self.prefix
+
+		# parameters of parallel EPG fetching - child class can set them before calling this constructor
+		if not hasattr(self, 'epg_fetch_workers'):
+			self.epg_fetch_workers = 1    # max. number of channels fetched in parallel (get_epg() needs to be thread safe for more)
+		if not hasattr(self, 'epg_fetch_rate'):
+			self.epg_fetch_rate = 0       # max. number of channels fetched per second (0 = unlimited)
+		if not hasattr(self, 'epg_channel_timeout'):
+			self.epg_channel_timeout = 120 # skip channel if fetching of it's EPG takes more seconds
+		if not hasattr(self, 'epg_refresh_window'):
+			self.epg_refresh_window = 6 * 3600 # already stored events starting in this time window are always fetched again
+
+		if not hasattr(self, 'xmlepg_compress'):
+			self.xmlepg_compress = False # write data file compressed using gzip
 
 		self.data_file = '%s.data.xml' % self.prefix
+		if self.xmlepg_compress:
+			self.data_file += '.gz'
 		self.channels_file = '%s.channels.xml' % self.prefix
+		self.epg_store_file = '%s.epgstore' % self.prefix # stored events used for incremental update - set to None to disable
 
 		# settings for EPGImport
 		self.epgimport_sources_file = '/etc/epgimport/%s.sources.xml' % self.prefix
@@ -173,6 +195,15 @@ class XmlEpgGeneratorTemplate(object):
 		data_file = os.path.join(xmlepg_dir, self.data_file)
 		channels_file = os.path.join(xmlepg_dir, self.channels_file)
 
+		if self.epg_store_file:
+			store_file = os.path.join(xmlepg_dir, self.epg_store_file)
+			if os.path.exists(store_file):
+				try:
+					self.log_info("Removing EPG store file %s" % store_file)
+					os.remove(store_file)
+				except:
+					pass
+
 		if os.path.exists(data_file):
 			try:
 				self.log_info("Removing data file %s" % data_file)
@@ -261,6 +292,7 @@ class XmlEpgGeneratorTemplate(object):
 		# create paths to export files
 		data_file = os.path.join(xmlepg_dir, self.data_file)
 		channels_file = os.path.join(xmlepg_dir, self.channels_file)
+		store_file = os.path.join(xmlepg_dir, self.epg_store_file) if self.epg_store_file else None
 
 		# check modification time of last exported file
 		data_mtime = self.get_datafile_mtime(data_file)
@@ -272,23 +304,13 @@ class XmlEpgGeneratorTemplate(object):
 		# time to generate new XML EPG file
 		try:
 			gen_time_start = time()
-			self.create_xmlepg(data_file, channels_file, xmlepg_days)
+			with metrics.timer('xmlepg', self.metrics_name):
+				self.create_xmlepg(data_file, channels_file, xmlepg_days, store_file, force)
 			self.log_info("EPG generated in %d seconds" % int(time() - gen_time_start))
 		except Exception as e:
+			# files are replaced only when generation succeeds, so data from previous run stay untouched
 			self.log_error("Something's failed by generating epg")
 			self.log_error(traceback.format_exc())
-
-			# XML data are probably corrupted, so remove it
-			try:
-				os.remove(data_file)
-			except:
-				pass
-
-			try:
-				os.remove(channels_file)
-			except:
-				pass
-
 			return
 
 		# generate proper sources file for EPGImport
@@ -403,24 +425,98 @@ class XmlEpgGeneratorTemplate(object):
 
 	# #################################################################################################
 
-	def create_xmlepg(self, data_file, channels_file, days):
+	def load_epg_store(self, store_file):
+		'''
+		Loads events stored by previous run. Returns map channel id -> { 'covered': timestamp, 'events': [(start, end, title, desc), ...] }
+		'''
+		try:
+			with open(store_file, 'rb') as f:
+				data = pickle.load(f)
+
+			if data.get('version') == EPG_STORE_VERSION:
+				return data['channels']
+		except (IOError, OSError):
+			pass
+		except:
+			self.log_error("Failed to load EPG store %s" % store_file)
+			self.log_error(traceback.format_exc())
+
+		return {}
+
+	# #################################################################################################
+
+	def save_epg_store(self, store_file, channels):
+		try:
+			tmp_file = store_file + '.tmp'
+			with open(tmp_file, 'wb') as f:
+				pickle.dump({ 'version': EPG_STORE_VERSION, 'channels': channels }, f, pickle.HIGHEST_PROTOCOL)
+			os.rename(tmp_file, store_file)
+		except:
+			self.log_error("Failed to save EPG store %s" % store_file)
+			self.log_error(traceback.format_exc())
+
+	# #################################################################################################
+
+	def get_epg_incremental(self, channel, fromts, tots, stored):
+		'''
+		Returns sorted list of events (start, end, title, desc) for channel. If there are stored events from previous run,
+		then only time window not covered by them and window of next epg_refresh_window seconds is fetched.
+		'''
+		if stored is None or stored['covered'] <= fromts + self.epg_refresh_window:
+			ranges = [(fromts, tots)]
+		else:
+			ranges = [(fromts, fromts + self.epg_refresh_window)]
+			if stored['covered'] < tots:
+				ranges.append((stored['covered'], tots))
+
+		events = {}
+		if stored is not None:
+			for event in stored['events']:
+				if event[1] > fromts and event[0] < tots:
+					for range_start, range_end in ranges:
+						if range_start <= event[0] < range_end:
+							# this will be fetched again
+							break
+					else:
+						events[event[0]] = event
+
+		for range_start, range_end in ranges:
+			for event in self.get_epg(channel, range_start, range_end):
+				try:
+					events[event['start']] = (event['start'], event['end'], str(event['title']), event.get('desc'))
+				except:
+					metrics.inc('xmlepg.errors', 1, self.metrics_name)
+					self.log_error(traceback.format_exc())
+
+		return sorted(events.values(), key=lambda e: e[0])
+
+	# #################################################################################################
+
+	def create_xmlepg(self, data_file, channels_file, days, store_file=None, force=False):
 
 		fromts = int(time())
 		tots = fromts + (int(days) * 86400)
 
+		# events stored by previous run - on force run everything is fetched again
+		store = self.load_epg_store(store_file) if store_file and not force else {}
+		new_store = {}
+
+		def get_epg(channel, fromts, tots):
+			return self.get_epg_incremental(channel, fromts, tots, store.get(str(channel['id'])))
+
 		xmlname_prefix = strip_accents(self.name.replace(' ', '')) + '_'
 
-		with open(channels_file, "w") as fc:
-			with open(data_file, "w") as f:
+		with XmlTvWriter(channels_file) as fc:
+			with XmlTvWriter(data_file, self.xmlepg_compress) as f:
 				fc.write('<?xml version="1.0" encoding="UTF-8"?>\n')
 				fc.write('<channels>\n')
 
 				f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
 				f.write('<tv generator-info-name="%s" generator-info-url="https://%s.cz" generator-info-partner="none">\n' % (self.name, self.prefix))
 
-				for channel in self.get_channels():
-					self.log_info("Processing EPG for channel: %s" % channel['name'])
+				fetcher = EpgFetcher(get_epg, self.epg_fetch_workers, RateLimiter.get_instance(self.prefix, self.epg_fetch_rate), self.epg_channel_timeout, self.log_error)
 
+				for channel, events, error, duration in fetcher.fetch(self.get_channels(), fromts, tots):
 					if 'id_content' in channel:
 						id_content = xmlname_prefix + channel["id_content"]
 					else:
@@ -428,24 +524,41 @@ class XmlEpgGeneratorTemplate(object):
 
 					fc.write(' <channel id="%s">1:0:1:%X:%X:%X:%X:0:0:0:http%%3a//</channel>\n' % (id_content, self.sid_start + channel['id'], self.tid, self.onid, self.namespace))
 
-					for event in self.get_epg(channel, fromts, tots):
+					metrics.observe('xmlepg.channel', duration, self.metrics_name)
+					channel_id = str(channel['id'])
+					if error is not None:
+						self.log_error("Failed to get EPG for channel %s: %s" % (channel['name'], str(error)))
+						metrics.inc('xmlepg.errors', 1, self.metrics_name)
+
+						stored = store.get(channel_id)
+						if stored is None:
+							continue
+
+						# use at least events from previous run
+						events = [e for e in stored['events'] if e[1] > fromts and e[0] < tots]
+						new_store[channel_id] = { 'covered': min(stored['covered'], tots), 'events': events }
+					else:
+						self.log_info("EPG for channel %s fetched in %.2fs (%d events)" % (channel['name'], duration, len(events)))
+						new_store[channel_id] = { 'covered': tots, 'events': events }
+
+					events_count = 0
+					for event in events:
 						try:
-							xml_data = {
-								'start': datetime.utcfromtimestamp(event['start']).strftime('%Y%m%d%H%M%S') + ' 0000',
-								'stop': datetime.utcfromtimestamp(event['end']).strftime('%Y%m%d%H%M%S') + ' 0000',
-								'title': escape(str(event['title'])),
-								'desc': escape(event['desc']) if event.get('desc') != None else ' '
-							}
-							f.write(' <programme start="%s" stop="%s" channel="%s">\n' % (xml_data['start'], xml_data['stop'], id_content))
-							f.write('  <title lang="cs">%s</title>\n' % xml_data['title'])
-							f.write('  <desc lang="cs">%s</desc>\n' % xml_data['desc'])
-							f.write(' </programme>\n')
+							f.write_programme(id_content, event[0], event[1], event[2], event[3])
+							events_count += 1
 						except:
+							metrics.inc('xmlepg.errors', 1, self.metrics_name)
 							self.log_error(traceback.format_exc())
 							pass
 
+					metrics.inc('xmlepg.channels', 1, self.metrics_name)
+					metrics.inc('xmlepg.events', events_count, self.metrics_name)
+
 				fc.write('</channels>\n')
 				f.write('</tv>\n')
 
+		if store_file:
+			self.save_epg_store(store_file, new_store)
+
 	# #################################################################################################
 
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import os, gzip
+from time import gmtime, strftime
+from xml.sax.saxutils import escape
+
+# #################################################################################################
+
+class XmlTvWriter(object):
+	'''
+	Buffered writer for XMLTV files. Data are written to temporary file, that replaces destination file atomicaly
+	when writer is closed, so readers (EPGImport, EPGLoad) never see half written file and failed generation keeps
+	previous data untouched. Optionaly output can be compressed using gzip.
+
+	Use it as context manager - on exception temporary file is removed and destination file is not touched.
+	'''
+	def __init__(self, file_name, compress=False, buffer_size=256 * 1024, lang='cs'):
+		self.file_name = file_name
+		self.tmp_file = file_name + '.tmp'
+		self.compress = compress
+		self.buffer_size = buffer_size
+		self.lang = lang
+		self.buffer = []
+		self.buffered = 0
+		self.time_cache = {}
+		self.f = None
+
+	# #################################################################################################
+
+	def open(self):
+		if self.compress:
+			self.f = gzip.open(self.tmp_file, 'wb', 6)
+		else:
+			self.f = open(self.tmp_file, 'wb')
+
+		return self
+
+	def __enter__(self):
+		return self.open()
+
+	def __exit__(self, exc_type, exc_value, tb):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
+
+		return False
+
+	# #################################################################################################
+
+	def flush(self):
+		if self.buffer:
+			self.f.write(b''.join(self.buffer))
+			self.buffer = []
+			self.buffered = 0
+
+	def close(self):
+		'''
+		Writes remaining data and moves temporary file to destination
+		'''
+		self.flush()
+		self.f.close()
+		self.f = None
+		os.rename(self.tmp_file, self.file_name)
+
+	def abort(self):
+		'''
+		Drops everything written so far - destination file stays untouched
+		'''
+		self.buffer = []
+		self.buffered = 0
+		if self.f:
+			try:
+				self.f.close()
+			except:
+				pass
+			self.f = None
+
+		try:
+			os.remove(self.tmp_file)
+		except:
+			pass
+
+	# #################################################################################################
+
+	def write(self, data):
+		if not isinstance(data, bytes):
+			data = data.encode('utf-8')
+
+		self.buffer.append(data)
+		self.buffered += len(data)
+		if self.buffered >= self.buffer_size:
+			self.flush()
+
+	# #################################################################################################
+
+	def format_time(self, ts):
+		'''
+		Converts timestamp to XMLTV time format. Results are cached, because end of one event is usualy start of the next one.
+		'''
+		ret = self.time_cache.get(ts)
+		if ret is None:
+			if len(self.time_cache) > 50000:
+				self.time_cache.clear()
+
+			ret = strftime('%Y%m%d%H%M%S', gmtime(ts)) + ' 0000'
+			self.time_cache[ts] = ret
+
+		return ret
+
+	# #################################################################################################
+
+	def write_programme(self, channel_id, start, end, title, desc=None):
+		self.write(' <programme start="%s" stop="%s" channel="%s">\n  <title lang="%s">%s</title>\n  <desc lang="%s">%s</desc>\n </programme>\n' % (
+			self.format_time(start), self.format_time(end), channel_id,
+			self.lang, escape(title),
+			self.lang, escape(desc) if desc != None else ' '))
+
+# #################################################################################################
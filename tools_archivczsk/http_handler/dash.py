@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 from .template import HTTPRequestHandlerTemplate
+from ..metrics import metrics
 
 import xml.etree.ElementTree as ET
 
@@ -9,7 +11,9 @@ try:
 except:
 	from urllib.parse import urljoin
 
-from tools_cenc.mp4decrypt import mp4decrypt
+from tools_cenc.mp4decrypt import mp4decrypt_async
+from tools_cenc.cencdecrypt import InitSegment
+from twisted.internet.defer import succeed
 
 # #################################################################################################
 
@@ -56,7 +60,14 @@ class DashHTTPRequestHandler(HTTPRequestHandlerTemplate):
 
 		self.log_devel("Request for MPD manifest for: %s" % path)
 
+		# processing of manifest can take some time (DRM keys) - player can close connection in the meantime
+		flags = { 'finished': False }
+		request.notifyFinish().addBoth(lambda reason: flags.update({ 'finished': True }))
+
 		def dash_continue(data):
+			if flags['finished']:
+				return
+
 			if data:
 				self.log_devel("Processed MPD:\n%s" % data.decode('utf-8'))
 				request.setResponseCode(200)
@@ -91,7 +102,7 @@ class DashHTTPRequestHandler(HTTPRequestHandlerTemplate):
 
 	# #################################################################################################
 
-	def dash_proxify_base_url(self, url, pssh=[], drm=None, cache_key=None):
+	def dash_proxify_base_url(self, url, pssh=[], drm=None, cache_key=None, segment_templates=None):
 		'''
 		Redirects segment url to use proxy
 		'''
@@ -108,6 +119,9 @@ class DashHTTPRequestHandler(HTTPRequestHandlerTemplate):
 			'drm': drm,
 		})
 
+		if segment_templates != None:
+			cached_data['templates'] = segment_templates
+
 		if cache_key == None:
 			cache_key = self.scache.put(cached_data)
 		else:
@@ -136,8 +150,13 @@ class DashHTTPRequestHandler(HTTPRequestHandlerTemplate):
 
 		# recreate original segment URL
 		# url_parts[1] is segment type - this information is only needed when DRM is active
-		url = '/'.join(url_parts[2:])
-		url = urljoin(base_url, url.replace('dot-dot-slash', '../'))
+		segment_path = '/'.join(url_parts[2:])
+		url = urljoin(base_url, segment_path.replace('dot-dot-slash', '../'))
+
+		if self.segment_prefetcher:
+			self.dash_prefetch_next_segments(cache_data, url_parts[1], segment_path)
+			if self.segment_prefetcher.serve(request, url):
+				return self.NOT_DONE_YET
 
 		self.log_devel('Requesting DASH segment: %s' % url)
 		flags = {
@@ -165,24 +184,162 @@ class DashHTTPRequestHandler(HTTPRequestHandlerTemplate):
 
 	# #################################################################################################
 
+	@staticmethod
+	def get_segment_template_info(e_segment_template, media, ns):
+		'''
+		Extracts informations from SegmentTemplate element needed to predict URLs of next segments
+		'''
+		timeline = []
+		e_timeline = e_segment_template.find('{}SegmentTimeline'.format(ns))
+		if e_timeline != None:
+			t = 0
+			entries = e_timeline.findall('{}S'.format(ns))
+			for i, e in enumerate(entries):
+				t = int(e.get('t', t))
+				d = int(e.get('d'))
+				r = int(e.get('r', 0))
+				if r < 0:
+					# repeat until start of next entry or (for last entry) until end of period - count it as open ended
+					if i + 1 < len(entries) and entries[i + 1].get('t'):
+						r = (int(entries[i + 1].get('t')) - t) // d - 1
+					else:
+						r = None
+
+				timeline.append((t, d, r))
+				if r == None:
+					break
+				t += d * (r + 1)
+
+		return {
+			'media': media,
+			'timeline': timeline,
+		}
+
+	# #################################################################################################
+
+	@staticmethod
+	def _segment_template_regex(media):
+		pattern = []
+		fields = {}
+		for i, part in enumerate(re.split(r'(\$[^$]*\$)', media)):
+			if i % 2 == 0:
+				pattern.append(re.escape(part))
+			elif part == '$$':
+				pattern.append(re.escape('$'))
+			else:
+				name, _, fmt = part[1:-1].partition('%')
+				group = name.lower()
+				if group in fields:
+					# the same identifier used more times - match only first one
+					pattern.append(r'.+?' if group == 'representationid' else r'\d+')
+					continue
+
+				fields[group] = '%' + fmt if fmt else '%d'
+				pattern.append(r'(?P<%s>.+?)' % group if group == 'representationid' else r'(?P<%s>\d+)' % group)
+
+		return re.compile(''.join(pattern) + '$'), fields
+
+	# #################################################################################################
+
+	def dash_predict_next_segments(self, cache_data, segment_type, segment_path, count):
+		'''
+		Predicts paths of next segments based on SegmentTemplate used to create current segment path
+		'''
+		template = cache_data.get('templates', {}).get(segment_type[1:])
+		if not template:
+			return []
+
+		if 'regex' not in template:
+			template['regex'], template['fields'] = self._segment_template_regex(template['media'])
+
+		m = template['regex'].match(segment_path)
+		if not m:
+			return []
+
+		if 'number' in template['fields']:
+			group = 'number'
+			cur = int(m.group('number'))
+			values = [cur + i + 1 for i in range(count)]
+		elif 'time' in template['fields']:
+			group = 'time'
+			cur = int(m.group('time'))
+			values = []
+			for t, d, r in template['timeline']:
+				if r == None:
+					end = cur + d * (count + 1)
+				else:
+					end = t + d * (r + 1)
+
+				if cur >= end:
+					continue
+
+				if cur >= t:
+					t += ((cur - t) // d + 1) * d
+
+				while t < end and len(values) < count:
+					values.append(t)
+					t += d
+
+				if len(values) >= count:
+					break
+		else:
+			return []
+
+		fmt = template['fields'][group]
+		return [segment_path[:m.start(group)] + (fmt % v) + segment_path[m.end(group):] for v in values]
+
+	# #################################################################################################
+
+	def dash_prefetch_next_segments(self, cache_data, segment_type, segment_path, process_cbk=None):
+		if segment_type[0] != 'm':
+			return
+
+		try:
+			paths = self.dash_predict_next_segments(cache_data, segment_type, segment_path, self.segment_prefetcher.segments)
+		except:
+			self.cp.log_exception()
+			return
+
+		urls = [urljoin(cache_data['url'], p.replace('dot-dot-slash', '../')) for p in paths]
+		self.segment_prefetcher.prefetch([(u, u) for u in urls], process_cbk)
+
+	# #################################################################################################
+
 	def process_drm_protected_segment(self, segment_type, data, cache_data):
-		# handle DRM protected segment data
+		'''
+		Handles complete DRM protected segment data. Returns Deferred, that fires with decrypted data or None on failure.
+		It is used when segment can't be decrypted on the fly.
+		'''
 		if segment_type[0] == 'i':
 			self.log_devel("Received init segment data for %s" % segment_type[1:])
 
-			# init segment is not encrypted, but we need it for decrypting data segments
-			cache_data['init'][segment_type[1:]] = data
-			return data
+			# init segment is not encrypted, but we need it for decrypting data segments - parse it only once per representation
+			cache_data['init'][segment_type[1:]] = InitSegment(data)
+			return succeed(data)
 
-		# collect keys for protected content
-		keys = self.get_drm_keys(cache_data['pssh'], cache_data['drm'], cache_data['drm'].get('privacy_mode', False))
+		def keys_received(keys):
+			if len(keys) == 0:
+				self.cp.log_error("No keys to decrypt DRM protected content")
+				return None
+
+			self.log_devel("Keys for pssh: %s" % str(keys))
+			d = metrics.timed_deferred('mp4decrypt', mp4decrypt_async(keys, cache_data['init'].get(segment_type[1:]), data), self.metrics_name)
+			d.addCallbacks(decrypted, decrypt_failed)
+			return d
+
+		def decrypted(result):
+			if not result:
+				self.invalidate_drm_keys(cache_data['pssh'])
+			return result
 
-		if len(keys) == 0:
-			self.cp.log_error("No keys to decrypt DRM protected content")
-			return None
+		def decrypt_failed(failure):
+			self.invalidate_drm_keys(cache_data['pssh'])
+			return failure
 
-		self.log_devel("Keys for pssh: %s" % str(keys))
-		return mp4decrypt(keys, cache_data['init'].get(segment_type[1:]), data)
+		# collect keys for protected content
+		d = self.get_drm_keys_async(cache_data['pssh'], cache_data['drm'], cache_data['drm'].get('privacy_mode', False))
+		d.addCallback(keys_received)
+		return d
 
 	# #################################################################################################
 
@@ -201,34 +358,31 @@ class DashHTTPRequestHandler(HTTPRequestHandlerTemplate):
 		base_url = cache_data['url']
 
 		# recreate original segment URL
-		url = '/'.join(url_parts[2:])
-		url = urljoin(base_url, url.replace('dot-dot-slash', '../'))
+		segment_path = '/'.join(url_parts[2:])
+		url = urljoin(base_url, segment_path.replace('dot-dot-slash', '../'))
 		self.log_devel("Original URL: %s" % url)
 		self.log_devel("Segment type: %s" % segment_type)
 #		self.log_devel("cache_data: %s" % str(cache_data))
 
-		def dsp_continue(response):
-			if response['status_code'] >= 400:
-				self.cp.log_error("Response code for DASH segment: %d" % response['status_code'])
-				request.setResponseCode(403)
-			else:
-				data = self.process_drm_protected_segment(segment_type, response['content'], cache_data)
+		if self.segment_prefetcher and segment_type[0] == 'm':
+			self.dash_prefetch_next_segments(cache_data, segment_type, segment_path, lambda data, st=segment_type: self.process_drm_protected_segment(st, data, cache_data))
+			if self.segment_prefetcher.serve(request, url):
+				return self.NOT_DONE_YET
 
-				if not data:
-					self.cp.log_error('Failed to decrypt segment for stream key: %s' % url_parts[0])
-					request.setResponseCode(501)
-				else:
-					request.setResponseCode(response['status_code'])
-					for k,v in response['headers'].items():
-						request.setHeader(k, v)
+		self.log_devel('Requesting DASH segment: %s' % url)
 
-					request.write(data)
+		if segment_type[0] == 'i':
+			def init_received(init):
+				self.log_devel("Received init segment data for %s" % segment_type[1:])
+				cache_data['init'][segment_type[1:]] = init
 
-			request.finish()
+			return self.request_drm_segment_async(request, url, init_cbk=init_received)
 
-		self.log_devel('Requesting DASH segment: %s' % url)
-		self.request_http_data_async_simple(url, cbk=dsp_continue, range=request.getHeader(b'Range'))
-		return self.NOT_DONE_YET
+		return self.request_drm_segment_async(request, url,
+			keys_cbk=lambda: self.get_drm_keys_async(cache_data['pssh'], cache_data['drm'], cache_data['drm'].get('privacy_mode', False)),
+			init_data=cache_data['init'].get(segment_type[1:]),
+			fallback_cbk=lambda data: self.process_drm_protected_segment(segment_type, data, cache_data),
+			invalidate_keys_cbk=lambda: self.invalidate_drm_keys(cache_data['pssh']))
 
 	# #################################################################################################
 
@@ -270,6 +424,8 @@ class DashHTTPRequestHandler(HTTPRequestHandlerTemplate):
 
 			return kid
 
+		segment_templates = {}
+
 		def patch_segment_url(element):
 			if self.dash_proxy_segments:
 				ck = self.calc_cache_key(element.get('id'))
@@ -288,7 +444,10 @@ class DashHTTPRequestHandler(HTTPRequestHandlerTemplate):
 
 					v = e_segment_template.get('media')
 					if v:
-						e_segment_template.set('media', 'm%s%d/%s' % (ck, i, urljoin(e_base_url, v.replace('../', 'dot-dot-slash'))))
+						media = urljoin(e_base_url, v.replace('../', 'dot-dot-slash'))
+						e_segment_template.set('media', 'm%s%d/%s' % (ck, i, media))
+						if self.segment_prefetcher:
+							segment_templates['%s%d' % (ck, i)] = self.get_segment_template_info(e_segment_template, media, ns)
 					i += 1
 
 		def remove_content_protection(element):
@@ -415,13 +574,13 @@ class DashHTTPRequestHandler(HTTPRequestHandlerTemplate):
 				base_url_set = urljoin(base_url, e_base_url.text)
 
 				if self.dash_proxy_segments:
-					base_url_set = self.dash_proxify_base_url(base_url_set, pssh=list(set(pssh_list)), drm=drm, cache_key=cache_key)
+					base_url_set = self.dash_proxify_base_url(base_url_set, pssh=list(set(pssh_list)), drm=drm, cache_key=cache_key, segment_templates=segment_templates)
 
 				e_base_url.text = base_url_set
 			else:
 				# base path not found in MPD, so set it ...
 				if self.dash_proxy_segments:
-					base_url_set = self.dash_proxify_base_url(base_url, pssh=list(set(pssh_list)), drm=drm, cache_key=cache_key)
+					base_url_set = self.dash_proxify_base_url(base_url, pssh=list(set(pssh_list)), drm=drm, cache_key=cache_key, segment_templates=segment_templates)
 				else:
 					base_url_set = base_url
 
@@ -431,6 +590,22 @@ class DashHTTPRequestHandler(HTTPRequestHandlerTemplate):
 #				ET.SubElement(e_period, 'BaseURL').text = base_url_set
 
 
+	# #################################################################################################
+
+	def dash_prefetch_drm_keys(self, root, drm):
+		'''
+		Requests DRM keys for all Widevine PSSHs found in manifest. Returns Deferred, that fires when keys are available.
+		'''
+		pssh_list = []
+		if drm and drm.get('licence_url'):
+			for e in root.iter():
+				if e.tag.endswith('ContentProtection') and e.get('schemeIdUri', '').lower() == 'urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed':
+					e_pssh = e.find('{urn:mpeg:cenc:2013}pssh')
+					if e_pssh != None and e_pssh.text:
+						pssh_list.append(e_pssh.text.strip())
+
+		return self.get_drm_keys_async(pssh_list, drm, drm.get('privacy_mode', False) if drm else False)
+
 	# #################################################################################################
 
 	def get_dash_playlist_data_async(self, dash_info, cbk=None):
@@ -460,8 +635,19 @@ class DashHTTPRequestHandler(HTTPRequestHandlerTemplate):
 			self.log_devel("Received MPD:\n%s" % response_data)
 
 			root = ET.fromstring(response_data)
-			self.handle_mpd_manifest(redirect_url, root, bandwidth, dash_info, cache_key)
-			cbk( ET.tostring(root, encoding='utf8', method='xml'))
+
+			def keys_ready(result):
+				try:
+					self.handle_mpd_manifest(redirect_url, root, bandwidth, dash_info, cache_key)
+					data = ET.tostring(root, encoding='utf8', method='xml')
+				except:
+					self.cp.log_exception()
+					data = None
+
+				cbk(data)
+
+			# DRM keys are requested outside of reactor before manifest is processed - handle_mpd_manifest() then gets them from key store
+			self.dash_prefetch_drm_keys(root, dash_info.get('drm', {})).addBoth(keys_ready)
 			return
 
 
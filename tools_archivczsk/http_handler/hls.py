@@ -2,12 +2,15 @@
 
 import base64
 from .template import HTTPRequestHandlerTemplate
+from ..metrics import metrics
 from ..parser.hls import HlsPlaylist
-import re
+from ..cache import LRUCache
 import binascii
 
 from ..compat import quote, unquote, urljoin
-from tools_cenc.mp4decrypt import mp4decrypt
+from tools_cenc.mp4decrypt import mp4decrypt_async
+from tools_cenc.cencdecrypt import InitSegment
+from twisted.internet.defer import succeed
 
 # #################################################################################################
 
@@ -59,6 +62,8 @@ class HlsHTTPRequestHandler(HTTPRequestHandlerTemplate):
 		self.hls_proxy_variants = proxy_variants
 		self.hls_internal_decrypt = proxy_segments and internal_decrypt
 		self.hls_master_processor = HlsMasterProcessor
+		# already processed segments of live variant playlists - only new segments are processed on next refresh
+		self.hls_variant_cache = LRUCache(16)
 
 	# #################################################################################################
 
@@ -147,13 +152,33 @@ class HlsHTTPRequestHandler(HTTPRequestHandlerTemplate):
 
 	# #################################################################################################
 
+	@staticmethod
+	def parse_drm_key_line(line):
+		return HlsPlaylist.parse_attributes_raw(line[11:])
+
+	# #################################################################################################
+
+	def hls_prefetch_drm_keys(self, playlist_data, drm_info):
+		'''
+		Requests DRM keys for all Widevine PSSHs found in variant playlist. Returns Deferred, that fires when keys are available.
+		'''
+		pssh_list = []
+		if drm_info:
+			for line in playlist_data.splitlines():
+				if line.startswith("#EXT-X-KEY:"):
+					attr = self.parse_drm_key_line(line)
+					pssh = attr.get('URI','')
+					if attr.get('KEYFORMAT','').lower() == '"urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed"' and pssh.startswith('"data:text/plain;base64,'):
+						pssh_list.append(pssh[24:-1])
+
+		return self.get_drm_keys_async(pssh_list, drm_info, drm_info.get('privacy_mode', False) if drm_info else False)
+
+	# #################################################################################################
+
 	def process_drm_key_line(self, line, drm_info, segment_cache_data):
 		self.cp.log_debug('Processing DRM line: %s' % line)
 
-		attr = {}
-		for a in re.findall(r'(?:[^\s,"]|"(?:\\.|[^"])*")+', line[11:]):
-			s = a.split('=')
-			attr[s[0]] = '='.join(s[1:])
+		attr = self.parse_drm_key_line(line)
 
 #		self.cp.log_debug('Attrs: %s' % attr)
 
@@ -185,27 +210,42 @@ class HlsHTTPRequestHandler(HTTPRequestHandlerTemplate):
 	# #################################################################################################
 
 	def hls_process_drm_protected_segment(self, segment_type, data, cache_data):
-		# handle DRM protected segment data
+		'''
+		Handles complete DRM protected segment data. Returns Deferred, that fires with decrypted data or None on failure.
+		It is used when segment can't be decrypted on the fly.
+		'''
 		if segment_type == 'i':
 			self.log_devel("Received init segment data")
 
-			# init segment is not encrypted, but we need it for decrypting data segments
-			cache_data['init'] = data
-			return data
+			# init segment is not encrypted, but we need it for decrypting data segments - parse it only once
+			cache_data['init'] = InitSegment(data)
+			return succeed(data)
 
-		# collect keys for protected content
-		keys = self.get_drm_keys(cache_data['pssh'], cache_data['drm'], cache_data['drm'].get('privacy_mode', False))
+		def keys_received(keys):
+			if len(keys) == 0:
+				self.cp.log_error("No keys to decrypt DRM protected content")
+				return None
+
+			self.log_devel("Keys for pssh: %s" % str(keys))
 
-		if len(keys) == 0:
-			self.cp.log_error("No keys to decrypt DRM protected content")
-			return None
+			self.log_devel("Decrypting media segment with size %d" % len(data))
+			d = metrics.timed_deferred('mp4decrypt', mp4decrypt_async(keys, cache_data.get('init'), data), self.metrics_name)
+			d.addCallbacks(decrypted, decrypt_failed)
+			return d
 
-		self.log_devel("Keys for pssh: %s" % str(keys))
+		def decrypted(result):
+			if not result:
+				self.invalidate_drm_keys(cache_data['pssh'])
+			return result
 
-		self.log_devel("Decrypting media segment with size %d" % len(data))
-		data_out = mp4decrypt(keys, cache_data['init'], data)
-		self.log_devel("Decrypted media segment with size %d" % len(data_out))
-		return data_out
+		def decrypt_failed(failure):
+			self.invalidate_drm_keys(cache_data['pssh'])
+			return failure
+
+		# collect keys for protected content
+		d = self.get_drm_keys_async(cache_data['pssh'], cache_data['drm'], cache_data['drm'].get('privacy_mode', False))
+		d.addCallback(keys_received)
+		return d
 
 	# #################################################################################################
 
@@ -219,33 +259,40 @@ class HlsHTTPRequestHandler(HTTPRequestHandlerTemplate):
 		self.cp.log_debug('Requesting HLS %s segment: %s' % ('init' if segment_type == 'i' else 'media', segment_url))
 		cache_data = self.scache.get(segment_cache_key)
 
-		def hsp_continue(response):
-			if response['status_code'] >= 400:
-				self.cp.log_error("Response code for HLS segment: %d" % response['status_code'])
-				request.setResponseCode(403)
-			else:
-				data = self.hls_process_drm_protected_segment(segment_type, response['content'], cache_data)
+		if self.segment_prefetcher and segment_type != 'i':
+			self.hls_prefetch_next_segments(segment_url, lambda data: self.hls_process_drm_protected_segment(segment_type, data, cache_data))
+			if self.segment_prefetcher.serve(request, segment_url):
+				return self.NOT_DONE_YET
 
-				if not data:
-					self.cp.log_error('Failed to decrypt segment for stream key: %s' % segment_cache_key)
-					request.setResponseCode(501)
-				else:
-					request.setResponseCode(response['status_code'])
-					for k,v in response['headers'].items():
-						request.setHeader(k, v)
+		if segment_type == 'i':
+			def init_received(init):
+				self.log_devel("Received init segment data")
+				cache_data['init'] = init
 
-					request.write(data)
+			return self.request_drm_segment_async(request, segment_url, init_cbk=init_received)
 
-			request.finish()
+		return self.request_drm_segment_async(request, segment_url,
+			keys_cbk=lambda: self.get_drm_keys_async(cache_data['pssh'], cache_data['drm'], cache_data['drm'].get('privacy_mode', False)),
+			init_data=cache_data.get('init'),
+			fallback_cbk=lambda data: self.hls_process_drm_protected_segment(segment_type, data, cache_data),
+			invalidate_keys_cbk=lambda: self.invalidate_drm_keys(cache_data['pssh']))
 
-		self.request_http_data_async_simple(segment_url, cbk=hsp_continue, range=request.getHeader(b'Range'))
-		return self.NOT_DONE_YET
+	# #################################################################################################
+
+	def hls_prefetch_next_segments(self, segment_url, process_cbk=None):
+		urls = self.segment_prefetcher.get_next_from_sequence(segment_url)
+		self.segment_prefetcher.prefetch([(u, u) for u in urls], process_cbk)
 
 	# #################################################################################################
 
 	def P_hs(self, request, path):
 		segment_url = unquote(path)
 
+		if self.segment_prefetcher:
+			self.hls_prefetch_next_segments(segment_url)
+			if self.segment_prefetcher.serve(request, segment_url):
+				return self.NOT_DONE_YET
+
 		self.cp.log_debug('Requesting HLS segment: %s' % segment_url)
 		flags = {
 			'finished': False
@@ -273,6 +320,11 @@ class HlsHTTPRequestHandler(HTTPRequestHandlerTemplate):
 	# #################################################################################################
 
 	def process_variant_playlist(self, playlist_url, playlist_data, hls_info={}):
+		'''
+		Rewrites variant playlist. Live playlists change only by few segments between refreshes, so processed segments
+		are remembered and on next refresh only new segments (the ones not seen in previous version) are processed.
+		Segment block (all lines up to segment url) is reused only when its raw data and DRM state before it are the same.
+		'''
 		drm_info = hls_info.get('drm', {})
 		segment_cache_data = {
 			'drm': drm_info,
@@ -290,30 +342,91 @@ class HlsHTTPRequestHandler(HTTPRequestHandlerTemplate):
 
 			return surl
 
+		def process_lines(lines):
+			# returns processed lines and absolute url of segment (if lines contain it)
+			out = []
+			segment_url = None
+			stream_url_line = False
+
+			for line in lines:
+				if stream_url_line and not line.startswith('#'):
+					segment_url = urljoin(playlist_url, line)
+					out.append(process_url(line, playlist_url))
+					stream_url_line = False
+					continue
+
+				if drm_info and line.startswith("#EXT-X-KEY:"):
+					line = self.process_drm_key_line(line, drm_info, segment_cache_data)
+				elif 'URI=' in line:
+					# fix uri to full url
+					uri = line[line.find('URI=') + 4:]
+
+					if uri[0] in ('"', "'"):
+						uri = uri[1:uri[1:].find(uri[0]) + 1]
+
+					line = line.replace(uri, process_url(uri, playlist_url, 'i' if line.startswith('#EXT-X-MAP:') else 'm'))
+
+				if line.startswith("#EXTINF:"):
+					stream_url_line = True
+
+				out.append(line)
+
+			return out, segment_url
+
+		# VOD playlists are processed only once - there is no need to remember them
+		use_cache = '#EXT-X-ENDLIST' not in playlist_data
+		old_blocks = (self.hls_variant_cache.get(segment_cache_key) or {}) if use_cache else {}
+		new_blocks = {}
+
 		resp_data = []
+		segment_urls = []
+		first_new_segment = None
+		block = []
 		stream_url_line = False
+		reused = 0
 
-		for line in iter(playlist_data.splitlines()):
-			if stream_url_line and not line.startswith('#'):
-				resp_data.append(process_url(line, playlist_url))
-				stream_url_line = False
-				continue
+		for line in playlist_data.splitlines():
+			block.append(line)
 
-			if drm_info and line.startswith("#EXT-X-KEY:"):
-				line = self.process_drm_key_line(line, drm_info, segment_cache_data)
-			elif 'URI=' in line:
-				# fix uri to full url
-				uri = line[line.find('URI=') + 4:]
+			if stream_url_line and not line.startswith('#'):
+				# end of segment block
+				block_key = ('\n'.join(block), len(segment_cache_data['pssh']) > 0)
+				cached = old_blocks.get(block_key)
+
+				if cached is None:
+					pssh_start = len(segment_cache_data['pssh'])
+					out, segment_url = process_lines(block)
+					cached = (out, segment_url, segment_cache_data['pssh'][pssh_start:])
+					if first_new_segment is None:
+						first_new_segment = len(segment_urls)
+				else:
+					segment_cache_data['pssh'].extend(cached[2])
+					reused += 1
 
-				if uri[0] in ('"', "'"):
-					uri = uri[1:uri[1:].find(uri[0]) + 1]
+				if use_cache:
+					new_blocks[block_key] = cached
 
-				line = line.replace(uri, process_url(uri, playlist_url, 'i' if line.startswith('#EXT-X-MAP:') else 'm'))
+				resp_data.extend(cached[0])
+				segment_urls.append(cached[1])
+				block = []
+				stream_url_line = False
+				continue
 
 			if line.startswith("#EXTINF:"):
 				stream_url_line = True
 
-			resp_data.append(line)
+		if block:
+			# lines after the last segment
+			resp_data.extend(process_lines(block)[0])
+
+		if use_cache:
+			self.hls_variant_cache.put(segment_cache_key, new_blocks)
+			metrics.inc('hls_variant.segments_reused', reused, self.metrics_name)
+			metrics.inc('hls_variant.segments_processed', len(segment_urls) - reused, self.metrics_name)
+
+		if self.segment_prefetcher and self.hls_proxy_segments and first_new_segment is not None:
+			# register only new part of sequence (including link from the last already known segment)
+			self.segment_prefetcher.add_sequence(segment_urls[max(0, first_new_segment - 1):])
 
 		return '\n'.join(resp_data) + '\n'
 
@@ -334,14 +447,33 @@ class HlsHTTPRequestHandler(HTTPRequestHandlerTemplate):
 				request.finish()
 				return
 
-			resp_data = self.process_variant_playlist(response['url'], response['content'].decode('utf-8'), stream_data['hls_info'])
+			playlist_data = response['content'].decode('utf-8')
 
-			request.setResponseCode(200)
-			request.setHeader('content-type', "application/vnd.apple.mpegurl")
-			request.write(resp_data.encode('utf-8'))
-			request.finish()
+			def keys_ready(result):
+				if flags['finished']:
+					return
+
+				try:
+					resp_data = self.process_variant_playlist(response['url'], playlist_data, stream_data['hls_info'])
+				except:
+					self.cp.log_exception()
+					request.setResponseCode(500)
+					request.finish()
+					return
+
+				request.setResponseCode(200)
+				request.setHeader('content-type', "application/vnd.apple.mpegurl")
+				request.write(resp_data.encode('utf-8'))
+				request.finish()
+
+			# DRM keys are requested outside of reactor before playlist is processed - process_drm_key_line() then gets them from key store
+			self.hls_prefetch_drm_keys(playlist_data, stream_data['hls_info'].get('drm', {})).addBoth(keys_ready)
 			return
 
+		# processing of playlist can take some time (DRM keys) - player can close connection in the meantime
+		flags = { 'finished': False }
+		request.notifyFinish().addBoth(lambda reason: flags.update({ 'finished': True }))
+
 		self.request_http_data_async_simple(url, cbk=p_continue)
 		return self.NOT_DONE_YET
 
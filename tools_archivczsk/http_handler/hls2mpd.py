@@ -4,6 +4,10 @@ import re
 from collections import OrderedDict
 import requests
 import xml.etree.ElementTree as ET
+from twisted.internet.defer import Deferred, DeferredList, maybeDeferred, succeed
+from twisted.internet.threads import deferToThread
+from ..cache import ExpiringLRUCache, SingleFlight
+from ..metrics import metrics
 
 try:
 	from urllib import quote, unquote
@@ -22,6 +26,12 @@ def parse_attributes(line):
 
 	return attr
 
+def _escape_text(value):
+	return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def _escape_attrib(value):
+	return _escape_text(value).replace('"', '&quot;').replace('\r', '&#13;').replace('\n', '&#10;').replace('\t', '&#09;')
+
 # ##################################################################################################################
 
 class Segment(object):
@@ -39,6 +49,8 @@ class Playlist(object):
 		self.segments = []
 		self.duration = 0.0
 		self.pssh = []
+		self.target_duration = None
+		self.finished = False
 
 	def has_segments(self):
 		return len(self.segments) > 0
@@ -77,11 +89,34 @@ class Playlist(object):
 			elif line.startswith('#EXT-X-MAP:'):
 				attrs = self.parse_attributes(line[11:])
 				self.initialization = attrs.get("URI")
+			elif line.startswith('#EXT-X-TARGETDURATION:'):
+				self.target_duration = int(float(line[22:]))
+			elif line.startswith('#EXT-X-ENDLIST'):
+				self.finished = True
 
 # ##################################################################################################################
 
 class Hls2Mpd(object):
-	def __init__(self):
+	'''
+	Converts HLS master playlist to static MPD. Blocking interface is run() - it loads media playlists one by one.
+	Non blocking interface is run_async() - all media playlists are fetched in parallel using request handler's
+	connection pool (or in threads, when no request handler is set), MPD is written directly to string and the
+	result is cached per master playlist URL and get_mpd_cache_key().
+
+	request_handler - HTTPRequestHandlerTemplate used for async requests (optional)
+	'''
+
+	# cache of generated MPDs - key is (class name, master playlist url, get_mpd_cache_key())
+	mpd_cache = ExpiringLRUCache(16)
+	mpd_single_flight = SingleFlight()
+
+	# how long to cache MPD for playlists without #EXT-X-ENDLIST when no #EXT-X-TARGETDURATION is found
+	mpd_cache_ttl_default = 6
+	# how long to cache MPD when all playlists are finished (VOD)
+	mpd_cache_ttl_vod = 3600
+
+	def __init__(self, request_handler=None):
+		self.request_handler = request_handler
 		self.video_playlists = []
 		self.audio_playlists = []
 		self.subtitles_playlists = []
@@ -93,6 +128,26 @@ class Hls2Mpd(object):
 
 	# ##################################################################################################################
 
+	def load_http_data_async(self, url):
+		'''
+		Non blocking version of load_http_data(). Returns Deferred, that fires with playlist data.
+		'''
+		if self.request_handler is None:
+			return deferToThread(self.load_http_data, url)
+
+		d = Deferred()
+
+		def data_received(response):
+			if response['status_code'] != 200:
+				d.errback(Exception("Failed to load playlist %s: HTTP status code %s" % (url, response['status_code'])))
+			else:
+				d.callback(response['content'].decode('utf-8'))
+
+		self.request_handler.request_http_data_async_simple(url, data_received)
+		return d
+
+	# ##################################################################################################################
+
 	def parse_attributes(self, line):
 		return parse_attributes(line)
 
@@ -134,31 +189,46 @@ class Hls2Mpd(object):
 
 	# ##################################################################################################################
 
-	def load_media_playlists(self):
-		audio_load = []
-		subtitles_load = []
-		for vp in self.video_playlists:
-			vp_data = self.load_http_data(vp.playlist_url)
-			vp.load_segments(vp_data)
-			a = vp.get('AUDIO')
-			if a not in audio_load:
-				audio_load.append(a)
-
-			s = vp.get('SUBTITLES')
-			if s not in subtitles_load:
-				subtitles_load.append(s)
+	def get_media_playlists_to_load(self):
+		'''
+		Returns list of all playlists, that need to be loaded - video playlists and audio/subtitles playlists from groups
+		used by them
+		'''
+		ret = list(self.video_playlists)
+		audio_load = set(vp.get('AUDIO') for vp in self.video_playlists)
+		subtitles_load = set(vp.get('SUBTITLES') for vp in self.video_playlists)
 
 		for p in self.audio_playlists:
 			if p.group() in audio_load:
 				if p.get('LANGUAGE','en').split('-')[0].lower() in ('sk', 'cs', 'en'):
-					ap_data = self.load_http_data(p.playlist_url)
-					p.load_segments(ap_data)
+					ret.append(p)
 
 		for p in self.subtitles_playlists:
 			if p.group() in subtitles_load:
 				if p.get('LANGUAGE','en').split('-')[0].lower() in ('sk', 'cs'):
-					sp_data = self.load_http_data(p.playlist_url)
-					p.load_segments(sp_data)
+					ret.append(p)
+
+		return ret
+
+	# ##################################################################################################################
+
+	def load_media_playlists(self):
+		for p in self.get_media_playlists_to_load():
+			p.load_segments(self.load_http_data(p.playlist_url))
+
+	# ##################################################################################################################
+
+	def load_media_playlists_async(self):
+		'''
+		Loads all needed media playlists in parallel. Returns Deferred, that fires when all of them are loaded.
+		'''
+		ds = []
+		for p in self.get_media_playlists_to_load():
+			d = self.load_http_data_async(p.playlist_url)
+			d.addCallback(p.load_segments)
+			ds.append(d)
+
+		return DeferredList(ds, fireOnOneErrback=True, consumeErrors=True).addErrback(lambda f: f.value.subFailure)
 
 	# ##################################################################################################################
 
@@ -284,6 +354,122 @@ class Hls2Mpd(object):
 
 	# ##################################################################################################################
 
+	def build_mpd_string(self, drm_keys=None):
+		'''
+		Streaming version of build_mpd() - MPD is written directly to list of string chunks without building element
+		tree. Output is the same as ET.tostring(self.build_mpd()). drm_keys is a map playlist -> list of keys - if not
+		set, then keys are requested using get_drm_keys().
+		'''
+		TIMESCALE=1000000
+		out = []
+		w = out.append
+
+		def get_keys(p):
+			if drm_keys is not None:
+				return drm_keys.get(p)
+			return self.get_drm_keys(p.pssh)
+
+		def write_keys(p):
+			if len(p.pssh) > 0:
+				keys = get_keys(p)
+				if keys:
+					w(' cenc_decryption_keys="%s"' % _escape_attrib(':'.join(k.replace(':','=') for k in keys)))
+
+		def fill_segments(p):
+			w('<BaseURL>%s</BaseURL>' % _escape_text(urljoin(p.playlist_url, '.')))
+
+			max_duration = 0.0
+			for segment in p.segments:
+				if segment.duration > max_duration:
+					max_duration = segment.duration
+
+			w('<SegmentList timescale="%d" startNumber="0" duration="%d">' % (TIMESCALE, int(max_duration * TIMESCALE)))
+			if p.initialization:
+				w('<Initialization sourceURL="%s" />' % _escape_attrib(p.initialization))
+
+			w('<SegmentTimeline>')
+			for i, segment in enumerate(p.segments):
+				if i == 0:
+					w('<S t="0" d="%d" />' % int(segment.duration * TIMESCALE))
+				else:
+					w('<S d="%d" />' % int(segment.duration * TIMESCALE))
+			w('</SegmentTimeline>')
+
+			for segment in p.segments:
+				w('<SegmentURL media="%s" />' % _escape_attrib(segment.url))
+
+			w('</SegmentList>')
+
+		max_duration = 0
+		for p in self.video_playlists:
+			if p.has_segments() and p.duration > max_duration:
+				max_duration = p.duration
+
+		duration_str = 'PT%dH%dM%dS' % ((max_duration // 3600), (max_duration //60) % 60, max_duration % 60)
+		w('<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" xmlns:cenc="urn:mpeg:cenc:2013" minBufferTime="PT2S" type="static" profiles="urn:mpeg:dash:profile:isoff-main:2011" mediaPresentationDuration="%s">' % duration_str)
+		w('<Period id="0" start="PT0S">')
+
+		for i, p in enumerate(self.audio_playlists):
+			if not p.has_segments():
+				continue
+
+			w('<AdaptationSet subsegmentAlignment="true" subsegmentStartsWithSAP="1" id="as%d" lang="%s" contentType="audio">' % (i, _escape_attrib(p.get('LANGUAGE', 'en-US'))))
+			w('<Representation mimeType="audio/mp4" id="a%d"' % i)
+			write_keys(p)
+			w('>')
+			fill_segments(p)
+			w('</Representation></AdaptationSet>')
+
+		for i, p in enumerate(self.video_playlists):
+			if not p.has_segments():
+				continue
+
+			w('<AdaptationSet subsegmentAlignment="true" subsegmentStartsWithSAP="1" id="vs%d" contentType="video">' % i)
+			w('<Representation mimeType="video/mp4" id="v%d"' % i)
+			write_keys(p)
+			w('>')
+			fill_segments(p)
+			w('</Representation></AdaptationSet>')
+
+		for i, p in enumerate(self.subtitles_playlists):
+			if not p.has_segments():
+				continue
+
+			w('<AdaptationSet subsegmentAlignment="true" subsegmentStartsWithSAP="1" id="ss%d" lang="%s" contentType="text">' % (i, _escape_attrib(p.get('LANGUAGE', 'en-US'))))
+			w('<Role schemeIdUri="urn:mpeg:dash:role:2011" value="subtitle" />')
+			w('<Representation mimeType="text/vtt" id="s%d">' % i)
+			fill_segments(p)
+			w('</Representation></AdaptationSet>')
+
+		w('</Period></MPD>')
+		return ''.join(out)
+
+	# ##################################################################################################################
+
+	def get_mpd_cache_ttl(self):
+		'''
+		Returns for how long generated MPD can be cached - one target duration for live playlists, because then new
+		segment is available
+		'''
+		playlists = [p for p in self.video_playlists + self.audio_playlists + self.subtitles_playlists if p.has_segments()]
+
+		if playlists and all(p.finished for p in playlists):
+			return self.mpd_cache_ttl_vod
+
+		target_durations = [p.target_duration for p in playlists if p.target_duration]
+		return min(target_durations) if target_durations else self.mpd_cache_ttl_default
+
+	# ##################################################################################################################
+
+	def get_mpd_cache_key(self):
+		'''
+		Returns tuple of additional values, that generated MPD depends on - override it when filter_master_playlist()
+		or get_drm_keys() depends on instance state (settings of quality, bandwidth, DRM licence, ...)
+		'''
+		return ()
+
+	# ##################################################################################################################
+
 	def run(self, mp_url, mp_data=None):
 		if not mp_data:
 			mp_data = self.load_http_data(mp_url)
@@ -297,6 +483,70 @@ class Hls2Mpd(object):
 
 	# ##################################################################################################################
 
+	def run_async(self, mp_url, mp_data=None):
+		'''
+		Non blocking version of run(). Returns Deferred, that fires with MPD as UTF-8 encoded string. Results are
+		cached per master playlist url and get_mpd_cache_key() and parallel requests for the same key are merged to one.
+		When mp_data is provided, then cache is not used, because content of master playlist can differ from the url.
+		'''
+		if mp_data:
+			return self._run_async(None, mp_url, mp_data)
+
+		cache_key = (self.__class__.__name__, mp_url) + tuple(self.get_mpd_cache_key())
+		mpd = self.mpd_cache.get(cache_key)
+		if mpd is not None:
+			metrics.inc('hls2mpd.cache_hits', 1, self.get_metrics_name())
+			return succeed(mpd)
+
+		metrics.inc('hls2mpd.cache_misses', 1, self.get_metrics_name())
+		return self.mpd_single_flight.do_deferred(cache_key, self._run_async, cache_key, mp_url, mp_data)
+
+	# ##################################################################################################################
+
+	def _run_async(self, cache_key, mp_url, mp_data):
+		self.video_playlists = []
+		self.audio_playlists = []
+		self.subtitles_playlists = []
+
+		def master_playlist_loaded(data):
+			self.process_master_playlist(mp_url, data)
+			self.filter_master_playlist()
+			return self.load_media_playlists_async()
+
+		def get_keys(result):
+			drm_keys = {}
+			ds = []
+			for p in self.video_playlists + self.audio_playlists:
+				if p.has_segments() and len(p.pssh) > 0:
+					d = maybeDeferred(self.get_drm_keys_async, p.pssh)
+					d.addCallback(lambda keys, p=p: drm_keys.__setitem__(p, keys))
+					ds.append(d)
+
+			return DeferredList(ds, fireOnOneErrback=True, consumeErrors=True).addCallbacks(lambda result: drm_keys, lambda f: f.value.subFailure)
+
+		def build(drm_keys):
+			mpd = self.build_mpd_string(drm_keys).encode('utf-8')
+			if cache_key is not None:
+				self.mpd_cache.put(cache_key, mpd, self.get_mpd_cache_ttl())
+			return mpd
+
+		if mp_data:
+			d = succeed(mp_data)
+		else:
+			d = self.load_http_data_async(mp_url)
+
+		d.addCallback(master_playlist_loaded)
+		d.addCallback(get_keys)
+		d.addCallback(build)
+		return d
+
+	# ##################################################################################################################
+
+	def get_metrics_name(self):
+		return getattr(self.request_handler, 'metrics_name', None)
+
+	# ##################################################################################################################
+
 	def filter_master_playlist(self):
 		# just simple default filter that gets the best stream by bandwidth
 		playlists = self.video_playlists
@@ -310,3 +560,10 @@ class Hls2Mpd(object):
 		return None
 
 	# ##################################################################################################################
+
+	def get_drm_keys_async(self, pssh):
+		# non blocking version of get_drm_keys() - it can return keys or Deferred
+		# get_drm_keys() of subclass usually requests licence server, so by default it runs outside of reactor thread
+		return deferToThread(self.get_drm_keys, pssh)
+
+	# ##################################################################################################################
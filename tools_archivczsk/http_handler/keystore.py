@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+import os, json, hmac, hashlib, threading
+from time import time
+from tools_cenc.cencdecrypt import aes_ctr_decrypt, is_available as aes_available
+
+# #################################################################################################
+
+_FILE_MAGIC = b'DKS1'
+
+try:
+	_compare_digest = hmac.compare_digest
+except AttributeError:
+	# python < 2.7.7
+	def _compare_digest(a, b):
+		return a == b
+
+class DrmKeyStore(object):
+	'''
+	Store of DRM content keys indexed by PSSH and by KID. Each entry has expiration time. Store is persisted to file,
+	so keys survive restart of enigma2. If AES implementation is available, then file is encrypted at rest - random
+	encryption key is stored in separate file with restricted access rights.
+
+	Use DrmKeyStore.get_instance() to get store shared by all handlers using the same file.
+	'''
+	_instances = {}
+	_instances_lock = threading.Lock()
+
+	def __init__(self, file_name=None, encrypt=True, log_error=None):
+		self.file_name = file_name
+		self.encrypt = encrypt and aes_available()
+		self.log_error = log_error
+		self.lock = threading.RLock()
+		self.pssh = {} # pssh -> { 'keys': ['kid:key', ...], 'expires': timestamp }
+		self.kid = {} # kid -> { 'key': key, 'expires': timestamp }
+		self.hits = 0
+		self.misses = 0
+		self.load()
+
+	# #################################################################################################
+
+	@classmethod
+	def get_instance(cls, file_name, encrypt=True, log_error=None):
+		with cls._instances_lock:
+			store = cls._instances.get(file_name)
+			if store is None:
+				store = cls(file_name, encrypt, log_error)
+				cls._instances[file_name] = store
+
+			return store
+
+	# #################################################################################################
+
+	def _log_error(self, msg):
+		if self.log_error:
+			self.log_error(msg)
+
+	# #################################################################################################
+
+	def _get_secret(self, create=False):
+		secret_file = self.file_name + '.key'
+		try:
+			with open(secret_file, 'rb') as f:
+				secret = f.read()
+
+			if len(secret) == 32:
+				return secret
+		except (IOError, OSError):
+			pass
+
+		if not create:
+			return None
+
+		secret = os.urandom(32)
+		fd = os.open(secret_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+		try:
+			os.write(fd, secret)
+		finally:
+			os.close(fd)
+
+		return secret
+
+	# #################################################################################################
+
+	def _encode(self, data):
+		if not self.encrypt:
+			return data
+
+		secret = self._get_secret(create=True)
+		iv = os.urandom(16)
+		enc_data = aes_ctr_decrypt(secret[:16], iv, data) # CTR mode - encryption is the same as decryption
+		mac = hmac.new(secret[16:], iv + enc_data, hashlib.sha256).digest()
+		return _FILE_MAGIC + iv + mac + enc_data
+
+	def _decode(self, data):
+		if not data.startswith(_FILE_MAGIC):
+			# not encrypted
+			return data
+
+		secret = self._get_secret()
+		if secret is None or not aes_available():
+			raise Exception("Key store is encrypted, but encryption key is not available")
+
+		iv = data[4:20]
+		mac = data[20:52]
+		enc_data = data[52:]
+		if not _compare_digest(hmac.new(secret[16:], iv + enc_data, hashlib.sha256).digest(), mac):
+			raise Exception("Key store data are corrupted")
+
+		return aes_ctr_decrypt(secret[:16], iv, enc_data)
+
+	# #################################################################################################
+
+	def load(self):
+		if not self.file_name:
+			return
+
+		try:
+			with open(self.file_name, 'rb') as f:
+				data = json.loads(self._decode(f.read()).decode('utf-8'))
+		except (IOError, OSError):
+			return
+		except Exception as e:
+			self._log_error("Failed to load DRM key store %s: %s" % (self.file_name, str(e)))
+			return
+
+		cur_time = time()
+		with self.lock:
+			for pssh, entry in data.get('pssh', {}).items():
+				if entry['expires'] > cur_time:
+					self._add(pssh, entry['keys'], entry['expires'])
+
+	def save(self):
+		if not self.file_name:
+			return
+
+		cur_time = time()
+		with self.lock:
+			data = {
+				'pssh': dict((k, v) for k, v in self.pssh.items() if v['expires'] > cur_time and v['keys'])
+			}
+
+		try:
+			tmp_file = self.file_name + '.tmp'
+			with open(tmp_file, 'wb') as f:
+				f.write(self._encode(json.dumps(data).encode('utf-8')))
+			os.rename(tmp_file, self.file_name)
+		except Exception as e:
+			self._log_error("Failed to save DRM key store %s: %s" % (self.file_name, str(e)))
+
+	# #################################################################################################
+
+	def _add(self, pssh, keys, expires):
+		self.pssh[pssh] = { 'keys': keys, 'expires': expires }
+		for k in keys:
+			kid, key = k.split(':')
+			self.kid[kid.lower()] = { 'key': key, 'expires': expires }
+
+	# #################################################################################################
+
+	def get(self, pssh):
+		'''
+		Returns list of keys ('kid:key') for pssh or None if keys are not known or already expired.
+		Empty list means, that getting of keys failed recently.
+		'''
+		entry = self.pssh.get(pssh)
+		if entry is None or entry['expires'] <= time():
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		return entry['keys']
+
+	def get_key(self, kid):
+		'''
+		Returns content key for KID (hex string) or None
+		'''
+		entry = self.kid.get(kid.replace('-', '').lower())
+		if entry is None or entry['expires'] <= time():
+			return None
+
+		return entry['key']
+
+	def put(self, pssh, keys, ttl):
+		'''
+		Stores keys for pssh, that will be valid for ttl seconds
+		'''
+		with self.lock:
+			self._add(pssh, keys, time() + ttl)
+			self.cleanup()
+
+		if keys:
+			self.save()
+
+	def invalidate(self, pssh):
+		'''
+		Removes keys for pssh - used when decryption with stored keys failed, so new keys are requested next time
+		'''
+		with self.lock:
+			entry = self.pssh.pop(pssh, None)
+			if entry is None:
+				return
+
+			for k in entry['keys']:
+				self.kid.pop(k.split(':')[0].lower(), None)
+
+		self.save()
+
+	def cleanup(self):
+		'''
+		Removes expired entries
+		'''
+		cur_time = time()
+		with self.lock:
+			for d in (self.pssh, self.kid):
+				for k in [k for k, v in d.items() if v['expires'] <= cur_time]:
+					del d[k]
+
+	def clear(self):
+		with self.lock:
+			self.pssh = {}
+			self.kid = {}
+
+		self.save()
+
+	# #################################################################################################
+
+	def get_stats(self):
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'pssh_entries': len(self.pssh),
+			'kid_entries': len(self.kid),
+		}
+
+# #################################################################################################
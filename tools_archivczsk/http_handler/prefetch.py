@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from twisted.internet.defer import maybeDeferred
+from ..cache import LRUCache
+
+# #################################################################################################
+
+class SegmentPrefetcher(object):
+	'''
+	Read-ahead cache for proxied segments. When player requests a segment, then next segments predicted by request handler
+	are downloaded (and decrypted) in background and stored in memory. When player asks for them, they are served directly
+	from memory. Size of memory cache is limited - the oldest segments are removed first.
+	'''
+	def __init__(self, request_handler, segments=2, max_cache_size=16 * 1024 * 1024):
+		self.request_handler = request_handler
+		self.segments = segments
+		self.max_cache_size = max_cache_size
+		self.cache = OrderedDict() # key -> (data, headers)
+		self.cache_size = 0
+		self.pending = {} # key -> list of requests waiting for segment
+		self.next_segments = LRUCache(4096) # segment url -> url of next segment (used for playlists with explicit list of segments)
+		self.hits = 0
+		self.misses = 0
+		self.prefetched = 0
+		self.evictions = 0
+		self.errors = 0
+
+	# #################################################################################################
+
+	def log_devel(self, msg):
+		self.request_handler.log_devel('[Prefetch] ' + msg)
+
+	# #################################################################################################
+
+	def get_stats(self):
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'prefetched': self.prefetched,
+			'evictions': self.evictions,
+			'errors': self.errors,
+			'cached_segments': len(self.cache),
+			'cached_bytes': self.cache_size,
+			'pending': len(self.pending),
+		}
+
+	# #################################################################################################
+
+	def clear(self):
+		self.cache.clear()
+		self.cache_size = 0
+		self.next_segments.clear()
+
+	# #################################################################################################
+
+	def add_sequence(self, urls):
+		'''
+		Registers ordered list of segment urls (for example segments from HLS variant playlist), so they can be later used for prediction
+		'''
+		for i in range(len(urls) - 1):
+			self.next_segments.put(urls[i], urls[i + 1])
+
+	# #################################################################################################
+
+	def get_next_from_sequence(self, url):
+		ret = []
+		for i in range(self.segments):
+			url = self.next_segments.get(url)
+			if url == None:
+				break
+			ret.append(url)
+
+		return ret
+
+	# #################################################################################################
+
+	def serve(self, request, key):
+		'''
+		Tries to serve segment identified by key from cache. Returns True if request was (or will be) handled by prefetcher.
+		'''
+		if request.getHeader(b'Range') != None:
+			# partial requests are not handled by prefetcher
+			return False
+
+		if key in self.cache:
+			data, headers = self.cache.pop(key)
+			self.cache_size -= len(data)
+			self.hits += 1
+			self.log_devel("Serving segment from cache: %s" % key)
+			self.write_response(request, data, headers)
+			return True
+
+		if key in self.pending:
+			# segment download is already running - wait for it
+			self.hits += 1
+			self.log_devel("Waiting for prefetched segment: %s" % key)
+			flags = { 'finished': False }
+			request.notifyFinish().addBoth(lambda reason: flags.update({ 'finished': True }))
+			self.pending[key].append((request, flags))
+			return True
+
+		self.misses += 1
+		return False
+
+	# #################################################################################################
+
+	def write_response(self, request, data, headers):
+		if data == None:
+			request.setResponseCode(501)
+		else:
+			request.setResponseCode(200)
+			for k, v in headers.items():
+				request.setHeader(k, v)
+			request.write(data)
+
+		request.finish()
+
+	# #################################################################################################
+
+	def prefetch(self, items, process_cbk=None, headers=None):
+		'''
+		Starts download of segments in background.
+		items - list of tuples (key, url)
+		process_cbk - function, that is called with downloaded segment data and should return processed data (or Deferred)
+		'''
+		for key, url in items:
+			if key in self.cache or key in self.pending:
+				continue
+
+			self.log_devel("Prefetching segment: %s" % url)
+			self.pending[key] = []
+			self.request_handler.request_http_data_async_simple(url, cbk=self.segment_received, headers=headers, key=key, process_cbk=process_cbk)
+
+	# #################################################################################################
+
+	def segment_received(self, response, key, process_cbk):
+		if response['status_code'] != 200:
+			self.request_handler.cp.log_error("Failed to prefetch segment %s - response code: %d" % (key, response['status_code']))
+			self.errors += 1
+			self.segment_processed(None, key, response)
+			return
+
+		if process_cbk:
+			d = maybeDeferred(process_cbk, response['content'])
+		else:
+			d = maybeDeferred(lambda: response['content'])
+
+		def process_failed(failure):
+			self.request_handler.cp.log_error("Failed to process prefetched segment %s: %s" % (key, str(failure)))
+			self.errors += 1
+			return None
+
+		d.addErrback(process_failed)
+		d.addCallback(self.segment_processed, key, response)
+
+	# #################################################################################################
+
+	def segment_processed(self, data, key, response):
+		waiting = self.pending.pop(key, [])
+		headers = response['headers']
+
+		if data != None:
+			self.prefetched += 1
+
+		if waiting:
+			# someone is already waiting for this segment - don't put it to cache
+			for request, flags in waiting:
+				if not flags['finished']:
+					self.write_response(request, data, headers)
+			return
+
+		if data == None:
+			return
+
+		self.cache[key] = (data, headers)
+		self.cache_size += len(data)
+
+		while self.cache_size > self.max_cache_size and self.cache:
+			k, v = self.cache.popitem(last=False)
+			self.cache_size -= len(v[0])
+			self.evictions += 1
+
+# #################################################################################################
@@ -3,13 +3,20 @@
 import os, base64
 from Plugins.Extensions.archivCZSK.engine.httpserver import AddonHttpRequestHandler
 from Plugins.Extensions.archivCZSK.settings import USER_AGENT
-from ..cache import SimpleAutokeyExpiringCache
+from ..cache import SimpleAutokeyExpiringCache, SingleFlight
+from ..metrics import metrics, monotonic
+from .prefetch import SegmentPrefetcher
+from .keystore import DrmKeyStore
 import json
+from io import BytesIO
 
 from twisted.web.client import CookieAgent, RedirectAgent, Agent, HTTPConnectionPool
 from twisted.web.http_headers import Headers
 from twisted.internet.protocol import Protocol
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList, maybeDeferred, succeed
+from twisted.internet.threads import deferToThread
+from twisted.web.client import FileBodyProducer
 
 try:
 	from cookielib import CookieJar
@@ -17,6 +24,7 @@ except:
 	from http.cookiejar import CookieJar
 
 from tools_cenc.wvdecrypt import WvDecrypt
+from tools_cenc.cencdecrypt import CencStreamDecrypter, InitSegment, is_available as internal_decrypt_available
 from binascii import crc32
 
 # #################################################################################################
@@ -87,7 +95,33 @@ class HTTPRequestHandlerTemplate(AddonHttpRequestHandler, object):
 
 		self.enable_devel_logs = os.path.isfile('/tmp/archivczsk_enable_devel_logs')
 		self.wvdecrypt = WvDecrypt(enable_logging=self.enable_devel_logs)
-		self.pssh = {}
+
+		# DRM keys are stored in key store shared by all handlers of addon and persisted in addon's data dir
+		data_dir = getattr(self.cp, 'data_dir', None)
+		self.drm_keystore = DrmKeyStore.get_instance(os.path.join(data_dir, 'drm_keys.bin') if data_dir else None, log_error=self.cp.log_error)
+		self.drm_keys_ttl = 8 * 3600 # how long are received keys valid when licence doesn't specify its duration
+		self.drm_keys_failed_ttl = 60 # when getting of keys fails, then don't try it again for this time
+		self.drm_single_flight = SingleFlight()
+		self.segment_prefetcher = None
+		self.metrics_name = getattr(self.cp, 'name', None) or self.name # metrics are grouped by name of content provider
+		metrics.register_source('scache', self.scache, self.metrics_name)
+		metrics.register_source('drm_keystore', self.drm_keystore, self.metrics_name)
+
+	# #################################################################################################
+
+	def enable_segment_prefetch(self, segments=2, max_cache_size=16 * 1024 * 1024):
+		'''
+		Enables read-ahead of proxied segments. When player requests segment, then next segments are downloaded (and decrypted)
+		in background and kept in memory until player asks for them.
+		segments - how many segments to download ahead
+		max_cache_size - max. size of memory used for prefetched segments (in bytes)
+		'''
+		if segments > 0:
+			self.segment_prefetcher = SegmentPrefetcher(self, segments, max_cache_size)
+			metrics.register_source('segment_prefetch', self.segment_prefetcher, self.metrics_name)
+		else:
+			self.segment_prefetcher = None
+			metrics.unregister_source('segment_prefetch', self.metrics_name)
 
 	# #################################################################################################
 
@@ -156,7 +190,25 @@ class HTTPRequestHandlerTemplate(AddonHttpRequestHandler, object):
 		d = self.cookie_agent.request( b'GET', url.encode('utf-8'), request_headers, None)
 		timeout_call = reactor.callLater(timeout, d.cancel)
 
+		# statistics
+		start_time = monotonic()
+		stats = { 'bytes': 0 }
+		cbk_data_orig = cbk_data
+
+		def cbk_data(data):
+			if data == None:
+				metrics.observe('http_request', monotonic() - start_time, self.metrics_name)
+				metrics.inc('http_request.bytes', stats['bytes'], self.metrics_name)
+			else:
+				stats['bytes'] += len(data)
+
+			cbk_data_orig(data)
+
 		def request_created(response):
+			metrics.observe('http_request.ttfb', monotonic() - start_time, self.metrics_name)
+			if response.code >= 400:
+				metrics.inc('http_request.errors', 1, self.metrics_name)
+
 			cbk_response_code(response.code, response.request.absoluteURI)
 
 #			self.log_devel("Response headers: %d" % response.code)
@@ -171,6 +223,7 @@ class HTTPRequestHandlerTemplate(AddonHttpRequestHandler, object):
 
 		def request_failed(response):
 			self.cp.log_error('Request for url %s failed: %s' % (url, str(response)))
+			metrics.inc('http_request.errors', 1, self.metrics_name)
 
 			cbk_response_code(500, '')
 			cbk_data(None)
@@ -190,6 +243,9 @@ class HTTPRequestHandlerTemplate(AddonHttpRequestHandler, object):
 			'content': b''
 		}
 
+		# received chunks are collected in list and joined at the end - repeated concatenation of bytes is quadratic
+		chunks = []
+
 		def cbk_response_code(rcode, rurl):
 			response['status_code'] = rcode
 			response['url'] = rurl.decode('utf-8')
@@ -199,17 +255,271 @@ class HTTPRequestHandlerTemplate(AddonHttpRequestHandler, object):
 
 		def cbk_data(data):
 			if data == None:
+				response['content'] = b''.join(chunks)
+				del chunks[:]
 				try:
 					cbk(response, **kwargs)
 				except:
 					self.cp.log_exception()
 			else:
-				response['content'] += data
+				chunks.append(data)
 
 		return self.request_http_data_async( url, cbk_response_code, cbk_header, cbk_data, headers=headers, range=range)
 
 	# #################################################################################################
 
+	def request_drm_segment_async(self, request, url, keys_cbk=None, init_data=None, init_cbk=None, fallback_cbk=None, invalidate_keys_cbk=None):
+		'''
+		Requests DRM protected segment and writes it to request. Media segment is decrypted on the fly - decrypted data are
+		written to request as soon as all samples covering them are received, so player doesn't need to wait for whole segment.
+		Decryption runs outside of reactor thread - received chunks are processed one by one in the same order as they came.
+
+		keys_cbk - function that returns list of keys needed to decrypt media segment (or Deferred, that fires with it)
+		init_data - init segment (raw data or InitSegment) that belongs to requested media segment
+		init_cbk - if set, then requested segment is init segment. It is passed to player without modification and
+		           when completely received, init_cbk is called with parsed InitSegment
+		fallback_cbk - function, that is called with complete segment data when decryption on the fly is not possible.
+		           It needs to return Deferred, that fires with decrypted data.
+		invalidate_keys_cbk - function, that is called when decryption of media segment with received keys failed
+		'''
+		state = {
+			'code': None,
+			'headers': {},
+			'started': False,
+			'finished': False,
+			'error': False,
+			'decrypter': None,
+			'decrypt_chain': succeed(None), # getting of keys and processing of received chunks by decrypter in worker thread
+			'chunks': [], # raw segment data - kept only until first data are written to request
+		}
+		start_time = monotonic()
+
+		def request_finished(reason):
+			state['finished'] = True
+
+		def write_data(data):
+			if state['finished']:
+				return
+
+			if not state['started']:
+				state['started'] = True
+				request.setResponseCode(state['code'])
+				for k,v in state['headers'].items():
+					request.setHeader(k, v)
+
+			request.write(data)
+			if not init_cbk:
+				# decrypted data were sent to player, so fallback to full segment decryption is not possible anymore
+				state['chunks'] = None
+
+		def write_data_from_thread(data):
+			reactor.callFromThread(write_data, data)
+
+		def finish_request(code=None):
+			if not init_cbk:
+				metrics.observe('drm_segment', monotonic() - start_time, self.metrics_name)
+				if code or state['error']:
+					metrics.inc('drm_segment.errors', 1, self.metrics_name)
+
+			if state['finished']:
+				return
+
+			if code and not state['started']:
+				request.setResponseCode(code)
+
+			request.finish()
+
+		def fallback_written(data):
+			if not data:
+				self.cp.log_error('Failed to decrypt segment: %s' % url)
+				finish_request(501)
+			else:
+				write_data(data)
+				finish_request()
+
+		def fallback_failed(failure):
+			self.cp.log_error('Failed to decrypt segment %s: %s' % (url, str(failure)))
+			finish_request(501)
+
+		def run_fallback():
+			d = fallback_cbk(b''.join(state['chunks']))
+			state['chunks'] = None
+			d.addCallback(fallback_written)
+			d.addErrback(fallback_failed)
+
+		def decrypt_failed(failure):
+			state['decrypter'] = None
+			if state['started']:
+				# data were already sent to player - there is no way back
+				self.cp.log_error('Decryption of segment %s failed: %s' % (url, failure.getErrorMessage()))
+				state['error'] = True
+				if invalidate_keys_cbk:
+					invalidate_keys_cbk()
+				finish_request()
+			else:
+				self.cp.log_error('Decryption on the fly of segment %s failed (%s) - falling back to full segment decryption' % (url, failure.getErrorMessage()))
+
+		def decrypt_finish_failed(failure):
+			self.cp.log_error('Decryption of segment %s failed: %s' % (url, failure.getErrorMessage()))
+			if invalidate_keys_cbk:
+				invalidate_keys_cbk()
+			finish_request()
+
+		def decrypt_step(result, data):
+			# called in reactor thread after processing of previous chunk is done
+			if state['finished']:
+				return
+
+			if state['error']:
+				if data == None and not state['started']:
+					finish_request(501)
+				return
+
+			decrypter = state['decrypter']
+			if decrypter == None:
+				# decryption on the fly failed - wait for complete segment
+				if data == None:
+					run_fallback()
+				return
+
+			if data == None:
+				d = deferToThread(decrypter.finish)
+				d.addCallbacks(lambda result: finish_request(), decrypt_finish_failed)
+			else:
+				d = deferToThread(decrypter.feed, data)
+				d.addErrback(decrypt_failed)
+			return d
+
+		def keys_received(keys):
+			if not keys:
+				self.cp.log_error("No keys to decrypt DRM protected content")
+				state['error'] = True
+				state['chunks'] = None
+				return
+
+			self.log_devel("Keys for pssh: %s" % str(keys))
+			if internal_decrypt_available():
+				state['decrypter'] = CencStreamDecrypter(keys, init_data, write_data_from_thread)
+
+		def keys_failed(failure):
+			self.cp.log_error("Failed to get keys to decrypt DRM protected content: %s" % failure.getErrorMessage())
+			keys_received(None)
+
+		def cbk_response_code(code, rurl):
+			state['code'] = code
+
+		def cbk_header(k, v):
+			state['headers'][k] = v
+
+		def cbk_data(data):
+			if state['code'] >= 400:
+				if data == None:
+					self.cp.log_error("Response code for DRM protected segment: %d" % state['code'])
+					finish_request(403)
+				return
+
+			if init_cbk:
+				if data == None:
+					init_cbk(InitSegment(b''.join(state['chunks'])))
+					finish_request()
+				else:
+					state['chunks'].append(data)
+					write_data(data)
+				return
+
+			if data != None and state['chunks'] != None:
+				state['chunks'].append(data)
+
+			# chunks are processed after keys are available - in the same order as they were received
+			state['decrypt_chain'].addCallback(decrypt_step, data)
+
+		if not init_cbk:
+			# keys are requested in parallel with segment data
+			state['decrypt_chain'] = maybeDeferred(keys_cbk)
+			state['decrypt_chain'].addCallbacks(keys_received, keys_failed)
+
+		self.request_http_data_async(url, cbk_response_code, cbk_header, cbk_data, range=request.getHeader(b'Range'))
+		request.notifyFinish().addBoth(request_finished)
+		return self.NOT_DONE_YET
+
+	# #################################################################################################
+
+	def request_http_post_async(self, url, data, headers=None):
+		'''
+		Sends POST request with data using cookie agent. Returns Deferred, that fires with response dictionary (the same as
+		for request_http_data_async_simple())
+		'''
+		timeout = int(self.cp.get_setting('loading_timeout'))
+		if timeout == 0:
+			timeout = 5 # it will be very silly to disable timeout, so set 5s here as default
+
+		request_headers = Headers()
+
+		if headers:
+			for k, v in headers.items():
+				request_headers.addRawHeader(k.encode('utf-8'), v.encode('utf-8'))
+
+		if not request_headers.hasHeader('User-Agent'):
+			request_headers.addRawHeader(b'User-Agent', USER_AGENT.encode('utf-8'))
+
+		d = self.cookie_agent.request(b'POST', url.encode('utf-8'), request_headers, FileBodyProducer(BytesIO(data)))
+		timeout_call = reactor.callLater(timeout, d.cancel)
+		d_response = Deferred()
+
+		response_data = {
+			'status_code': None,
+			'url': url,
+			'headers': {},
+			'content': b''
+		}
+		chunks = []
+
+		def cbk_data(data):
+			if data == None:
+				response_data['content'] = b''.join(chunks)
+				d_response.callback(response_data)
+			else:
+				chunks.append(data)
+
+		def request_created(response):
+			response_data['status_code'] = response.code
+			response_data['url'] = response.request.absoluteURI.decode('utf-8')
+			for k,v in response.headers.getAllRawHeaders():
+				response_data['headers'][k] = v[0]
+
+			response.deliverBody(SegmentDataWriter(self.cp, d, cbk_data, timeout_call))
+
+		def request_failed(failure):
+			if timeout_call.active():
+				timeout_call.cancel()
+			d_response.errback(failure)
+
+		d.addCallbacks(request_created, request_failed)
+		return d_response
+
+	# #################################################################################################
+
+	def get_wv_licence_async(self, drm_info, lic_request):
+		'''
+		Non blocking version of get_wv_licence(). Returns Deferred, that fires with licence data or None on failure.
+		'''
+		def response_received(response):
+			if response['status_code'] != 200:
+				self.cp.log_error("Failed to get DRM licence: response code %d" % response['status_code'])
+				return None
+
+			return response['content']
+
+		def request_failed(failure):
+			self.cp.log_error("Failed to get DRM licence: %s" % str(failure.value))
+			return None
+
+		d = self.request_http_post_async(drm_info['licence_url'], lic_request, drm_info.get('headers'))
+		d.addCallbacks(response_received, request_failed)
+		return d
+
+	# #################################################################################################
+
 	def get_wv_licence(self, drm_info, lic_request):
 		session = self.cp.get_requests_session()
 		try:
@@ -226,30 +536,149 @@ class HTTPRequestHandlerTemplate(AddonHttpRequestHandler, object):
 
 	# #################################################################################################
 
+	def store_drm_keys(self, pssh, keys, duration=None):
+		'''
+		Stores received keys in key store. Keys are valid for licence duration (if reported by CDM) or for drm_keys_ttl.
+		'''
+		if keys:
+			ttl = duration or self.drm_keys_ttl
+			self.cp.log_debug("Received %d keys for pssh %s valid for %d seconds" % (len(keys), pssh, ttl))
+			self.drm_keystore.put(pssh, keys, ttl)
+		else:
+			metrics.inc('drm_keys.errors', 1, self.metrics_name)
+			self.cp.log_error("Failed to get DRM keys for pssh %s" % pssh)
+			self.drm_keystore.put(pssh, [], self.drm_keys_failed_ttl)
+
+		return keys
+
+	# #################################################################################################
+
+	def invalidate_drm_keys(self, pssh_list):
+		'''
+		Removes keys for all PSSHs from key store - called when decryption with them failed, so they are requested again
+		'''
+		for p in set(pssh_list):
+			if self.drm_keystore.get(p):
+				self.cp.log_error("Decryption with keys for pssh %s failed - removing them from key store" % p)
+				metrics.inc('drm_keys.invalidated', 1, self.metrics_name)
+				self.drm_keystore.invalidate(p)
+
+	# #################################################################################################
+
+	def acquire_drm_keys(self, pssh, drm_info, privacy_mode=False):
+		'''
+		Gets keys for pssh from licence server and stores them in key store. This is blocking call - use acquire_drm_keys_async() if possible.
+		'''
+		self.cp.log_debug("Requesting keys for pssh %s from licence server" % pssh)
+		try:
+			with metrics.timer('drm_keys', self.metrics_name):
+				if privacy_mode:
+					keys, duration = self.wvdecrypt.get_content_keys(pssh, lambda lic_request: self.get_wv_licence(drm_info, lic_request), lambda cert_request: self.get_wv_licence(drm_info, cert_request), with_duration=True)
+				else:
+					keys, duration = self.wvdecrypt.get_content_keys(pssh, lambda lic_request: self.get_wv_licence(drm_info, lic_request), with_duration=True)
+		except:
+			self.cp.log_exception()
+			keys, duration = [], None
+
+		return self.store_drm_keys(pssh, keys, duration)
+
+	# #################################################################################################
+
+	def acquire_drm_keys_async(self, pssh, drm_info, privacy_mode=False):
+		'''
+		Non blocking version of acquire_drm_keys(). Licence (and service certificate) requests are sent using cookie agent.
+		Returns Deferred, that fires with list of received keys.
+		'''
+		self.cp.log_debug("Requesting keys for pssh %s from licence server" % pssh)
+		start_time = monotonic()
+		session = { 'id': None }
+
+		def send_licence_request(result=None):
+			return self.get_wv_licence_async(drm_info, self.wvdecrypt.get_license_challenge(session['id']))
+
+		def start():
+			session['id'] = self.wvdecrypt.open_session(pssh)
+			if session['id'] == None:
+				return None
+
+			if privacy_mode:
+				d = self.get_wv_licence_async(drm_info, self.wvdecrypt.get_service_certificate_challenge())
+				d.addCallback(lambda cert: self.wvdecrypt.set_service_certificate(session['id'], cert))
+				d.addCallback(send_licence_request)
+			else:
+				d = send_licence_request()
+
+			d.addCallback(lambda lic_response: self.wvdecrypt.process_license(session['id'], lic_response, with_duration=True))
+			return d
+
+		def failed(failure):
+			self.cp.log_error("Failed to get DRM keys for pssh %s: %s" % (pssh, str(failure.value)))
+			if session['id'] != None:
+				self.wvdecrypt.close_session(session['id'])
+			return None
+
+		def finished(result):
+			metrics.observe('drm_keys', monotonic() - start_time, self.metrics_name)
+			keys, duration = result or ([], None)
+			return self.store_drm_keys(pssh, keys, duration)
+
+		d = maybeDeferred(start)
+		d.addErrback(failed)
+		d.addCallback(finished)
+		return d
+
+	# #################################################################################################
+
 	def get_drm_keys(self, pssh_list, drm_info, privacy_mode=False):
 		keys = []
 		for p in pssh_list:
-			k = self.pssh.get(p)
+			k = self.drm_keystore.get(p)
 			if k == None:
-				self.cp.log_debug("Requesting keys for pssh %s from licence server" % p)
-				if privacy_mode:
-					k = self.wvdecrypt.get_content_keys(p, lambda lic_request: self.get_wv_licence(drm_info, lic_request), lambda cert_request: self.get_wv_licence(drm_info, cert_request))
-				else:
-					k = self.wvdecrypt.get_content_keys(p, lambda lic_request: self.get_wv_licence(drm_info, lic_request))
-				self.pssh[p] = k
-				if k:
-					keys.extend(k)
-					self.cp.log_debug("Received %d keys for pssh %s" % (len(k), p))
-				else:
-					self.cp.log_error("Failed to get DRM keys for pssh %s" % p)
+				k = self.acquire_drm_keys(p, drm_info, privacy_mode)
 			else:
 				self.cp.log_debug("Keys for pssh %s found in cache" % p)
-				keys.extend(k)
+				metrics.inc('drm_keys.cache_hits', 1, self.metrics_name)
+
+			keys.extend(k)
 
 		return keys
 
 	# #################################################################################################
 
+	def get_drm_keys_async(self, pssh_list, drm_info, privacy_mode=False):
+		'''
+		Non blocking version of get_drm_keys(). Keys for all unknown PSSHs are requested in parallel and returned Deferred
+		fires with list of all keys when they are available in key store.
+		'''
+		ds = []
+		for p in set(pssh_list):
+			if self.drm_keystore.get(p) == None:
+				ds.append(self.drm_single_flight.do_deferred(p, self.acquire_drm_keys_async, p, drm_info, privacy_mode))
+			else:
+				self.cp.log_debug("Keys for pssh %s found in cache" % p)
+				metrics.inc('drm_keys.cache_hits', 1, self.metrics_name)
+
+		def collect_keys(result):
+			# only key store is checked here - keys that failed to be received are stored there as empty list
+			keys = []
+			for p in pssh_list:
+				keys.extend(self.drm_keystore.get(p) or [])
+			return keys
+
+		d = DeferredList(ds, consumeErrors=True)
+		d.addCallback(collect_keys)
+		return d
+
+	# #################################################################################################
+
+	def P__stats(self, request, path):
+		'''
+		Returns collected metrics of this addon (and global metrics) as JSON
+		'''
+		return self.reply_ok(request, metrics.dump_json(self.metrics_name, indent=2).encode('utf-8'), "application/json", raw=True)
+
+	# #################################################################################################
+
 	@staticmethod
 	def calc_cache_key(data):
 		return str(crc32(data.encode('utf-8')) & 0xffffffff)
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+""" Simple registry of runtime metrics (timings, byte counts, errors, cache statistics) """
+
+import json
+import threading
+import weakref
+from twisted.python.failure import Failure
+
+try:
+	# monotonic is available from ArchivCZSK version 2.6.0
+	from Plugins.Extensions.archivCZSK.engine.tools.monotonic import monotonic
+except:
+	# fallback for older versions
+	from time import time as monotonic
+
+# #################################################################################################
+
+# upper bounds of histogram buckets in milliseconds - last bucket is for everything above
+_HISTOGRAM_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+_GLOBAL = '_global'
+
+# #################################################################################################
+
+class Histogram(object):
+	__slots__ = ('counts', 'count', 'sum', 'min', 'max')
+
+	def __init__(self):
+		self.counts = [0] * (len(_HISTOGRAM_BUCKETS) + 1)
+		self.count = 0
+		self.sum = 0.0
+		self.min = None
+		self.max = None
+
+	def observe(self, value):
+		'''
+		Adds one measured value (in milliseconds)
+		'''
+		i = 0
+		for bound in _HISTOGRAM_BUCKETS:
+			if value <= bound:
+				break
+			i += 1
+
+		self.counts[i] += 1
+		self.count += 1
+		self.sum += value
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+
+	def percentile(self, p):
+		'''
+		Returns upper bound of bucket, where p-th percentile lies (or max value for last bucket)
+		'''
+		if self.count == 0:
+			return None
+
+		limit = self.count * p / 100.0
+		total = 0
+		for i, cnt in enumerate(self.counts):
+			total += cnt
+			if total >= limit:
+				return round(min(_HISTOGRAM_BUCKETS[i], self.max) if i < len(_HISTOGRAM_BUCKETS) else self.max, 3)
+
+		return round(self.max, 3)
+
+	def to_dict(self):
+		buckets = {}
+		for i, cnt in enumerate(self.counts):
+			if cnt:
+				buckets['le_%d' % _HISTOGRAM_BUCKETS[i] if i < len(_HISTOGRAM_BUCKETS) else 'inf'] = cnt
+
+		return {
+			'count': self.count,
+			'sum_ms': round(self.sum, 3),
+			'avg_ms': round(self.sum / self.count, 3) if self.count else None,
+			'min_ms': round(self.min, 3) if self.min is not None else None,
+			'max_ms': round(self.max, 3) if self.max is not None else None,
+			'p50_ms': self.percentile(50),
+			'p95_ms': self.percentile(95),
+			'buckets': buckets,
+		}
+
+# #################################################################################################
+
+class Timer(object):
+	'''
+	Context manager, that measures time of block and stores it to registry
+	'''
+	__slots__ = ('registry', 'name', 'provider', 'start')
+
+	def __init__(self, registry, name, provider):
+		self.registry = registry
+		self.name = name
+		self.provider = provider
+		self.start = None
+
+	def __enter__(self):
+		self.start = monotonic()
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.registry.observe(self.name, monotonic() - self.start, self.provider)
+		if exc_type is not None:
+			self.registry.inc(self.name + '.errors', 1, self.provider)
+		return False
+
+# #################################################################################################
+
+def get_cache_stats(cache):
+	'''
+	Returns statistics of cache from tools_archivczsk.cache module (or any other object with the same counters)
+	'''
+	ret = {}
+	for name in ('hits', 'misses', 'lookups', 'evictions', 'expirations', 'stale_hits', 'disk_hits'):
+		value = getattr(cache, name, None)
+		if value is not None:
+			ret[name] = value
+
+	data = getattr(cache, 'data', None)
+	if data is not None:
+		ret['entries'] = len(data)
+
+	lookups = ret.get('lookups', ret.get('hits', 0) + ret.get('misses', 0))
+	if lookups:
+		ret['hit_ratio'] = round(float(ret.get('hits', 0)) / lookups, 3)
+
+	return ret
+
+# #################################################################################################
+
+class MetricsRegistry(object):
+	'''
+	Registry of metrics divided by provider (addon) name.
+	- timings are stored as histograms (observe(), timer())
+	- byte counts, error counts, ... are simple counters (inc())
+	- sources are objects (caches, prefetchers, ...) that have their own counters - they are read when stats are requested
+	'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.histograms = {}
+		self.counters = {}
+		self.sources = {}
+
+	def _key(self, provider, name):
+		return (provider or _GLOBAL, name)
+
+	def observe(self, name, seconds, provider=None):
+		'''
+		Stores one duration (in seconds) to histogram name
+		'''
+		key = self._key(provider, name)
+		with self.lock:
+			h = self.histograms.get(key)
+			if h is None:
+				h = Histogram()
+				self.histograms[key] = h
+
+			h.observe(seconds * 1000.0)
+
+	def inc(self, name, value=1, provider=None):
+		'''
+		Increments counter name by value
+		'''
+		key = self._key(provider, name)
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def timer(self, name, provider=None):
+		'''
+		Returns context manager, that measures time of with block. When block raises exception, then also error counter is increased.
+		'''
+		return Timer(self, name, provider)
+
+	def timed_deferred(self, name, d, provider=None):
+		'''
+		Measures time until Deferred d fires. Failure or None result are counted as errors. Returns d.
+		'''
+		start = monotonic()
+
+		def finished(result):
+			self.observe(name, monotonic() - start, provider)
+			if result is None or isinstance(result, Failure):
+				self.inc(name + '.errors', 1, provider)
+			return result
+
+		return d.addBoth(finished)
+
+	def register_source(self, name, obj, provider=None, stats_fn=None):
+		'''
+		Registers object with own statistics. stats_fn(obj) is called to get statistics as dictionary - if not set, then
+		obj.get_stats() is used if available, otherwise obj is handled as cache. Only weak reference to obj is stored.
+		'''
+		if stats_fn is None:
+			stats_fn = obj.__class__.get_stats if hasattr(obj, 'get_stats') else get_cache_stats
+
+		with self.lock:
+			self.sources[self._key(provider, name)] = (weakref.ref(obj), stats_fn)
+
+	def unregister_source(self, name, provider=None):
+		with self.lock:
+			self.sources.pop(self._key(provider, name), None)
+
+	def get_stats(self, provider=None):
+		'''
+		Returns all metrics as dictionary provider -> { 'timings', 'counters', 'sources' }. If provider is set, then only
+		his and global metrics are returned.
+		'''
+		ret = {}
+
+		def get_provider_stats(p):
+			if p not in ret:
+				ret[p] = { 'timings': {}, 'counters': {}, 'sources': {} }
+			return ret[p]
+
+		with self.lock:
+			histograms = list(self.histograms.items())
+			counters = list(self.counters.items())
+			sources = list(self.sources.items())
+
+		for (p, name), h in histograms:
+			if provider is None or p in (provider, _GLOBAL):
+				get_provider_stats(p)['timings'][name] = h.to_dict()
+
+		for (p, name), value in counters:
+			if provider is None or p in (provider, _GLOBAL):
+				get_provider_stats(p)['counters'][name] = value
+
+		for (p, name), (ref, stats_fn) in sources:
+			obj = ref()
+			if obj is None:
+				# object doesn't exist anymore
+				with self.lock:
+					if self.sources.get((p, name), (None,))[0] is ref:
+						del self.sources[(p, name)]
+				continue
+
+			if provider is None or p in (provider, _GLOBAL):
+				try:
+					get_provider_stats(p)['sources'][name] = stats_fn(obj)
+				except Exception as e:
+					get_provider_stats(p)['sources'][name] = { 'error': str(e) }
+
+		return ret
+
+	def dump_json(self, provider=None, indent=None):
+		return json.dumps(self.get_stats(provider), indent=indent, sort_keys=True)
+
+	def reset(self, provider=None):
+		'''
+		Removes collected timings and counters (registered sources stay)
+		'''
+		with self.lock:
+			if provider is None:
+				self.histograms.clear()
+				self.counters.clear()
+			else:
+				for d in (self.histograms, self.counters):
+					for key in [k for k in d if k[0] == provider]:
+						del d[key]
+
+# #################################################################################################
+
+# global registry used by all addons
+metrics = MetricsRegistry()
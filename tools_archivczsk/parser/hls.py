@@ -8,7 +8,29 @@ from ..compat import urljoin
 
 # ##################################################################################################################
 
+# one attribute of tag - NAME=VALUE or NAME="QUOTED VALUE" (quoted string can't contain quotation mark)
+_ATTR_RE = re.compile(r'([^\s,="]+)=("[^"]*"|[^\s,"]*)')
+
+# tags handled by parser - other tags are stored in header (until first segment or variant playlist) or dropped
+_TAG_STREAM_INF = 1
+_TAG_EXTINF = 2
+_TAG_MEDIA = 3
+_TAG_KEY = 4
+_TAG_ENDLIST = 5
+
+_TAGS = {
+	'#EXT-X-STREAM-INF': _TAG_STREAM_INF,
+	'#EXTINF': _TAG_EXTINF,
+	'#EXT-X-MEDIA': _TAG_MEDIA,
+	'#EXT-X-KEY': _TAG_KEY,
+	'#EXT-X-ENDLIST': _TAG_ENDLIST,
+}
+
+# ##################################################################################################################
+
 class AttrValue(object):
+	__slots__ = ('value', 'use_qm')
+
 	def __init__(self, value):
 		if value.startswith('"'):
 			self.value = value[1:-1]
@@ -32,6 +54,8 @@ class AttrValue(object):
 # ##################################################################################################################
 
 class PlaylistHeader(object):
+	__slots__ = ('playlist_url', 'attrs')
+
 	def __init__(self, playlist_url, attrs={}):
 		self.playlist_url = playlist_url
 		self.attrs = attrs
@@ -66,24 +90,52 @@ class PlaylistHeader(object):
 # ##################################################################################################################
 
 class SegmentHeader(object):
-	def __init__(self, segment_url, attrs='', key={}):
+	'''
+	Segment of media playlist. Key can be provided as parsed attributes or as raw attributes string - then it is
+	parsed only when somebody accesses it (lazy mode).
+	'''
+	__slots__ = ('segment_url', 'duration', '_key', '_key_raw')
+
+	def __init__(self, segment_url, attrs='', key={}, key_raw=None):
 		self.segment_url = segment_url
 		self.duration = attrs.split(',', 1)[0]
-		self.key = key
+		self._key = key
+		self._key_raw = key_raw
+
+	@property
+	def key(self):
+		if self._key_raw is not None:
+			self._key = HlsPlaylist.parse_attributes(self._key_raw)
+			self._key_raw = None
+
+		return self._key
+
+	@key.setter
+	def key(self, value):
+		self._key = value
+		self._key_raw = None
 
 	def __str__(self):
-		if self.key:
-			key='#EXT-X-KEY:{}\n'.format(','.join('%s=%s' % (k, v.export()) for k, v in self.key.items()))
+		if self._key_raw is not None:
+			# key was not touched - no need to parse and export it again
+			key = '#EXT-X-KEY:' + self._key_raw + '\n'
+		elif self._key:
+			key = '#EXT-X-KEY:' + ','.join('%s=%s' % (k, v.export()) for k, v in self._key.items()) + '\n'
 		else:
 			key = ''
 
-		return '{}#EXTINF:{},\n{}'.format(key, self.duration, self.segment_url)
+		return key + '#EXTINF:' + self.duration + ',\n' + self.segment_url
 
 # ##################################################################################################################
 
 class HlsPlaylist(object):
-	def __init__(self, url):
+	'''
+	Parser of HLS master and media playlists. In lazy mode #EXT-X-KEY attributes of segments are parsed only when
+	they are accessed - useful for long media playlists, where only few tags will be rewritten.
+	'''
+	def __init__(self, url, lazy=False):
 		self.mp_url = url
+		self.lazy = lazy
 		self.header = []
 		self.video_playlists = []
 		self.audio_playlists = []
@@ -105,13 +157,18 @@ class HlsPlaylist(object):
 	@staticmethod
 	def parse_attributes(line):
 		attr = OrderedDict()
-		for a in re.findall(r'(?:[^\s,"]|"(?:\\.|[^"])*")+', line):
-			s = a.split('=')
-			value = '='.join(s[1:])
-			attr[s[0]] = AttrValue(value)
+		for name, value in _ATTR_RE.findall(line):
+			attr[name] = AttrValue(value)
 
 		return attr
 
+	@staticmethod
+	def parse_attributes_raw(line):
+		'''
+		Returns attributes as dictionary name -> value exactly as it is in playlist (including quotation marks)
+		'''
+		return dict(_ATTR_RE.findall(line))
+
 	# ##################################################################################################################
 
 	def add_video_playlist(self, attrs, playlist_url):
@@ -132,8 +189,8 @@ class HlsPlaylist(object):
 
 	# ##################################################################################################################
 
-	def add_segment(self, attrs, segment_url, key={}):
-		s = SegmentHeader(segment_url, attrs, key)
+	def add_segment(self, attrs, segment_url, key={}, key_raw=None):
+		s = SegmentHeader(segment_url, attrs, key, key_raw)
 		self.segments.append(s)
 
 	# ##################################################################################################################
@@ -141,45 +198,61 @@ class HlsPlaylist(object):
 	def parse(self, playlist_data):
 		attrs = {}
 		key = {}
+		key_raw = None
 		in_header = True
 		video_playlist = False
+		tags = _TAGS
+		lazy = self.lazy
+		header = self.header
 
-		for line in iter(playlist_data.splitlines()):
+		for line in playlist_data.splitlines():
 			line = line.strip()
 			if not line:
 				continue
 
-			if not line.startswith('#'):
+			if line[0] != '#':
 				if video_playlist:
 					self.add_video_playlist(attrs, line)
 				else:
-					self.add_segment(attrs, line, key)
+					self.add_segment(attrs, line, key, key_raw)
 					key = {}
+					key_raw = None
 				attrs = {}
+				continue
 
-			elif line.startswith('#EXT-X-STREAM-INF:'):
-				in_header = False
-				video_playlist = True
-				attrs = self.parse_attributes(line[18:])
-			elif line.startswith('#EXTINF:'):
+			pos = line.find(':')
+			tag = tags.get(line if pos == -1 else line[:pos])
+
+			if tag is None:
+				if in_header:
+					header.append(line)
+			elif tag == _TAG_EXTINF:
 				in_header = False
 				video_playlist = False
 				attrs = line[8:]
-			elif line.startswith('#EXT-X-MEDIA:'):
+			elif tag == _TAG_KEY:
+				if lazy:
+					key_raw = line[11:]
+				else:
+					key = self.parse_attributes(line[11:])
+			elif tag == _TAG_STREAM_INF:
+				in_header = False
+				video_playlist = True
+				attrs = self.parse_attributes(line[18:])
+			elif tag == _TAG_MEDIA:
 				in_header = False
 				self.add_media_playlist(self.parse_attributes(line[13:]))
-			elif line.startswith('#EXT-X-KEY:'):
-				key = self.parse_attributes(line[11:])
-			elif line == '#EXT-X-ENDLIST':
-				self.finished = True
-			elif in_header:
-				self.header.append(line)
+			elif tag == _TAG_ENDLIST:
+				if pos == -1:
+					self.finished = True
+				elif in_header:
+					header.append(line)
 
 	# ##################################################################################################################
 
 	def process(self, mp_data=None):
 		if not mp_data:
-			mp_data = self.load_http_data(self.mp_url)
+			mp_data = self.load_http_data()
 		self.parse(mp_data)
 
 		# filter out not needed data from master playlist in order to speed up all another operations
@@ -247,7 +320,7 @@ class HlsPlaylist(object):
 			p.playlist_url = urljoin(self.mp_url, p.playlist_url)
 
 		for s in self.segments:
-			s.segment_url = urljoin(self.mp_url, p.segment_url)
+			s.segment_url = urljoin(self.mp_url, s.segment_url)
 
 	# ##################################################################################################################
 
@@ -0,0 +1,732 @@
+# -*- coding: utf-8 -*-
+#
+# In-process decrypter of CENC protected fragmented MP4 segments (ISO/IEC 23001-7).
+# Supports cenc, cens, cbc1 and cbcs protection schemes, sample encryption data stored
+# in senc (or PIFF uuid) box or referenced by saiz/saio boxes.
+#
+# Decryption is done in place - sizes of samples don't change, so all offsets in moof
+# stay valid. Boxes that carry encryption informations are renamed to 'free' in the
+# output segment, so player will not try to decrypt data again.
+
+import struct
+from collections import deque
+from binascii import a2b_hex, b2a_hex
+
+_aes_impl = None
+
+try:
+	from Cryptodome.Cipher import AES
+	from Cryptodome.Util import Counter
+	_aes_impl = 'pycryptodome'
+except:
+	pass
+
+if _aes_impl == None:
+	try:
+		from Crypto.Cipher import AES
+		from Crypto.Util import Counter
+		_aes_impl = 'pycrypto'
+	except:
+		pass
+
+if _aes_impl == None:
+	try:
+		from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+		from cryptography.hazmat.backends import default_backend
+		_aes_impl = 'cryptography'
+	except:
+		pass
+
+# #################################################################################################
+
+if _aes_impl == 'cryptography':
+	def aes_ctr_decrypt(key, iv, data):
+		d = Cipher(algorithms.AES(key), modes.CTR(iv), backend=default_backend()).decryptor()
+		return d.update(data) + d.finalize()
+
+	def aes_cbc_decrypt(key, iv, data):
+		d = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend()).decryptor()
+		return d.update(data) + d.finalize()
+
+elif _aes_impl != None:
+	def aes_ctr_decrypt(key, iv, data):
+		ctr = Counter.new(128, initial_value=int(b2a_hex(iv), 16))
+		return AES.new(key, AES.MODE_CTR, counter=ctr).decrypt(data)
+
+	def aes_cbc_decrypt(key, iv, data):
+		return AES.new(key, AES.MODE_CBC, iv).decrypt(data)
+
+else:
+	aes_ctr_decrypt = None
+	aes_cbc_decrypt = None
+
+
+def is_available():
+	'''
+	Returns True if AES implementation needed for internal decryption is available
+	'''
+	return _aes_impl != None
+
+# #################################################################################################
+
+PIFF_SENC_UUID = a2b_hex('a2394f525a9b4f14a2446c427c648df4')
+PROTECTED_SAMPLE_ENTRIES = (b'encv', b'enca', b'enct', b'encs', b'encm')
+
+_u8 = struct.Struct('>B')
+_u16 = struct.Struct('>H')
+_u32 = struct.Struct('>I')
+_u64 = struct.Struct('>Q')
+_subsample = struct.Struct('>HI')
+
+
+class CencDecryptError(Exception):
+	pass
+
+
+def iter_boxes(data, start, end):
+	'''
+	Iterates over boxes in data[start:end] and returns tuples (box_type, box_start, payload_start, box_end)
+	'''
+	pos = start
+	while pos + 8 <= end:
+		size = _u32.unpack_from(data, pos)[0]
+		box_type = bytes(data[pos + 4:pos + 8])
+		payload = pos + 8
+
+		if size == 1:
+			size = _u64.unpack_from(data, payload)[0]
+			payload += 8
+		elif size == 0:
+			size = end - pos
+
+		if size < payload - pos or pos + size > end:
+			raise CencDecryptError("Invalid size of box %s at position %d" % (box_type, pos))
+
+		if box_type == b'uuid':
+			payload += 16
+
+		yield box_type, pos, payload, pos + size
+		pos += size
+
+
+def find_box(data, start, end, box_type):
+	for t, bstart, pstart, bend in iter_boxes(data, start, end):
+		if t == box_type:
+			return bstart, pstart, bend
+
+	return None
+
+# #################################################################################################
+
+class TrackEncryptionInfo(object):
+	'''
+	Encryption parameters of one track - extracted from tenc box
+	'''
+	__slots__ = ('scheme', 'kid', 'iv_size', 'constant_iv', 'crypt_byte_block', 'skip_byte_block', 'protected')
+
+	def __init__(self, scheme=b'cenc', kid=None, iv_size=8, constant_iv=None, crypt_byte_block=0, skip_byte_block=0, protected=True):
+		self.scheme = scheme
+		self.kid = kid
+		self.iv_size = iv_size
+		self.constant_iv = constant_iv
+		self.crypt_byte_block = crypt_byte_block
+		self.skip_byte_block = skip_byte_block
+		self.protected = protected
+
+# #################################################################################################
+
+class InitSegment(object):
+	'''
+	Parsed init segment. Holds informations about encryption of all tracks and default sample values
+	from trex boxes. Original data are preserved in data attribute.
+	'''
+	def __init__(self, data):
+		self.data = data
+		self.tracks = {}
+		self.trex = {}
+
+		if data:
+			try:
+				self.parse(data)
+			except CencDecryptError:
+				pass
+
+	# #################################################################################################
+
+	def parse(self, data):
+		moov = find_box(data, 0, len(data), b'moov')
+		if not moov:
+			return
+
+		for t, bstart, pstart, bend in iter_boxes(data, moov[1], moov[2]):
+			if t == b'trak':
+				self.parse_trak(data, pstart, bend)
+			elif t == b'mvex':
+				for t2, bstart2, pstart2, bend2 in iter_boxes(data, pstart, bend):
+					if t2 == b'trex':
+						track_id, desc_idx, duration, size, flags = struct.unpack_from('>5I', data, pstart2 + 4)
+						self.trex[track_id] = size
+
+	# #################################################################################################
+
+	def parse_trak(self, data, start, end):
+		tkhd = find_box(data, start, end, b'tkhd')
+		if not tkhd:
+			return
+
+		version = _u8.unpack_from(data, tkhd[1])[0]
+		track_id = _u32.unpack_from(data, tkhd[1] + (20 if version == 1 else 12))[0]
+
+		pos = (start, end)
+		for name in (b'mdia', b'minf', b'stbl', b'stsd'):
+			box = find_box(data, pos[0], pos[1], name)
+			if not box:
+				return
+			pos = (box[1], box[2])
+
+		# skip full box header + entry count
+		for t, bstart, pstart, bend in iter_boxes(data, pos[0] + 8, pos[1]):
+			if t not in PROTECTED_SAMPLE_ENTRIES:
+				continue
+
+			# sample entries have type specific header before child boxes, so search directly for sinf box
+			i = data.find(b'sinf', pstart, bend)
+			while i != -1:
+				sinf_start = i - 4
+				sinf_end = sinf_start + _u32.unpack_from(data, sinf_start)[0]
+				if sinf_end <= bend and sinf_end > i:
+					info = self.parse_sinf(data, i + 4, sinf_end)
+					if info:
+						self.tracks[track_id] = info
+						return
+				i = data.find(b'sinf', i + 4, bend)
+
+	# #################################################################################################
+
+	def parse_sinf(self, data, start, end):
+		scheme = b'cenc'
+		info = None
+
+		for t, bstart, pstart, bend in iter_boxes(data, start, end):
+			if t == b'schm':
+				scheme = bytes(data[pstart + 4:pstart + 8])
+			elif t == b'schi':
+				tenc = find_box(data, pstart, bend, b'tenc')
+				if tenc:
+					p = tenc[1]
+					version = _u8.unpack_from(data, p)[0]
+					pattern = _u8.unpack_from(data, p + 5)[0] if version > 0 else 0
+					protected, iv_size = struct.unpack_from('>BB', data, p + 6)
+					kid = b2a_hex(data[p + 8:p + 24]).decode('ascii')
+					constant_iv = None
+					if protected and iv_size == 0:
+						civ_size = _u8.unpack_from(data, p + 24)[0]
+						constant_iv = bytes(data[p + 25:p + 25 + civ_size])
+
+					info = TrackEncryptionInfo(kid=kid, iv_size=iv_size, constant_iv=constant_iv, crypt_byte_block=pattern >> 4, skip_byte_block=pattern & 0x0F, protected=protected != 0)
+
+		if info:
+			info.scheme = scheme
+
+		return info
+
+# #################################################################################################
+
+class CencDecrypter(object):
+	'''
+	Decrypts CENC protected media segments using keys in format "kid:key" (hex encoded)
+	'''
+	def __init__(self, keys):
+		self.keys = {}
+		for k in keys:
+			kid, key = k.split(':')
+			self.keys[kid.lower()] = a2b_hex(key)
+
+	# #################################################################################################
+
+	def get_key(self, kid):
+		key = self.keys.get(kid)
+
+		if key == None and len(self.keys) == 1:
+			# only one key available - it must be the one we need
+			key = list(self.keys.values())[0]
+
+		if key == None:
+			raise CencDecryptError("No key available for KID %s" % kid)
+
+		return key
+
+	# #################################################################################################
+
+	def decrypt(self, init, data):
+		'''
+		Decrypts media segment. init is InitSegment object, raw init segment data or None
+		'''
+		if _aes_impl == None:
+			raise CencDecryptError("No AES implementation available")
+
+		if not isinstance(init, InitSegment):
+			init = InitSegment(init)
+
+		buf = bytearray(data)
+		for t, bstart, pstart, bend in iter_boxes(buf, 0, len(buf)):
+			if t == b'moof':
+				for job in self.prepare_fragment(init, buf, 0, bstart, pstart, bend):
+					self.apply_job(buf, 0, job)
+
+		return bytes(buf)
+
+	# #################################################################################################
+
+	def apply_job(self, buf, buf_offset, job):
+		'''
+		Decrypts one sample described by job in buffer, that starts on absolute position buf_offset
+		'''
+		pos, size, decrypt_sample, key, iv, subsamples, info = job
+		pos -= buf_offset
+		if pos < 0 or pos + size > len(buf):
+			raise CencDecryptError("Sample data out of segment range")
+
+		decrypt_sample(buf, pos, size, key, iv, subsamples, info)
+
+	# #################################################################################################
+
+	def prepare_fragment(self, init, buf, buf_offset, moof_start, start, end):
+		'''
+		Parses moof box and returns list of decryption jobs for all encrypted samples sorted by sample position.
+		Positions in buffer are relative to buf_offset, positions of samples in jobs are absolute.
+		'''
+		jobs = []
+		for t, bstart, pstart, bend in iter_boxes(buf, start, end):
+			if t == b'traf':
+				jobs.extend(self.prepare_track_fragment(init, buf, buf_offset, moof_start, pstart, bend))
+			elif t == b'pssh':
+				buf[bstart + 4:bstart + 8] = b'free'
+
+		jobs.sort(key=lambda j: j[0])
+		return jobs
+
+	# #################################################################################################
+
+	def prepare_track_fragment(self, init, buf, buf_offset, moof_start, start, end):
+		tfhd = None
+		truns = []
+		senc = None
+		saiz = None
+		saio = None
+		to_free = []
+
+		for t, bstart, pstart, bend in iter_boxes(buf, start, end):
+			if t == b'tfhd':
+				tfhd = pstart
+			elif t == b'trun':
+				truns.append(pstart)
+			elif t == b'senc':
+				senc = (pstart, bend, False)
+				to_free.append(bstart)
+			elif t == b'uuid' and bytes(buf[bstart + 8:bstart + 24]) == PIFF_SENC_UUID:
+				senc = (pstart, bend, True)
+				to_free.append(bstart)
+			elif t == b'saiz':
+				saiz = pstart
+				to_free.append(bstart)
+			elif t == b'saio':
+				saio = pstart
+				to_free.append(bstart)
+
+		if tfhd == None:
+			return []
+
+		# track fragment header
+		flags = _u32.unpack_from(buf, tfhd)[0] & 0xFFFFFF
+		track_id = _u32.unpack_from(buf, tfhd + 4)[0]
+		p = tfhd + 8
+		base_offset = buf_offset + moof_start
+		default_size = init.trex.get(track_id, 0)
+
+		if flags & 0x01:
+			base_offset = _u64.unpack_from(buf, p)[0]
+			p += 8
+		if flags & 0x02:
+			p += 4
+		if flags & 0x08:
+			p += 4
+		if flags & 0x10:
+			default_size = _u32.unpack_from(buf, p)[0]
+
+		info = init.tracks.get(track_id)
+		if info == None and len(init.tracks) == 1:
+			info = list(init.tracks.values())[0]
+
+		if info != None and not info.protected:
+			return []
+
+		if senc == None and (saiz == None or saio == None):
+			# no sample encryption data found - fragment is not encrypted
+			return []
+
+		# collect positions and sizes of all samples
+		samples = []
+		data_pos = base_offset
+		for p in truns:
+			flags = _u32.unpack_from(buf, p)[0] & 0xFFFFFF
+			sample_count = _u32.unpack_from(buf, p + 4)[0]
+			p += 8
+			if flags & 0x01:
+				data_pos = base_offset + struct.unpack_from('>i', buf, p)[0]
+				p += 4
+			if flags & 0x04:
+				p += 4
+
+			size_off = None
+			entry_size = 0
+			for f in (0x100, 0x200, 0x400, 0x800):
+				if flags & f:
+					if f == 0x200:
+						size_off = entry_size
+					entry_size += 4
+
+			for i in range(sample_count):
+				if size_off != None:
+					size = _u32.unpack_from(buf, p + size_off)[0]
+				else:
+					size = default_size
+				samples.append((data_pos, size))
+				data_pos += size
+				p += entry_size
+
+		if senc != None:
+			sample_info, info = self.parse_senc(buf, senc, info, len(samples))
+		else:
+			sample_info = self.parse_aux_info(buf, saiz, saio, base_offset - buf_offset, info, len(samples))
+
+		if info == None:
+			raise CencDecryptError("Encryption info for track %d not available" % track_id)
+
+		key = self.get_key(info.kid)
+
+		if len(sample_info) < len(samples):
+			raise CencDecryptError("Sample encryption info count mismatch (%d < %d)" % (len(sample_info), len(samples)))
+
+		if info.scheme in (b'cenc', b'cens'):
+			decrypt_sample = self.decrypt_sample_ctr
+		elif info.scheme in (b'cbcs', b'cbc1'):
+			decrypt_sample = self.decrypt_sample_cbc
+		else:
+			raise CencDecryptError("Unsupported protection scheme %s" % info.scheme)
+
+		for p in to_free:
+			buf[p + 4:p + 8] = b'free'
+
+		return [(pos, size, decrypt_sample, key, iv, subsamples, info) for (pos, size), (iv, subsamples) in zip(samples, sample_info)]
+
+	# #################################################################################################
+
+	def parse_senc(self, buf, senc, info, sample_count):
+		start, end, piff = senc
+		flags = _u32.unpack_from(buf, start)[0] & 0xFFFFFF
+		p = start + 4
+
+		if piff and flags & 0x01:
+			# PIFF box overrides track encryption parameters
+			iv_size = _u8.unpack_from(buf, p + 3)[0]
+			kid = b2a_hex(buf[p + 4:p + 20]).decode('ascii')
+			info = TrackEncryptionInfo(kid=kid, iv_size=iv_size)
+			p += 20
+
+		count = _u32.unpack_from(buf, p)[0]
+		p += 4
+
+		if info == None:
+			# init segment is not available - assume cenc scheme and guess IV size from senc data
+			for iv_size in (8, 16):
+				if self.check_senc_layout(buf, p, end, count, iv_size, flags & 0x02):
+					info = TrackEncryptionInfo(iv_size=iv_size)
+					break
+			else:
+				raise CencDecryptError("Failed to detect IV size of senc box")
+
+		return self.parse_sample_entries(buf, p, count, info, flags & 0x02), info
+
+	# #################################################################################################
+
+	@staticmethod
+	def check_senc_layout(buf, p, end, count, iv_size, has_subsamples):
+		for i in range(count):
+			p += iv_size
+			if has_subsamples:
+				if p + 2 > end:
+					return False
+				p += 2 + _u16.unpack_from(buf, p)[0] * 6
+
+		return p == end
+
+	# #################################################################################################
+
+	def parse_aux_info(self, buf, saiz, saio, base_offset, info, sample_count):
+		if info == None:
+			raise CencDecryptError("Init segment is needed to decrypt segment without senc box")
+
+		p = saiz
+		flags = _u32.unpack_from(buf, p)[0] & 0xFFFFFF
+		p += 12 if flags & 0x01 else 4
+		default_size = _u8.unpack_from(buf, p)[0]
+		count = _u32.unpack_from(buf, p + 1)[0]
+		if default_size == 0:
+			sizes = bytearray(buf[p + 5:p + 5 + count])
+		else:
+			sizes = None
+
+		p = saio
+		version = _u8.unpack_from(buf, p)[0]
+		flags = _u32.unpack_from(buf, p)[0] & 0xFFFFFF
+		p += 12 if flags & 0x01 else 4
+		entry_count = _u32.unpack_from(buf, p)[0]
+		if entry_count != 1:
+			raise CencDecryptError("Unsupported count of saio entries: %d" % entry_count)
+
+		if version == 0:
+			offset = _u32.unpack_from(buf, p + 4)[0]
+		else:
+			offset = _u64.unpack_from(buf, p + 4)[0]
+
+		p = base_offset + offset
+		if p < 0 or p > len(buf):
+			raise CencDecryptError("Sample auxiliary informations are out of available data")
+
+		has_subsamples = (default_size or (max(sizes) if sizes else 0)) > info.iv_size
+		return self.parse_sample_entries(buf, p, count, info, has_subsamples)
+
+	# #################################################################################################
+
+	@staticmethod
+	def parse_sample_entries(buf, p, count, info, has_subsamples):
+		iv_size = info.iv_size
+		entries = []
+
+		for i in range(count):
+			if iv_size:
+				iv = bytes(buf[p:p + iv_size])
+				p += iv_size
+			else:
+				iv = info.constant_iv
+
+			subsamples = None
+			if has_subsamples:
+				n = _u16.unpack_from(buf, p)[0]
+				p += 2
+				subsamples = [_subsample.unpack_from(buf, p + 6 * j) for j in range(n)]
+				p += 6 * n
+
+			entries.append((iv, subsamples))
+
+		return entries
+
+	# #################################################################################################
+
+	@staticmethod
+	def encrypted_ranges(pos, size, subsamples):
+		if not subsamples:
+			return [(pos, size)]
+
+		ranges = []
+		for clear, encrypted in subsamples:
+			pos += clear
+			if encrypted:
+				ranges.append((pos, encrypted))
+			pos += encrypted
+
+		return ranges
+
+	# #################################################################################################
+
+	@staticmethod
+	def pattern_blocks(pos, size, crypt_byte_block, skip_byte_block):
+		'''
+		Returns list of (position, size) of encrypted blocks in protected range when pattern encryption is used
+		'''
+		if crypt_byte_block == 0 or skip_byte_block == 0:
+			# no pattern - whole blocks are encrypted, the rest is left in clear
+			size -= size % 16
+			return [(pos, size)] if size else []
+
+		ret = []
+		crypt_size = crypt_byte_block * 16
+		step = (crypt_byte_block + skip_byte_block) * 16
+		end = pos + size
+		while pos + 16 <= end:
+			s = min(crypt_size, end - pos)
+			s -= s % 16
+			ret.append((pos, s))
+			pos += step
+
+		return ret
+
+	# #################################################################################################
+
+	def decrypt_sample_ctr(self, buf, pos, size, key, iv, subsamples, info):
+		if len(iv) == 8:
+			iv += b'\x00' * 8
+
+		ranges = self.encrypted_ranges(pos, size, subsamples)
+
+		if info.scheme == b'cens' and info.crypt_byte_block and info.skip_byte_block:
+			blocks = []
+			for p, s in ranges:
+				blocks.extend(self.pattern_blocks(p, s, info.crypt_byte_block, info.skip_byte_block))
+			ranges = blocks
+
+		self.decrypt_ranges(buf, ranges, aes_ctr_decrypt, key, iv)
+
+	# #################################################################################################
+
+	def decrypt_sample_cbc(self, buf, pos, size, key, iv, subsamples, info):
+		if len(iv) == 8:
+			iv += b'\x00' * 8
+
+		ranges = self.encrypted_ranges(pos, size, subsamples)
+
+		if info.scheme == b'cbcs':
+			# IV is reset at the beginning of each subsample
+			for p, s in ranges:
+				self.decrypt_ranges(buf, self.pattern_blocks(p, s, info.crypt_byte_block, info.skip_byte_block), aes_cbc_decrypt, key, iv)
+		else:
+			# cbc1 - CBC chain continues over all subsamples
+			blocks = []
+			for p, s in ranges:
+				s -= s % 16
+				if s:
+					blocks.append((p, s))
+			self.decrypt_ranges(buf, blocks, aes_cbc_decrypt, key, iv)
+
+	# #################################################################################################
+
+	@staticmethod
+	def decrypt_ranges(buf, ranges, decrypt_fn, key, iv):
+		'''
+		Encrypted ranges form one continuous cipher stream, so collect them, decrypt at once
+		and put decrypted data back to its positions
+		'''
+		if not ranges:
+			return
+
+		if len(ranges) == 1:
+			p, s = ranges[0]
+			buf[p:p + s] = decrypt_fn(key, iv, bytes(buf[p:p + s]))
+			return
+
+		dec = decrypt_fn(key, iv, b''.join(bytes(buf[p:p + s]) for p, s in ranges))
+
+		i = 0
+		for p, s in ranges:
+			buf[p:p + s] = dec[i:i + s]
+			i += s
+
+# #################################################################################################
+
+class CencStreamDecrypter(object):
+	'''
+	Incremental version of CencDecrypter. Segment data are fed in chunks as they are received and decrypted
+	output is passed to write_cbk as soon as all samples covering it are complete. Only one sample (plus
+	one received chunk) is held in memory at a time.
+	'''
+	OPEN_END = 1 << 62
+
+	def __init__(self, keys, init, write_cbk):
+		if _aes_impl == None:
+			raise CencDecryptError("No AES implementation available")
+
+		self.decrypter = CencDecrypter(keys)
+		self.init = init if isinstance(init, InitSegment) else InitSegment(init)
+		self.write = write_cbk
+		self.buf = bytearray()
+		self.offset = 0 # absolute position of buf[0] in segment
+		self.box_end = None # absolute end position of currently processed top level box
+		self.in_mdat = False
+		self.jobs = deque()
+
+	# #################################################################################################
+
+	def feed(self, data):
+		self.buf.extend(data)
+		self.process()
+
+	# #################################################################################################
+
+	def finish(self):
+		if self.jobs or self.buf or (self.box_end != None and self.box_end != self.OPEN_END):
+			raise CencDecryptError("Segment data are incomplete")
+
+	# #################################################################################################
+
+	def emit(self, size):
+		if size > 0:
+			data = bytes(self.buf[:size])
+			del self.buf[:size]
+			self.offset += size
+			self.write(data)
+
+	# #################################################################################################
+
+	def read_box_header(self):
+		buf = self.buf
+		if len(buf) < 8:
+			return None
+
+		size = _u32.unpack_from(buf, 0)[0]
+		box_type = bytes(buf[4:8])
+
+		if size == 1:
+			if len(buf) < 16:
+				return None
+			size = _u64.unpack_from(buf, 8)[0]
+		elif size == 0:
+			size = self.OPEN_END
+		elif size < 8:
+			raise CencDecryptError("Invalid size of box %s" % box_type)
+
+		return box_type, size
+
+	# #################################################################################################
+
+	def process(self):
+		while self.buf:
+			if self.box_end == None:
+				hdr = self.read_box_header()
+				if hdr == None:
+					return
+
+				box_type, size = hdr
+				if box_type == b'moof':
+					if len(self.buf) < size:
+						# moof box needs to be complete before we can continue
+						return
+
+					self.jobs.extend(self.decrypter.prepare_fragment(self.init, self.buf, self.offset, 0, 8, size))
+					self.emit(size)
+					continue
+
+				self.box_end = size if size == self.OPEN_END else self.offset + size
+				self.in_mdat = box_type == b'mdat'
+
+			limit = min(self.offset + len(self.buf), self.box_end)
+
+			if self.in_mdat:
+				# decrypt all samples, that are complete
+				jobs = self.jobs
+				while jobs and jobs[0][0] + jobs[0][1] <= limit:
+					self.decrypter.apply_job(self.buf, self.offset, jobs.popleft())
+
+				if jobs and jobs[0][0] < limit:
+					# data of next sample are not complete yet
+					limit = jobs[0][0]
+
+			self.emit(limit - self.offset)
+
+			if self.offset >= self.box_end:
+				self.box_end = None
+				self.in_mdat = False
+			else:
+				return
+
+# #################################################################################################
@@ -1,23 +1,35 @@
 # -*- coding: utf-8 -*-
 import os
 import subprocess
+import threading
 from Plugins.Extensions.archivCZSK.engine.tools.stbinfo import stbinfo
+from Plugins.Extensions.archivCZSK.engine import client
+from twisted.internet.threads import deferToThread
+from .cencdecrypt import CencDecrypter, InitSegment, is_available as internal_decrypt_available
 
 tmp_file_id = 1
+# mp4decrypt() runs in worker threads, so more segments can be decrypted in parallel
+tmp_file_lock = threading.Lock()
 DECRYPT_CMD = os.path.join(os.path.dirname(__file__), 'bin', 'mp4decrypt_%s' % stbinfo.hw_arch)
 
 def mp4decrypt(keys, init_data, enc_data):
 	# this is very simple and unefective implementation that blocks reactor and that is definitely not what we want ...
-	# needs complete rewrite to async ...
+	# use mp4decrypt_async() instead
 	global tmp_file_id
 
+	if isinstance(init_data, InitSegment):
+		init_data = init_data.data
+
+	with tmp_file_lock:
+		file_id = '%d_%d' % (threading.current_thread().ident or 0, tmp_file_id)
+		tmp_file_id += 1
+		if tmp_file_id >= 1000:
+			tmp_file_id = 1
+
 	# create temp file with segment data
-	tmp_file_name_init = os.path.join( '/tmp', '._init_%d.mp4' % tmp_file_id)
-	tmp_file_name_in = os.path.join( '/tmp', '._in_%d.m4s' % tmp_file_id)
-	tmp_file_name_out = os.path.join( '/tmp', '._out_%d.m4s' % tmp_file_id)
-	tmp_file_id += 1
-	if tmp_file_id >= 1000:
-		tmp_file_id = 1
+	tmp_file_name_init = os.path.join( '/tmp', '._init_%s.mp4' % file_id)
+	tmp_file_name_in = os.path.join( '/tmp', '._in_%s.m4s' % file_id)
+	tmp_file_name_out = os.path.join( '/tmp', '._out_%s.m4s' % file_id)
 
 	with open(tmp_file_name_in, 'wb') as f:
 		f.write(enc_data)
@@ -56,3 +68,27 @@ def mp4decrypt(keys, init_data, enc_data):
 			pass
 
 	return data_out
+
+# #################################################################################################
+
+def mp4decrypt_internal(keys, init_data, enc_data):
+	'''
+	Decrypts segment in memory without need of external binary. If internal decryption is not possible,
+	then it falls back to mp4decrypt binary.
+	init_data can be raw init segment data or already parsed InitSegment object.
+	'''
+	if internal_decrypt_available():
+		try:
+			return CencDecrypter(keys).decrypt(init_data, enc_data)
+		except Exception as e:
+			client.log.error("Internal CENC decryption failed: %s - falling back to mp4decrypt binary" % str(e))
+
+	return mp4decrypt(keys, init_data, enc_data)
+
+# #################################################################################################
+
+def mp4decrypt_async(keys, init_data, enc_data):
+	'''
+	Non blocking version of mp4decrypt() - decryption runs outside of reactor thread. Returns Deferred, that fires with decrypted data
+	'''
+	return deferToThread(mp4decrypt_internal, keys, init_data, enc_data)
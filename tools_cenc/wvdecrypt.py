@@ -14,4 +14,10 @@ except:
 			pass
 
 		def get_content_keys(self, *args, **kwargs):
-			return []
+			return ([], None) if kwargs.get('with_duration') else []
+
+		def open_session(self, *args, **kwargs):
+			return None
+
+		def close_session(self, *args, **kwargs):
+			pass
@@ -385,3 +385,13 @@ class Cdm:
 		else:
 			self.logger.error("session not found")
 			return 1
+
+	# returns duration of provided license in seconds or None if license policy has no time limit
+	def get_license_duration(self, session_id):
+		session = self.sessions.get(session_id)
+		if session == None or session.license == None:
+			return None
+
+		policy = session.license.Msg._Policy
+		durations = [d for d in (policy.LicenseDurationSeconds, policy.PlaybackDurationSeconds, policy.RentalDurationSeconds) if d > 0]
+		return min(durations) if durations else None
@@ -49,20 +49,48 @@ class WvDecrypt(object):
 		else:
 			return pssh_b64
 
-	def get_content_keys(self, pssh, lic_cbk, service_cert_cbk=None):
+	def open_session(self, pssh):
+		'''
+		Opens new CDM session for pssh and returns it's ID or None on failure.
+		This (together with functions bellow) can be used for non blocking licence exchange:
+		open_session() -> [set_service_certificate()] -> get_license_challenge() -> process_license()
+		'''
 		session = self.cdm.open_session(self.check_pssh(pssh), self.device_config)
-		if service_cert_cbk:
-			self.cdm.set_service_certificate(session, service_cert_cbk(self.cdm.CERTIFICATE_CHALLENGE))
+		return None if session == 1 else session
+
+	def close_session(self, session):
+		self.cdm.close_session(session)
+
+	def get_service_certificate_challenge(self):
+		return self.cdm.CERTIFICATE_CHALLENGE
+
+	def set_service_certificate(self, session, cert):
+		self.cdm.set_service_certificate(session, cert)
 
-		lic_response = lic_cbk(self.cdm.get_license_request(session))
-		if not lic_response:
-			self.cdm.close_session(session)
-			return []
+	def get_license_challenge(self, session):
+		return self.cdm.get_license_request(session)
 
-		if self.cdm.provide_license(session, lic_response) == 0:
+	def process_license(self, session, lic_response, with_duration=False):
+		'''
+		Processes licence response, closes session and returns list of content keys.
+		If with_duration is set, then tuple (keys, licence duration in seconds or None if not limited) is returned.
+		'''
+		duration = None
+		if lic_response and self.cdm.provide_license(session, lic_response) == 0:
 			keys = [key.export() for key in filter(lambda k: k.type == 'CONTENT', self.cdm.get_keys(session))]
+			duration = self.cdm.get_license_duration(session)
 		else:
 			keys = []
 
 		self.cdm.close_session(session)
-		return keys
+		return (keys, duration) if with_duration else keys
+
+	def get_content_keys(self, pssh, lic_cbk, service_cert_cbk=None, with_duration=False):
+		session = self.open_session(pssh)
+		if session == None:
+			return ([], None) if with_duration else []
+
+		if service_cert_cbk:
+			self.set_service_certificate(session, service_cert_cbk(self.get_service_certificate_challenge()))
+
+		return self.process_license(session, lic_cbk(self.get_license_challenge(session)), with_duration)